@@ -0,0 +1,168 @@
+"""
+ Running / pending application index for Unravel Auto Scaling on HDInsight
+
+ Pages through Unravel's /api/v1/apps/search and keeps the running and
+ pending applications of a cluster keyed by app id. Every refresh is applied
+ as a diff (added, updated, finished) so records keep when they were first seen.
+"""
+import json
+import time
+from collections import deque
+
+RUNNING = 'R'
+PENDING = 'W'
+APP_TYPES = ['mr', 'hive', 'spark', 'cascading', 'pig']
+
+# Index record key -> field of an Unravel search result
+APP_FIELDS = {'type': 'kind',
+              'state': 'status',
+              'duration': 'duration_long',
+              'queue': 'queue',
+              'memory': 'allocatedMB',
+              'vcores': 'allocatedVCores',
+              'cluster': 'clusterId'}
+
+
+def search_apps(session, url, statuses=(RUNNING, PENDING), app_types=APP_TYPES, page_size=100, timeout=None, cluster_name=None):
+    """Yield every result of the apps search, of cluster_name only when given, one page request at a time"""
+    offset = 0
+    while True:
+        search_input = {'appStatus': list(statuses),
+                        'from': offset,
+                        'size': page_size,
+                        'appTypes': list(app_types)}
+        if cluster_name:
+            search_input['clusters'] = [cluster_name]
+        res = session.post(url, json=search_input, timeout=timeout)
+        res.raise_for_status()
+        parsed = json.loads(res.text) or {}
+        results = parsed.get('results') or []
+        for result in results:
+            yield result
+        offset += len(results)
+        total = parsed.get('metadata', {}).get('totalRecords')
+        if len(results) < page_size or (total is not None and offset >= total):
+            return
+
+
+def requested_resources(result):
+    """
+    (vcores, MB) an app asks for and has not been given yet: its pending
+    fields, else the sum of its outstanding YARN resource requests, None when
+    the result has neither. A pending app has next to nothing allocated.
+    """
+    if result.get('pendingVCores') is not None or result.get('pendingMB') is not None:
+        return float(result.get('pendingVCores') or 0), float(result.get('pendingMB') or 0)
+    requests = result.get('resourceRequests')
+    if not requests:
+        return None
+    vcores = memory = 0.0
+    for request in requests:
+        capability = request.get('capability') or {}
+        containers = request.get('numContainers', 1)
+        vcores += (capability.get('vCores') or 0) * containers
+        memory += (capability.get('memory') or 0) * containers
+    return vcores, memory
+
+
+def to_record(result):
+    record = dict((key, result.get(field)) for key, field in APP_FIELDS.items())
+    record['id'] = result['id']
+    record['duration'] = record['duration'] or 0
+    record['memory'] = float(record['memory'] or 0)
+    record['vcores'] = float(record['vcores'] or 0)
+    record['pending_vcores'], record['pending_memory'] = requested_resources(result) or (None, None)
+    return record
+
+
+class AppIndex(object):
+    def __init__(self, cluster_name=None, clock=time.time, history_size=200):
+        self.cluster_name = cluster_name
+        self.clock = clock
+        self.apps = {}
+        self.history_size = history_size
+        self.finished_durations = {}       # app type -> durations (ms) of the last finished apps
+
+    def refresh(self, results):
+        """Apply a full listing of running/pending apps, returns {'added': , 'updated': , 'finished': } counts"""
+        now = self.clock()
+        seen = set()
+        diff = {'added': 0, 'updated': 0, 'finished': 0}
+        for result in results:
+            record = to_record(result)
+            if self.cluster_name and record['cluster'] not in (None, self.cluster_name):
+                continue
+            seen.add(record['id'])
+            current = self.apps.get(record['id'])
+            if current is None:
+                record['first_seen'] = now
+                self.apps[record['id']] = record
+                diff['added'] += 1
+            else:
+                changed = [key for key in record if key != 'id' and current[key] != record[key]]
+                if changed:
+                    for key in changed:
+                        current[key] = record[key]
+                    diff['updated'] += 1
+        for app_id in set(self.apps) - seen:
+            app = self.apps.pop(app_id)
+            if app['state'] == RUNNING:
+                self.finished_durations.setdefault(app['type'], deque(maxlen=self.history_size)).append(app['duration'])
+            diff['finished'] += 1
+        return diff
+
+    def typical_duration(self, app_type, elapsed=0):
+        """
+        Median duration (ms) of the finished apps of app_type that ran longer
+        than elapsed ms, None when none did
+        """
+        durations = sorted(duration for duration in self.finished_durations.get(app_type) or [] if duration > elapsed)
+        if not durations:
+            return None
+        return durations[len(durations) // 2]
+
+    def running(self):
+        return [app for app in self.apps.values() if app['state'] == RUNNING]
+
+    def pending(self):
+        return [app for app in self.apps.values() if app['state'] == PENDING]
+
+    def pending_count(self):
+        return len(self.pending())
+
+    def oldest_pending_age(self):
+        """Seconds the oldest pending app has been waiting, 0 when nothing is pending"""
+        pending = self.pending()
+        if not pending:
+            return 0
+        return self.clock() - min(app['first_seen'] for app in pending)
+
+    def demand_by_queue(self, state=PENDING, container_size=None):
+        """
+        queue -> {'apps': , 'vcores': , 'memory': } of the apps in state, what
+        running apps hold and pending ones request. A pending app whose request
+        is unknown counts as one container of container_size (vcores, MB) if given.
+        """
+        queues = {}
+        for app in self.apps.values():
+            if app['state'] != state:
+                continue
+            vcores, memory = app['vcores'], app['memory']
+            if state == PENDING:
+                if app['pending_vcores'] is not None:
+                    vcores, memory = app['pending_vcores'], app['pending_memory']
+                elif container_size:
+                    vcores, memory = container_size
+            queue = queues.setdefault(app['queue'] or 'default', {'apps': 0, 'vcores': 0.0, 'memory': 0.0})
+            queue['apps'] += 1
+            queue['vcores'] += vcores
+            queue['memory'] += memory
+        return queues
+
+    def pending_demand(self, container_size=None):
+        """(vcores, MB) requested by all pending apps"""
+        queues = self.demand_by_queue(PENDING, container_size)
+        return sum(q['vcores'] for q in queues.values()), sum(q['memory'] for q in queues.values())
+
+    def __len__(self):
+        return len(self.apps)
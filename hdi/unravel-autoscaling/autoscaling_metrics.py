@@ -0,0 +1,195 @@
+"""
+ Self instrumentation for Unravel Auto Scaling on HDInsight
+
+ Counters, gauges and histograms kept in process and served on a local HTTP
+ port in the Prometheus text format (version 0.0.4), no client library needed.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RESIZE_BUCKETS = (60, 120, 300, 600, 900, 1200, 1800, 2700, 3600)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError('%s expects labels %s, got %s' % (self.name, self.label_names, sorted(labels)))
+        return tuple(labels[name] for name in self.label_names)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            for key in sorted(self.values):
+                lines.extend(self.render_series(key, self.values[key]))
+        return lines
+
+    def render_series(self, key, value):
+        return ['%s%s %s' % (self.name, format_labels(self.label_names, key), format_value(value))]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.values.setdefault(key, {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def quantile(self, q, **labels):
+        """q-quantile interpolated within its bucket as Prometheus' histogram_quantile(), None without observations"""
+        with self.lock:
+            series = self.values.get(self.key(labels))
+            if not series or not series['count']:
+                return None
+            counts = list(series['counts'])
+        rank = q * counts[-1]
+        lower, below = 0.0, 0
+        for bound, count in zip(self.buckets, counts):
+            if count >= rank:
+                if bound == float('inf'):
+                    return lower
+                return lower + (bound - lower) * (rank - below) / float(count - below) if count > below else bound
+            lower, below = bound, count
+        return lower
+
+    def render_series(self, key, series):
+        lines = []
+        for bound, count in zip(self.buckets, series['counts']):
+            lines.append('%s_bucket%s %d' % (self.name, format_labels(self.label_names, key, [('le', format_value(bound))]), count))
+        lines.append('%s_sum%s %s' % (self.name, format_labels(self.label_names, key), format_value(series['sum'])))
+        lines.append('%s_count%s %d' % (self.name, format_labels(self.label_names, key), series['count']))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def clear(self):
+        """Forget every observation, e.g. between two benchmark runs in one process"""
+        for metric in self.metrics:
+            with metric.lock:
+                metric.values.clear()
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+ES_QUERY_SECONDS = REGISTRY.register(Histogram('autoscaler_es_query_seconds', 'Elasticsearch metric query latency, one query per batch of clusters'))
+RM_QUERY_SECONDS = REGISTRY.register(Histogram('autoscaler_rm_query_seconds', 'YARN ResourceManager cluster metrics latency', ['cluster']))
+RESOURCE_REQUEST_SECONDS = REGISTRY.register(Histogram('autoscaler_resource_request_seconds', 'Unravel resource endpoint latency', ['endpoint']))
+TOPOLOGY_LOOKUP_SECONDS = REGISTRY.register(Histogram('autoscaler_topology_lookup_seconds', 'Workernode count lookup latency, cache hits included', ['cluster']))
+CYCLE_SECONDS = REGISTRY.register(Histogram('autoscaler_cycle_seconds', 'Autoscaling cycle of one cluster, waiting for a slot in flight included'))
+DECISION_SECONDS = REGISTRY.register(Histogram('autoscaler_decision_seconds', 'Time to take a scaling decision from a sample', ['cluster']))
+JOURNAL_COMPACTION_SECONDS = REGISTRY.register(Histogram('autoscaler_journal_compaction_seconds', 'Journal compactions, run off the event loop'))
+RESIZE_SECONDS = REGISTRY.register(Histogram('autoscaler_resize_seconds', 'Duration of finished resizes', ['cluster', 'state'], buckets=RESIZE_BUCKETS))
+DECISIONS_TOTAL = REGISTRY.register(Counter('autoscaler_decisions_total', 'Scaling decisions by outcome', ['cluster', 'decision']))
+LOGINS_TOTAL = REGISTRY.register(Counter('autoscaler_unravel_logins_total', 'Logins to Unravel by reason (initial, expired, max_age)', ['reason']))
+STALE_SAMPLES_TOTAL = REGISTRY.register(Counter('autoscaler_stale_samples_total', 'Autoscaling cycles skipped because the newest sample was too old', ['cluster']))
+CYCLE_ERRORS_TOTAL = REGISTRY.register(Counter('autoscaler_cycle_errors_total', 'Autoscaling cycles that failed', ['cluster']))
+CPU_USAGE = REGISTRY.register(Gauge('autoscaler_cpu_usage_percent', 'Allocated vcores of the cluster', ['cluster']))
+MEMORY_USAGE = REGISTRY.register(Gauge('autoscaler_memory_usage_percent', 'Allocated memory of the cluster', ['cluster']))
+WORKERNODES = REGISTRY.register(Gauge('autoscaler_workernodes', 'Workernode count of the cluster', ['cluster']))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(port, host='127.0.0.1', registry=REGISTRY):
+    """Serve registry on http://host:port/metrics from a daemon thread, returns the server"""
+    handler = type('Handler', (MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,85 @@
+"""
+ Predictive scaling policy for Unravel Auto Scaling on HDInsight
+
+ Forecasts cpu/memory allocation at the time a new workernode would be ready
+ (Holt linear trend, Holt-Winters additive when a full season of history is
+ buffered) and asks for a scale up before the threshold is actually breached.
+"""
+try:
+    import numpy
+except Exception as e:
+    numpy = None
+    print(e)
+    print('numpy module is missing, predictive scaling is disabled')
+
+BUCKET_SECONDS = 30
+
+
+def holt_forecast(series, horizon, alpha=0.5, beta=0.3):
+    y = numpy.asarray(series, dtype=float)
+    level, trend = y[0], y[1] - y[0]
+    for value in y[1:]:
+        previous_level = level
+        level = alpha * value + (1 - alpha) * (level + trend)
+        trend = beta * (level - previous_level) + (1 - beta) * trend
+    return float(level + horizon * trend)
+
+
+def holt_winters_forecast(series, horizon, season_length, alpha=0.5, beta=0.3, gamma=0.1):
+    y = numpy.asarray(series, dtype=float)
+    seasons = y[:len(y) // season_length * season_length].reshape(-1, season_length)
+    season = seasons.mean(axis=0) - seasons.mean()
+    level = y[:season_length].mean()
+    trend = (seasons[1].mean() - seasons[0].mean()) / season_length
+    for i, value in enumerate(y):
+        s = season[i % season_length]
+        previous_level = level
+        level = alpha * (value - s) + (1 - alpha) * (level + trend)
+        trend = beta * (level - previous_level) + (1 - beta) * trend
+        season[i % season_length] = gamma * (value - level) + (1 - gamma) * s
+    return float(level + horizon * trend + season[(len(y) + horizon - 1) % season_length])
+
+
+def forecast(series, horizon, season_length=None, alpha=0.5, beta=0.3, gamma=0.1):
+    """Predicted value horizon buckets after the last sample of series"""
+    if season_length and len(series) >= 2 * season_length:
+        return holt_winters_forecast(series, horizon, season_length, alpha, beta, gamma)
+    return holt_forecast(series, horizon, alpha, beta)
+
+
+class ForecastPolicy(object):
+    """
+    provision_time: seconds until a requested workernode runs containers
+    season_length:  buckets in one season (e.g. 2880 for a day of 30s buckets), None for no seasonality
+    min_history:    buckets needed before forecasting at all
+    """
+    def __init__(self, provision_time=600, season_length=None, min_history=10, alpha=0.5, beta=0.3, gamma=0.1):
+        self.horizon = max(1, int(provision_time // BUCKET_SECONDS))
+        self.season_length = season_length
+        self.min_history = min_history
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+
+    @property
+    def enabled(self):
+        return numpy is not None
+
+    def predict(self, buffer):
+        """Predicted {'cpu_usage', 'memory_usage'} at the time a new node is ready, None without enough history"""
+        if not self.enabled or len(buffer) < self.min_history:
+            return None
+        return dict((key, min(100.0, max(0.0, forecast(buffer.series(key), self.horizon, self.season_length, self.alpha, self.beta, self.gamma))))
+                    for key in ('cpu_usage', 'memory_usage'))
+
+    def check(self, buffer, resources_usage, cluster):
+        """
+        Returns (decision, predicted). decision is 'Up Scaling' when usage is
+        forecast over the thresholds and the cluster may still grow, otherwise None
+        """
+        predicted = self.predict(buffer)
+        if predicted is None or resources_usage['nodes_count'] >= cluster['max_nodes']:
+            return None, predicted
+        if predicted['cpu_usage'] > cluster['cpu_threshold'] or predicted['memory_usage'] > cluster['memory_threshold']:
+            return 'Up Scaling', predicted
+        return None, predicted
@@ -0,0 +1,205 @@
+"""
+ Fleet load benchmark for Unravel Auto Scaling on HDInsight
+
+ Runs the autoscaler's fleet loop for duration seconds against the local
+ Unravel / Elasticsearch / Azure stand-in (unravel_standin.py) serving a
+ fleet of simulated clusters, and reports the decision throughput and the
+ per cycle latency read from the autoscaler's own metrics.
+
+ python load_benchmark.py --clusters 1000 --duration 120
+ python load_benchmark.py --clusters 1000 --in-flight 32 --api-latency 0.01 --output load-1000.json
+ python load_benchmark.py --clusters 1000 --no-journal
+ python load_benchmark.py --clusters 50 --metrics-source yarn
+
+ With --metrics-source yarn the clusters read their metrics from a YARN
+ ResourceManager stand-in (yarn_rm_standin.py) running half of their
+ initial capacity instead of Elasticsearch.
+ The warm restart journal is on by default (in a temporary directory unless
+ --journal is given), its compactions and size are reported separately.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import autoscaling_metrics as metrics
+import unravel_HDInsight_autoscaling as autoscaling
+from topology import AzureRestProvider, TopologyCache
+from unravel_standin import StandInFleet, canonical_traces, start_standin
+from yarn_rm_standin import ClusterModel
+from yarn_rm_standin import start_standin as start_yarn_standin
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def counter_total(counter, **match):
+    """Sum of the series of counter whose labels include match"""
+    with counter.lock:
+        return sum(value for key, value in counter.values.items()
+                   if all(dict(zip(counter.label_names, key)).get(name) == wanted for name, wanted in match.items()))
+
+
+def histogram_summary(histogram):
+    with histogram.lock:
+        series = histogram.values.get(())
+        count, total = (series['count'], series['sum']) if series else (0, 0.0)
+    summary = dict(('p%d' % round(q * 100), histogram.quantile(q)) for q in QUANTILES)
+    summary.update({'count': count, 'mean': total / count if count else None})
+    return summary
+
+
+def histogram_count(histogram):
+    """Observations of every series of histogram"""
+    with histogram.lock:
+        return sum(series['count'] for series in histogram.values.values())
+
+
+def configure(argv, url, journal_path):
+    """Point the autoscaler at the stand-in and size it for the fleet"""
+    autoscaling.max_clusters_in_flight = argv.in_flight
+    autoscaling.sample_interval = argv.sample_interval
+    autoscaling.poll_interval = argv.poll_interval
+    autoscaling.es_batch_size = argv.es_batch_size
+    autoscaling.resize_cooldown = argv.resize_cooldown
+    autoscaling.journal_path = journal_path
+    autoscaling.journal_compact_every = argv.journal_compact_every
+    autoscaling.s = autoscaling.new_session(argv.in_flight)
+    autoscaling.rm_session = autoscaling.new_rm_session(argv.in_flight)
+    autoscaling.use_unravel(url)
+    # Topology and resizes through the Azure REST provider, the stand-in answers for management.azure.com
+    autoscaling.topology_cache = TopologyCache(AzureRestProvider(autoscaling.s, 'standin', lambda: 'standin', timeout=autoscaling.request_timeout,
+                                                                 management_url=url), ttl=autoscaling.topology_ttl)
+    autoscaling.LOGGER.setLevel(logging.WARNING if argv.verbose else logging.CRITICAL)
+
+
+def new_clusters(names, argv, yarn_rm_url=None):
+    clusters = []
+    for name in names:
+        cluster = autoscaling.default_cluster()
+        cluster.update({'cluster_name': name, 'resource_group': 'standin', 'min_nodes': 2, 'max_nodes': 40,
+                        'worker_shape': argv.worker_shape, 'scale_down_planner': False,
+                        'metrics_source': argv.metrics_source, 'yarn_rm_url': yarn_rm_url})
+        clusters.append(cluster)
+    return clusters
+
+
+async def run_for(clusters, duration):
+    try:
+        await asyncio.wait_for(autoscaling.run_fleet(clusters), duration)
+    except asyncio.TimeoutError:
+        pass
+
+
+def run(argv):
+    names = ['standin-%04d' % i for i in range(argv.clusters)]
+    fleet = StandInFleet(names, canonical_traces(), argv.worker_shape, argv.initial_nodes, argv.speed, argv.resize_latency)
+    server = start_standin(fleet, latency=argv.api_latency)
+    yarn_server = yarn_rm_url = None
+    if argv.metrics_source == 'yarn':
+        model = ClusterModel(argv.initial_nodes, *argv.worker_shape)
+        model.update({'cores': argv.initial_nodes * argv.worker_shape[0] / 2.0, 'memory': argv.initial_nodes * argv.worker_shape[1] / 2.0})
+        yarn_server = start_yarn_standin(model=model)
+        yarn_rm_url = 'http://127.0.0.1:%d' % yarn_server.server_address[1]
+    temp_dir = None
+    journal_path = argv.journal
+    if journal_path is None and not argv.no_journal:
+        temp_dir = tempfile.mkdtemp(prefix='autoscaling-journal-')
+        journal_path = os.path.join(temp_dir, 'hdinsight_autoscaling.journal')
+    try:
+        configure(argv, server.url, journal_path)
+        metrics.REGISTRY.clear()
+        started = time.time()
+        asyncio.run(run_for(new_clusters(names, argv, yarn_rm_url), argv.duration))
+        elapsed = time.time() - started
+        journal_bytes = os.path.getsize(journal_path) if journal_path and os.path.exists(journal_path) else None
+    finally:
+        server.shutdown()
+        if yarn_server is not None:
+            yarn_server.shutdown()
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+    decisions = counter_total(metrics.DECISIONS_TOTAL)
+    return {'clusters': argv.clusters,
+            'metrics_source': argv.metrics_source,
+            'in_flight': argv.in_flight,
+            'duration': elapsed,
+            'decisions': decisions,
+            'decisions_per_second': decisions / elapsed,
+            'resize_decisions': counter_total(metrics.DECISIONS_TOTAL, decision='Up Scaling') + counter_total(metrics.DECISIONS_TOTAL, decision='Down Scaling'),
+            'resize_requests': fleet.requests.get('azure_resize', 0),
+            'cycle_errors': counter_total(metrics.CYCLE_ERRORS_TOTAL),
+            'logins': counter_total(metrics.LOGINS_TOTAL),
+            'cycle_seconds': histogram_summary(metrics.CYCLE_SECONDS),
+            'es_query_seconds': histogram_summary(metrics.ES_QUERY_SECONDS),
+            'rm_polls': histogram_count(metrics.RM_QUERY_SECONDS),
+            'journal_bytes': journal_bytes,
+            'journal_compaction_seconds': histogram_summary(metrics.JOURNAL_COMPACTION_SECONDS),
+            'standin_requests': dict(fleet.requests)}
+
+
+def format_seconds(value):
+    return '-' if value is None else '%.1fms' % (value * 1000)
+
+
+def print_report(result):
+    print('%d clusters, %d in flight, %.0fs, metrics from %s' % (result['clusters'], result['in_flight'], result['duration'], result['metrics_source']))
+    print('decisions:        %d (%.1f/s)' % (result['decisions'], result['decisions_per_second']))
+    print('resizes:          %d decided, %d sent to Azure' % (result['resize_decisions'], result['resize_requests']))
+    print('cycle errors:     %d' % result['cycle_errors'])
+    print('logins:           %d' % result['logins'])
+    for name in ('cycle_seconds', 'es_query_seconds'):
+        summary = result[name]
+        print('%-17s %s' % (name + ':', '  '.join('%s %s' % (q, format_seconds(summary[q])) for q in ('p50', 'p95', 'p99'))) +
+              '  (%d observed)' % summary['count'])
+    if result['rm_polls']:
+        print('rm polls:         %d' % result['rm_polls'])
+    if result['journal_bytes'] is None:
+        print('journal:          off')
+    else:
+        compactions = result['journal_compaction_seconds']
+        print('journal:          %.1fMB, %d compaction(s), mean %s' % (result['journal_bytes'] / 1048576.0, compactions['count'],
+                                                                        format_seconds(compactions['mean'])))
+    print('stand-in requests: %s' % ', '.join('%s %d' % item for item in sorted(result['standin_requests'].items())))
+
+
+def new_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clusters', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=120, help='Seconds the fleet loop runs')
+    parser.add_argument('--in-flight', type=int, default=autoscaling.max_clusters_in_flight, help='max_clusters_in_flight')
+    parser.add_argument('--sample-interval', type=int, default=30, help='Seconds between two decisions of a cluster')
+    parser.add_argument('--poll-interval', type=int, default=15, help='Seconds between two metric polls of the fleet')
+    parser.add_argument('--es-batch-size', type=int, default=autoscaling.es_batch_size)
+    parser.add_argument('--resize-cooldown', type=int, default=60)
+    parser.add_argument('--initial-nodes', type=int, default=3)
+    parser.add_argument('--worker-shape', type=float, nargs=2, default=[8, 28672], metavar=('VCORES', 'MB'))
+    parser.add_argument('--speed', type=float, default=60, help='Trace replay speed of the stand-in clusters')
+    parser.add_argument('--resize-latency', type=float, default=30, help='Seconds a stand-in resize takes')
+    parser.add_argument('--api-latency', type=float, default=0, help='Seconds the stand-in adds to every request')
+    parser.add_argument('--journal', help='Warm restart journal path, a temporary file by default')
+    parser.add_argument('--no-journal', action='store_true', help='Run without the warm restart journal')
+    parser.add_argument('--journal-compact-every', type=int, default=autoscaling.journal_compact_every)
+    parser.add_argument('--metrics-source', choices=('elasticsearch', 'yarn'), default='elasticsearch',
+                        help='Where the clusters read their metrics: the stand-in Elasticsearch, or a YARN ResourceManager stand-in')
+    parser.add_argument('--output', help='Write the results as JSON')
+    parser.add_argument('--verbose', action='store_true', help='Log the autoscaler warnings and errors')
+    return parser
+
+
+def main():
+    argv = new_parser().parse_args()
+
+    result = run(argv)
+    print_report(result)
+    if argv.output:
+        with open(argv.output, 'w') as f:
+            json.dump(dict(result, created=time.time()), f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    main()
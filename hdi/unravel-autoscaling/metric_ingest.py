@@ -0,0 +1,302 @@
+"""
+ Incremental metric ingestion for Unravel Auto Scaling on HDInsight
+
+ Each cluster keeps a cursor on the last date_histogram bucket it has seen and
+ only asks Elasticsearch for buckets from that point on. Samples are kept in a
+ fixed size ring buffer per cluster which the scaling policies read from.
+ A FleetIngestor polls many clusters with one terms aggregation on clusterName.
+
+ What a sample holds is declared in SIGNALS: a field of the YARN cluster
+ metrics documents, how Elasticsearch reduces it (avg, max, p95, p99) and over
+ which window, so only the reduced values come back.
+"""
+import json
+import time
+from collections import deque
+
+BUCKET_INTERVAL = '30s'
+INITIAL_WINDOW_MS = 120000
+MAX_LOOKBACK_MS = 3600000
+AGGREGATIONS = ('avg', 'max', 'p95', 'p99')
+
+
+class Signal(object):
+    """
+    name:   sample key the value is stored under
+    field:  field of the cluster metrics documents
+    agg:    'avg', 'max', 'p95' or 'p99'
+    window: None for one value per 30s bucket, or an Elasticsearch time unit
+            (e.g. '5m') for one value over the trailing window, set on the
+            newest sample of a poll
+    """
+    def __init__(self, name, field, agg='avg', window=None):
+        if agg not in AGGREGATIONS:
+            raise ValueError('Unknown aggregation %s of signal %s, expected one of %s' % (agg, name, AGGREGATIONS))
+        self.name = name
+        self.field = field
+        self.agg = agg
+        self.window = window
+
+    def aggregation(self):
+        if self.agg.startswith('p'):
+            return {'percentiles': {'field': self.field, 'percents': [float(self.agg[1:])]}}
+        return {self.agg: {'field': self.field}}
+
+    def value(self, result):
+        if self.agg.startswith('p'):
+            values = result.get('values') or {}
+            return values.get('%.1f' % float(self.agg[1:]))
+        return result.get('value')
+
+    def __repr__(self):
+        return 'Signal(%s = %s(%s)%s)' % (self.name, self.agg, self.field, ' over ' + self.window if self.window else '')
+
+
+SIGNALS = [Signal('total_memory', 'totalMB'),
+           Signal('total_cores', 'totalVCores'),
+           Signal('memory_allocated', 'allocatedMB'),
+           Signal('cores_allocated', 'allocatedVCores'),
+           Signal('pending_memory', 'pendingMB', 'max'),
+           Signal('pending_cores', 'pendingVCores', 'max'),
+           Signal('memory_allocated_p95', 'allocatedMB', 'p95', '5m'),
+           Signal('cores_allocated_p95', 'allocatedVCores', 'p95', '5m')]
+
+
+class MetricBuffer(object):
+    """Fixed size history of samples ordered by their bucket timestamp (epoch ms)"""
+    def __init__(self, size=720):
+        self.samples = deque(maxlen=size)
+
+    def add(self, sample):
+        # The newest bucket is still filling up, a later poll replaces it
+        if self.samples and self.samples[-1]['timestamp'] == sample['timestamp']:
+            self.samples[-1] = sample
+            return False
+        if self.samples and self.samples[-1]['timestamp'] > sample['timestamp']:
+            return False
+        self.samples.append(sample)
+        return True
+
+    def latest(self):
+        return self.samples[-1] if self.samples else None
+
+    def since(self, timestamp):
+        """Samples from timestamp on, oldest first"""
+        if timestamp is None:
+            return list(self.samples)
+        newer = []
+        for sample in reversed(self.samples):
+            if sample['timestamp'] < timestamp:
+                break
+            newer.append(sample)
+        return newer[::-1]
+
+    def series(self, key, count=None):
+        samples = list(self.samples)
+        if count is not None:
+            samples = samples[-count:]
+        return [sample[key] for sample in samples]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __iter__(self):
+        return iter(self.samples)
+
+
+def window_ms(window):
+    units = {'s': 1000, 'm': 60000, 'h': 3600000, 'd': 86400000}
+    return int(window[:-1]) * units[window[-1]]
+
+
+def query_start(cursors, now_ms):
+    """Oldest cursor, at most MAX_LOOKBACK_MS back"""
+    starts = [cursor if cursor is not None else now_ms - INITIAL_WINDOW_MS for cursor in cursors]
+    return max(min(starts), now_ms - MAX_LOOKBACK_MS)
+
+
+def cluster_filter(cluster_name, cursor, now_ms):
+    """The documents of one cluster from its own cursor on"""
+    # Re-read the cursor bucket, it may have been partial on the previous poll
+    return {'bool': {
+                'must': [{'range': {'date': {'gte': query_start([cursor], now_ms), 'lt': 'now', 'format': 'epoch_millis'}}},
+                         {'term': {'clusterName': cluster_name}}]
+            }
+           }
+
+
+def build_query(cluster_name, cursor=None, signals=SIGNALS, now_ms=None):
+    now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+    aggs = signal_aggs(signals)
+    aggs.update(window_aggs([cluster_name], signals))
+    return {'from': 0,
+            'size': 0,
+            'query': cluster_filter(cluster_name, cursor, now_ms),
+            'aggs': aggs
+           }
+
+
+def window_key(window):
+    return 'window_%s' % window
+
+
+def signal_aggs(signals=SIGNALS):
+    """The per bucket signals below a date_histogram of the buckets from the cursor on"""
+    return {'apps_over_time': {
+                'date_histogram': {'field': 'date', 'interval': BUCKET_INTERVAL, 'min_doc_count': 1},
+                'aggs': dict((signal.name, signal.aggregation()) for signal in signals if signal.window is None)
+            }
+           }
+
+
+def window_aggs(cluster_names, signals=SIGNALS):
+    """
+    The windowed signals of every cluster in cluster_names, one filter
+    aggregation per window. They sit below a global aggregation so their
+    trailing window is not cut to the cursor range of the query.
+    """
+    windows = {}
+    for signal in signals:
+        if signal.window is not None:
+            window = windows.setdefault(window_key(signal.window), {
+                'filter': {'bool': {'must': [{'range': {'date': {'gte': 'now-%s' % signal.window}}},
+                                             {'terms': {'clusterName': sorted(cluster_names)}}]}},
+                'aggs': {'clusters': {'terms': {'field': 'clusterName', 'size': len(cluster_names)}, 'aggs': {}}}
+            })
+            window['aggs']['clusters']['aggs'][signal.name] = signal.aggregation()
+    if not windows:
+        return {}
+    return {'windows': {'global': {}, 'aggs': windows}}
+
+
+def split_windows(aggregations):
+    """cluster name -> window key -> windowed signal results of a response"""
+    per_cluster = {}
+    for key, window in ((aggregations or {}).get('windows') or {}).items():
+        if not isinstance(window, dict) or 'clusters' not in window:
+            continue
+        for cluster_bucket in window['clusters']['buckets']:
+            per_cluster.setdefault(cluster_bucket['key'], {})[key] = cluster_bucket
+    return per_cluster
+
+
+def build_fleet_query(cursors, now_ms=None, signals=SIGNALS):
+    """
+    One query for many clusters, cursors is cluster name -> cursor (None for a
+    new cluster). Every cluster is matched from its own cursor on, so a
+    cluster that was not polled for a while does not make the others re-read
+    the buckets they have already seen.
+    """
+    now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+    aggs = {'clusters': {
+                'terms': {'field': 'clusterName', 'size': len(cursors)},
+                'aggs': signal_aggs(signals)
+            }
+           }
+    aggs.update(window_aggs(cursors, signals))
+    return {'from': 0,
+            'size': 0,
+            'query': {
+                'bool': {
+                    'should': [cluster_filter(name, cursors[name], now_ms) for name in sorted(cursors)],
+                    'minimum_should_match': 1
+                }
+            },
+            'aggs': aggs
+           }
+
+
+def bucket_to_sample(bucket, signals=SIGNALS):
+    sample = {'timestamp': int(bucket['key'])}
+    for signal in signals:
+        if signal.window is None:
+            sample[signal.name] = signal.value(bucket.get(signal.name) or {})
+    try:
+        cpu_percent_usage = sample['cores_allocated'] / sample['total_cores']  * 100
+        memory_percent_usage = sample['memory_allocated'] / sample['total_memory']  * 100
+    except:
+        cpu_percent_usage = 1.0
+        memory_percent_usage = 1.0
+    sample['cpu_usage'] = cpu_percent_usage
+    sample['memory_usage'] = memory_percent_usage
+    return sample
+
+
+class MetricIngestor(object):
+    def __init__(self, cluster_name, session, query_url, buffer_size=720, signals=SIGNALS, timeout=None):
+        self.cluster_name = cluster_name
+        self.session = session
+        self.query_url = query_url
+        self.buffer = MetricBuffer(buffer_size)
+        self.signals = signals
+        self.timeout = timeout
+        self.cursor = None
+
+    def poll(self):
+        """Fetch the buckets newer than the cursor, returns how many new samples were added"""
+        res = self.session.post(self.query_url, data=json.dumps(build_query(self.cluster_name, self.cursor, self.signals)),
+                                timeout=self.timeout)
+        res.raise_for_status()
+        response = json.loads(res.text)
+        aggregations = response.get('aggregations')
+        if aggregations:
+            aggregations['windows'] = split_windows(aggregations).get(self.cluster_name, {})
+        return self.ingest(response)
+
+    def ingest(self, response):
+        """
+        Add the buckets of a response of one cluster, its windowed signals
+        are under 'windows' by window key
+        """
+        aggregations = response.get('aggregations')
+        if not aggregations:
+            return 0
+        added = 0
+        for bucket in aggregations['apps_over_time']['buckets']:
+            sample = bucket_to_sample(bucket, self.signals)
+            if sample.get('total_cores') is None:
+                continue
+            if self.buffer.add(sample):
+                added += 1
+        latest = self.buffer.latest()
+        if latest is not None:
+            self.cursor = latest['timestamp']
+            for signal in self.signals:
+                if signal.window is not None:
+                    latest[signal.name] = signal.value(((aggregations.get('windows') or {}).get(window_key(signal.window)) or {}).get(signal.name) or {})
+        return added
+
+
+class FleetIngestor(object):
+    """Polls the MetricIngestors of many clusters in batches of one request each"""
+    def __init__(self, session, query_url, batch_size=100, signals=SIGNALS, timeout=None):
+        self.session = session
+        self.query_url = query_url
+        self.batch_size = batch_size
+        self.signals = signals
+        self.timeout = timeout
+        self.ingestors = {}
+
+    def add(self, ingestor):
+        self.ingestors[ingestor.cluster_name] = ingestor
+
+    def batches(self):
+        names = sorted(self.ingestors)
+        return [names[i:i + self.batch_size] for i in range(0, len(names), self.batch_size)]
+
+    def poll(self, names=None):
+        """One request for the clusters in names (all by default), returns cluster name -> new samples added"""
+        names = names if names is not None else sorted(self.ingestors)
+        query = build_fleet_query(dict((name, self.ingestors[name].cursor) for name in names), signals=self.signals)
+        res = self.session.post(self.query_url, data=json.dumps(query), timeout=self.timeout)
+        res.raise_for_status()
+        return self.split(json.loads(res.text), names)
+
+    def split(self, response, names):
+        per_cluster = {}
+        aggregations = response.get('aggregations')
+        if aggregations:
+            windows = split_windows(aggregations)
+            for cluster_bucket in aggregations['clusters']['buckets']:
+                per_cluster[cluster_bucket['key']] = dict(cluster_bucket, windows=windows.get(cluster_bucket['key'], {}))
+        return dict((name, self.ingestors[name].ingest({'aggregations': per_cluster.get(name)})) for name in names)
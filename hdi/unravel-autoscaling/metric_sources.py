@@ -0,0 +1,67 @@
+"""
+ Metric sources for Unravel Auto Scaling on HDInsight
+
+ A metric source keeps a cluster's MetricBuffer filled: poll() fetches what is
+ new and returns how many samples were added. MetricIngestor reads YARN's
+ cluster metrics as ingested by Unravel into Elasticsearch; YarnRmSource reads
+ them straight from the ResourceManager REST API, without the ingestion lag.
+"""
+import json
+import time
+
+from metric_ingest import MetricBuffer
+
+BUCKET_MS = 30000
+
+# Sample key -> field of the RM's /ws/v1/cluster/metrics clusterMetrics
+RM_FIELDS = {'total_memory': 'totalMB',
+             'total_cores': 'totalVirtualCores',
+             'memory_allocated': 'allocatedMB',
+             'cores_allocated': 'allocatedVirtualCores',
+             'memory_available': 'availableMB',
+             'cores_available': 'availableVirtualCores',
+             'pending_memory': 'pendingMB',
+             'pending_cores': 'pendingVirtualCores',
+             'active_nodes': 'activeNodes'}
+
+
+def cluster_metrics_to_sample(cluster_metrics, timestamp):
+    sample = dict((key, cluster_metrics.get(field)) for key, field in RM_FIELDS.items())
+    sample['timestamp'] = timestamp
+    # Capacity is allocated plus available when the RM reports no totals
+    if not sample['total_memory'] and sample['memory_available'] is not None:
+        sample['total_memory'] = (sample['memory_allocated'] or 0) + sample['memory_available']
+    if not sample['total_cores'] and sample['cores_available'] is not None:
+        sample['total_cores'] = (sample['cores_allocated'] or 0) + sample['cores_available']
+    try:
+        sample['cpu_usage'] = sample['cores_allocated'] / float(sample['total_cores']) * 100
+        sample['memory_usage'] = sample['memory_allocated'] / float(sample['total_memory']) * 100
+    except:
+        sample['cpu_usage'] = 1.0
+        sample['memory_usage'] = 1.0
+    return sample
+
+
+class YarnRmSource(object):
+    """
+    Cluster metrics read from the ResourceManager at rm_url. Samples are
+    keyed on the 30s bucket of the poll, a later poll in the same bucket
+    replaces the sample so the newest one is never older than a poll.
+    """
+    def __init__(self, cluster_name, session, rm_url, buffer_size=720, timeout=None, clock=time.time):
+        self.cluster_name = cluster_name
+        self.session = session
+        self.metrics_url = rm_url.rstrip('/') + '/ws/v1/cluster/metrics'
+        self.buffer = MetricBuffer(buffer_size)
+        self.timeout = timeout
+        self.clock = clock
+        self.cursor = None
+
+    def poll(self):
+        res = self.session.get(self.metrics_url, timeout=self.timeout)
+        res.raise_for_status()
+        now_ms = int(self.clock() * 1000)
+        sample = cluster_metrics_to_sample(json.loads(res.text)['clusterMetrics'], now_ms - now_ms % BUCKET_MS)
+        added = 1 if self.buffer.add(sample) else 0
+        self.cursor = sample['timestamp']
+        return added
@@ -0,0 +1,99 @@
+"""
+ Scale down planner for Unravel Auto Scaling on HDInsight
+
+ HDInsight removes workernodes without draining them, so YARN kills whatever
+ containers run there, and it picks the nodes to remove itself. The planner
+ limits a scale down to the capacity that is free or held by apps expected to
+ finish within the drain window, and with YARN node data to the nodes running
+ no container, assuming those are the ones removed. It delays the scale down
+ when nothing can be given back safely.
+"""
+import json
+
+from target_sizing import nodes_for_demand
+
+
+class ScaleDownPlan(object):
+    def __init__(self, nodes_count, requested, target, reason):
+        self.nodes_count = nodes_count
+        self.requested = requested
+        self.target = target
+        self.reason = reason
+
+    @property
+    def delayed(self):
+        return self.target >= self.nodes_count
+
+    def __repr__(self):
+        return 'ScaleDownPlan(%s -> %s requested, %s allowed: %s)' % (self.nodes_count, self.requested, self.target, self.reason)
+
+
+def estimate_remaining(app, typical_duration=None):
+    """
+    Seconds an app is expected to keep running. typical_duration is the median
+    duration (ms) of the finished apps of its type that ran longer than it has
+    so far, the app runs until then. An app that outran every finished app of
+    its type, or without any history, runs as long again as it already ran
+    (the longer a job has run, the longer it is likely to run).
+    """
+    elapsed = app['duration'] / 1000.0
+    if typical_duration is not None and elapsed < typical_duration / 1000.0:
+        return typical_duration / 1000.0 - elapsed
+    return elapsed
+
+
+def yarn_nodes(session, rm_url, timeout=None):
+    """Running NodeManagers from the YARN ResourceManager REST API"""
+    res = session.get(rm_url.rstrip('/') + '/ws/v1/cluster/nodes', params={'states': 'RUNNING'}, timeout=timeout)
+    res.raise_for_status()
+    nodes = (json.loads(res.text).get('nodes') or {}).get('node') or []
+    return [{'host': node['nodeHostName'],
+             'containers': node.get('numContainers', 0),
+             'used_vcores': node.get('usedVirtualCores', 0),
+             'used_memory': node.get('usedMemoryMB', 0)}
+            for node in nodes]
+
+
+def plan_scale_down(nodes_count, target, shape, running_apps, typical_duration=None, nodes=None, drain_window=600, free=None):
+    """
+    running_apps:     AppIndex records of the running apps
+    typical_duration: callable (app type, elapsed ms) -> median duration (ms) of
+                      the finished apps of that type which ran longer, or None
+    nodes:            yarn_nodes() result, None when per node usage is unknown
+    free:             (vcores, MB) of the cluster not allocated to any container, None when unknown
+    """
+    typical_duration = typical_duration or (lambda app_type, elapsed: None)
+    reasons = []
+    allowed = target
+
+    # Capacity held by apps that won't be done within the drain window has to stay
+    protected, draining = [], []
+    for app in running_apps:
+        remaining = estimate_remaining(app, typical_duration(app['type'], app['duration']))
+        (protected if remaining > drain_window else draining).append(app)
+    if protected and shape is not None:
+        protected_cores = sum(app['vcores'] for app in protected)
+        protected_memory = sum(app['memory'] for app in protected)
+        needed = nodes_for_demand(protected_cores, protected_memory, shape)
+        if needed > allowed:
+            allowed = needed
+            reasons.append('%d long running app(s) need %d node(s)' % (len(protected), needed))
+
+    # Which nodes go is up to HDInsight, no more can go than the capacity that is free or being freed
+    if free is not None and shape is not None:
+        free_cores = free[0] + sum(app['vcores'] for app in draining)
+        free_memory = free[1] + sum(app['memory'] for app in draining)
+        removable = int(max(0, min(free_cores / shape.cores, free_memory / shape.memory)))
+        if nodes_count - removable > allowed:
+            allowed = nodes_count - removable
+            reasons.append('free capacity of %d node(s)' % removable)
+
+    # Only as many nodes as are idle can go without killing containers
+    if nodes is not None:
+        idle = len([node for node in nodes if node['containers'] == 0])
+        if nodes_count - idle > allowed:
+            allowed = nodes_count - idle
+            reasons.append('%d idle node(s)' % idle)
+
+    allowed = min(allowed, nodes_count)
+    return ScaleDownPlan(nodes_count, target, allowed, ', '.join(reasons) or 'capacity is idle')
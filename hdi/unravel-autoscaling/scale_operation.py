@@ -0,0 +1,127 @@
+"""
+ Background resize operations for Unravel Auto Scaling on HDInsight
+
+ A ResizeExecutor owns the resizes of one cluster. Resizes run as asyncio
+ tasks so the sampling loop keeps going while Azure works, and every resize
+ moves through: pending -> running -> succeeded | failed | timed-out
+"""
+import asyncio
+import time
+
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+TIMED_OUT = 'timed-out'
+FINISHED_STATES = (SUCCEEDED, FAILED, TIMED_OUT)
+
+
+class ScaleOperation(object):
+    def __init__(self, from_nodes, target_nodes, clock=time.monotonic):
+        self.from_nodes = from_nodes
+        self.target_nodes = target_nodes
+        self.state = PENDING
+        self.clock = clock
+        self.created = clock()
+        self.started = None
+        self.finished = None
+
+    @property
+    def direction(self):
+        return 1 if self.target_nodes > self.from_nodes else -1
+
+    @property
+    def done(self):
+        return self.state in FINISHED_STATES
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or self.clock()) - self.started
+
+    def transition(self, state):
+        if self.done:
+            raise ValueError('Resize already finished as %s' % self.state)
+        if state == RUNNING:
+            self.started = self.clock()
+        elif state in FINISHED_STATES:
+            self.finished = self.clock()
+        self.state = state
+
+    def __repr__(self):
+        return 'ScaleOperation(%s -> %s, %s, %.0fs)' % (self.from_nodes, self.target_nodes, self.state, self.elapsed())
+
+
+class ResizeExecutor(object):
+    """
+    Runs at most one resize of a cluster at a time.
+    resize is a coroutine function (cluster, target_nodes) -> bool
+    on_started is called with every operation once it is running
+    on_finished is called with every operation that finished, whatever its state
+    """
+    def __init__(self, cluster, resize, timeout=1800, cooldown=300, logger=None, clock=time.monotonic, on_started=None, on_finished=None):
+        self.cluster = cluster
+        self.resize = resize
+        self.timeout = timeout
+        self.cooldown = cooldown
+        self.logger = logger
+        self.clock = clock
+        self.on_started = on_started
+        self.on_finished = on_finished
+        self.hold_until = None
+        self.current = None
+        self.last = None
+        self.task = None
+
+    @property
+    def busy(self):
+        return self.current is not None and not self.current.done
+
+    def in_cooldown(self):
+        if self.hold_until is not None and self.clock() < self.hold_until:
+            return True
+        return (self.last is not None and self.last.finished is not None
+                and self.clock() - self.last.finished < self.cooldown)
+
+    def hold(self, seconds):
+        """Refuse new resizes for seconds, e.g. while a resize started before a restart may still run"""
+        self.hold_until = self.clock() + seconds
+
+    def submit(self, from_nodes, target_nodes):
+        """
+        Start a resize in the background. Returns the operation that will carry
+        target_nodes, or None when the request is refused: a resize is already
+        running or the cluster is cooling down from the previous one.
+        """
+        if self.busy:
+            self._log('info', 'Resize to %s refused, %r in flight' % (target_nodes, self.current))
+            return None
+        if self.in_cooldown():
+            self._log('info', 'Resize to %s refused, cooling down' % target_nodes)
+            return None
+        self.current = ScaleOperation(from_nodes, target_nodes, self.clock)
+        self.task = asyncio.ensure_future(self._run(self.current))
+        return self.current
+
+    async def _run(self, operation):
+        operation.transition(RUNNING)
+        self._log('info', 'Resize started %r' % operation)
+        if self.on_started is not None:
+            self.on_started(operation)
+        try:
+            succeeded = await asyncio.wait_for(self.resize(self.cluster, operation.target_nodes), self.timeout)
+            operation.transition(SUCCEEDED if succeeded else FAILED)
+        except asyncio.TimeoutError:
+            operation.transition(TIMED_OUT)
+        except Exception as e:
+            self._log('error', 'Resize raised %s' % e)
+            operation.transition(FAILED)
+        self.last = operation
+        if self.on_finished is not None:
+            self.on_finished(operation)
+        self._log('info' if operation.state == SUCCEEDED else 'error', 'Resize finished %r' % operation)
+        return operation
+
+    def _log(self, level, message):
+        if self.logger is not None:
+            getattr(self.logger, level)(message)
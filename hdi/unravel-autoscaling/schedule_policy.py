@@ -0,0 +1,120 @@
+"""
+ Scheduled scaling policy for Unravel Auto Scaling on HDInsight
+
+ Calendar windows with a minimum workernode count, e.g. the nightly ETL or
+ month-end batches. A window starts on a cron expression (UTC) and lasts
+ duration seconds; the cluster is scaled up lead_time seconds before it
+ starts so the nodes are running when the batch lands. The reactive
+ policies still scale above the minimum.
+
+ {"name": "nightly-etl", "cron": "0 1 * * *", "duration": 7200, "min_nodes": 12}
+ {"name": "month-end", "cron": "0 18 L * *", "duration": 21600, "min_nodes": 20}
+"""
+import calendar
+import time
+
+# (first, last) value of each cron field: minute, hour, day of month, month, day of week (Sunday is 0 or 7)
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+LAST_DAY = 'L'
+
+
+def parse_field(expression, first, last):
+    """Set of the values a cron field matches: *, */n, a, a-b, a-b/n and lists of them"""
+    values = set()
+    for part in expression.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+        if part == '*':
+            start, end = first, last
+        elif '-' in part:
+            start, end = [int(value) for value in part.split('-')]
+        else:
+            start = end = int(part)
+            if step != 1:
+                end = last
+        if start < first or end > last or start > end:
+            raise ValueError('Cron field %s is out of %d-%d' % (expression, first, last))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronExpression(object):
+    """minute hour day-of-month month day-of-week, day-of-month may be L for the last day"""
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('Cron expression %r needs 5 fields' % expression)
+        self.expression = expression
+        self.last_day = fields[2] == LAST_DAY
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            set() if field == LAST_DAY else parse_field(field, first, last) for field, (first, last) in zip(fields, CRON_FIELDS)]
+        self.weekdays = set(weekday % 7 for weekday in self.weekdays)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+        self.times = sorted(hour * 3600 + minute * 60 for hour in self.hours for minute in self.minutes)
+
+    def matches_day(self, day):
+        """day: time.struct_time of a UTC day"""
+        if day.tm_mon not in self.months:
+            return False
+        if self.last_day:
+            in_month = day.tm_mday == calendar.monthrange(day.tm_year, day.tm_mon)[1]
+        else:
+            in_month = day.tm_mday in self.days
+        weekday = (day.tm_wday + 1) % 7
+        # As in cron, a restricted day of month and day of week match either one
+        if self.any_weekday:
+            return in_month
+        if self.any_day:
+            return weekday in self.weekdays
+        return in_month or weekday in self.weekdays
+
+    def last_start(self, now, since):
+        """Latest time in (since, now] the expression matches (epoch seconds, UTC), None if there is none"""
+        day_start = int(now) - int(now) % 86400
+        while day_start + 86400 > since:
+            if self.matches_day(time.gmtime(day_start)):
+                for offset in reversed(self.times):
+                    start = day_start + offset
+                    if since < start <= now:
+                        return start
+                    if start <= since:
+                        break
+            day_start -= 86400
+        return None
+
+
+class ScheduleWindow(object):
+    def __init__(self, cron, duration, min_nodes, name=None):
+        self.cron = CronExpression(cron)
+        self.duration = duration
+        self.min_nodes = min_nodes
+        self.name = name or cron
+
+    @classmethod
+    def from_dict(cls, window):
+        return cls(window['cron'], window['duration'], window['min_nodes'], window.get('name'))
+
+    def __repr__(self):
+        return 'ScheduleWindow(%s: %s for %ss, %d nodes)' % (self.name, self.cron.expression, self.duration, self.min_nodes)
+
+
+class SchedulePolicy(object):
+    def __init__(self, windows, lead_time=600):
+        self.windows = [window if isinstance(window, ScheduleWindow) else ScheduleWindow.from_dict(window) for window in windows]
+        self.lead_time = lead_time
+
+    def active(self, now=None):
+        """Windows running at now, or starting within lead_time"""
+        now = time.time() if now is None else now
+        return [window for window in self.windows
+                if window.cron.last_start(now + self.lead_time, now - window.duration) is not None]
+
+    def min_nodes(self, now=None):
+        """Workernodes the active windows need, None outside every window"""
+        active = self.active(now)
+        if not active:
+            return None
+        return max(window.min_nodes for window in active)
@@ -0,0 +1,262 @@
+"""
+ Offline policy replay for Unravel Auto Scaling on HDInsight
+
+ Feeds a YARN demand trace (one point per 30s bucket) through the same
+ decision code as the live autoscaler, with a simple cluster model and a
+ configurable resize latency, and reports what the policy would have cost.
+
+ python simulator.py --trace diurnal
+ python simulator.py --trace recorded.json --cpu-threshold 70 --resize-latency 1200
+ python simulator.py --benchmark --output bench-0.3.0.json --compare bench-0.2.json
+"""
+import argparse
+import json
+import math
+import random
+import time
+
+import unravel_HDInsight_autoscaling as autoscaling
+from metric_ingest import MetricBuffer
+from target_sizing import WorkerShape
+
+STEP_SECONDS = 30
+STEPS_PER_HOUR = 3600 // STEP_SECONDS
+MB_PER_VCORE = 3072
+
+
+#############################################################
+#   Canonical traces, lists of {'cores': , 'memory': }      #
+#   YARN demand (allocated + pending) per 30s bucket        #
+#############################################################
+def demand(cores):
+    return {'cores': cores, 'memory': cores * MB_PER_VCORE}
+
+
+def diurnal_trace(days=3):
+    """Business hours load plus a two hour ETL batch at 01:00"""
+    trace = []
+    for i in range(days * 24 * STEPS_PER_HOUR):
+        hour = (i % (24 * STEPS_PER_HOUR)) / float(STEPS_PER_HOUR)
+        cores = 16 + 80 * max(0.0, math.sin(math.pi * (hour - 8) / 12))
+        if 1 <= hour < 3:
+            cores += 160
+        trace.append(demand(cores))
+    return trace
+
+
+def spiky_trace(hours=24, seed=7):
+    """Steady base load with random 5 to 30 minute bursts"""
+    rand = random.Random(seed)
+    trace = []
+    spike_left, spike_cores = 0, 0
+    for i in range(hours * STEPS_PER_HOUR):
+        if spike_left == 0 and rand.random() < 0.01:
+            spike_left = rand.randint(10, 60)
+            spike_cores = rand.uniform(100, 250)
+        cores = 24 + rand.uniform(-4, 4)
+        if spike_left:
+            cores += spike_cores
+            spike_left -= 1
+        trace.append(demand(cores))
+    return trace
+
+
+def step_trace():
+    """Idle, sudden heavy load, medium load, idle again, six hours each"""
+    trace = []
+    for cores in (16, 200, 60, 16):
+        trace.extend(demand(cores) for i in range(6 * STEPS_PER_HOUR))
+    return trace
+
+
+CANONICAL_TRACES = {'diurnal': diurnal_trace, 'spiky': spiky_trace, 'step': step_trace}
+
+
+def load_trace(path):
+    """
+    JSON list of {'cores', 'memory'} demand points, or of recorded samples
+    (MetricBuffer contents) where demand is allocated plus pending if present
+    """
+    with open(path) as f:
+        return to_trace(json.load(f))
+
+
+def to_trace(points):
+    trace = []
+    for point in points:
+        if 'cores' in point:
+            trace.append({'cores': point['cores'], 'memory': point['memory']})
+        else:
+            trace.append({'cores': point['cores_allocated'] + (point.get('pending_cores') or 0),
+                          'memory': point['memory_allocated'] + (point.get('pending_memory') or 0)})
+    return trace
+
+
+def get_trace(name):
+    if name in CANONICAL_TRACES:
+        return CANONICAL_TRACES[name]()
+    return load_trace(name)
+
+
+#############################################################
+#   Simulation                                              #
+#############################################################
+def simulate(trace, cluster, initial_nodes=None, resize_latency=900, resize_cooldown=300, sample_interval=120):
+    """
+    Replay trace against cluster settings (see autoscaling.CLUSTER_SETTINGS),
+    cluster['worker_shape'] is required. Returns a dict of outcome metrics.
+    """
+    shape = WorkerShape(*cluster['worker_shape'])
+    nodes = target_count = initial_nodes or cluster['min_nodes']
+    resize = None                     # (finish time, target nodes) of the resize in flight
+    cooldown_until = 0
+    decide_every = max(1, sample_interval // STEP_SECONDS)
+    buffer = MetricBuffer(autoscaling.metric_history_size)
+    state = {'threshold_count': 0, 'forecast': autoscaling.new_forecast(cluster), 'schedule': autoscaling.new_schedule(cluster)}
+
+    node_seconds = above_seconds = queued_seconds = queued_core_seconds = 0
+    resizes = decisions = 0
+    started = time.time()
+    for i, point in enumerate(trace):
+        now = i * STEP_SECONDS
+        if resize is not None and now >= resize[0]:
+            nodes = resize[1]
+            resize = None
+            cooldown_until = now + resize_cooldown
+
+        total_cores = nodes * shape.cores
+        total_memory = nodes * shape.memory
+        # Containers need both vcores and memory, the scarcer one limits allocation
+        fraction = min(1.0, total_cores / point['cores'] if point['cores'] else 1.0,
+                       total_memory / point['memory'] if point['memory'] else 1.0)
+        sample = {'timestamp': now * 1000,
+                  'total_cores': total_cores,
+                  'total_memory': total_memory,
+                  'cores_allocated': point['cores'] * fraction,
+                  'memory_allocated': point['memory'] * fraction,
+                  'pending_cores': point['cores'] * (1 - fraction),
+                  'pending_memory': point['memory'] * (1 - fraction)}
+        sample['cpu_usage'] = sample['cores_allocated'] / total_cores * 100
+        sample['memory_usage'] = sample['memory_allocated'] / total_memory * 100
+        buffer.add(sample)
+
+        node_seconds += nodes * STEP_SECONDS
+        if sample['cpu_usage'] > cluster['cpu_threshold'] or sample['memory_usage'] > cluster['memory_threshold']:
+            above_seconds += STEP_SECONDS
+        if sample['pending_cores'] > 0:
+            queued_seconds += STEP_SECONDS
+            queued_core_seconds += sample['pending_cores'] * STEP_SECONDS
+
+        if i % decide_every == 0:
+            decisions += 1
+            # HDInsight reports the target instance count as soon as a resize starts
+            resources_usage = dict(sample, nodes_count=target_count)
+            decision, target = autoscaling.decide(cluster, state, resources_usage, buffer, now=now)
+            resize_accepted = False
+            if target is not None and resize is None and now >= cooldown_until:
+                resize = (now + resize_latency, target)
+                target_count = target
+                resizes += 1
+                resize_accepted = True
+            autoscaling.update_threshold_count(state, decision, resize_accepted)
+
+    wall_seconds = max(time.time() - started, 1e-9)
+    return {'simulated_hours': len(trace) * STEP_SECONDS / 3600.0,
+            'node_hours': node_seconds / 3600.0,
+            'minutes_above_threshold': above_seconds / 60.0,
+            'resizes': resizes,
+            'queued_minutes': queued_seconds / 60.0,
+            'queued_vcore_hours': queued_core_seconds / 3600.0,
+            'decisions': decisions,
+            'wall_seconds': wall_seconds,
+            'steps_per_second': len(trace) / wall_seconds,
+            'speedup': len(trace) * STEP_SECONDS / wall_seconds}
+
+
+#############################################################
+#   Benchmark                                               #
+#############################################################
+BENCHMARK_POLICIES = {'threshold-single': {'scaling_step': 'single'},
+                      'threshold-demand': {'scaling_step': 'demand'},
+                      'predictive-demand': {'scaling_step': 'demand', 'scaling_policy': 'predictive'}}
+REPORT_COLUMNS = ('node_hours', 'minutes_above_threshold', 'resizes', 'queued_minutes', 'queued_vcore_hours', 'speedup')
+
+
+def run_benchmark(cluster, traces, **options):
+    results = []
+    for trace_name in traces:
+        trace = get_trace(trace_name)
+        for policy_name in sorted(BENCHMARK_POLICIES):
+            policy = dict(cluster, **BENCHMARK_POLICIES[policy_name])
+            result = simulate(trace, policy, **options)
+            result.update({'trace': trace_name, 'policy': policy_name})
+            results.append(result)
+    return results
+
+
+def print_report(results, previous=None):
+    previous = dict(((r['trace'], r['policy']), r) for r in previous or [])
+    print('%-10s %-18s ' % ('trace', 'policy') + ' '.join('%22s' % column for column in REPORT_COLUMNS))
+    for result in results:
+        cells = []
+        for column in REPORT_COLUMNS:
+            cell = '%.1f' % result[column]
+            before = previous.get((result['trace'], result['policy']))
+            if before is not None and before.get(column):
+                cell += ' (%+.0f%%)' % ((result[column] - before[column]) / before[column] * 100)
+            cells.append('%22s' % cell)
+        print('%-10s %-18s ' % (result['trace'], result['policy']) + ' '.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trace', action='append', help='Canonical trace (%s) or JSON trace file, repeatable' % ', '.join(sorted(CANONICAL_TRACES)))
+    parser.add_argument('--benchmark', action='store_true', help='Run every trace against every benchmark policy')
+    parser.add_argument('--output', help='Write the results as JSON, to compare later runs against')
+    parser.add_argument('--compare', help='JSON results of a previous --output run')
+    parser.add_argument('--min-nodes', type=int, default=2)
+    parser.add_argument('--max-nodes', type=int, default=40)
+    parser.add_argument('--initial-nodes', type=int)
+    parser.add_argument('--cpu-threshold', type=float, default=autoscaling.cpu_threshold)
+    parser.add_argument('--memory-threshold', type=float, default=autoscaling.memory_threshold)
+    parser.add_argument('--worker-shape', type=float, nargs=2, default=[8, 28672], metavar=('VCORES', 'MB'))
+    parser.add_argument('--scaling-policy', default=autoscaling.scaling_policy)
+    parser.add_argument('--scaling-step', default=autoscaling.scaling_step)
+    parser.add_argument('--resize-latency', type=int, default=900, help='Seconds until a resize takes effect')
+    parser.add_argument('--resize-cooldown', type=int, default=autoscaling.resize_cooldown)
+    parser.add_argument('--sample-interval', type=int, default=autoscaling.sample_interval)
+    parser.add_argument('--schedule', help='JSON file with the list of schedule windows, traces start on 1970-01-01 00:00 UTC')
+    argv = parser.parse_args()
+
+    cluster = autoscaling.default_cluster()
+    if argv.schedule:
+        with open(argv.schedule) as f:
+            cluster['schedule'] = json.load(f)
+    cluster.update({'cluster_name': 'simulated', 'min_nodes': argv.min_nodes, 'max_nodes': argv.max_nodes,
+                    'cpu_threshold': argv.cpu_threshold, 'memory_threshold': argv.memory_threshold,
+                    'worker_shape': argv.worker_shape, 'scaling_policy': argv.scaling_policy, 'scaling_step': argv.scaling_step})
+    options = {'initial_nodes': argv.initial_nodes, 'resize_latency': argv.resize_latency,
+               'resize_cooldown': argv.resize_cooldown, 'sample_interval': argv.sample_interval}
+    traces = argv.trace or sorted(CANONICAL_TRACES)
+
+    if argv.benchmark:
+        results = run_benchmark(cluster, traces, **options)
+    else:
+        results = []
+        for trace_name in traces:
+            result = simulate(get_trace(trace_name), cluster, **options)
+            result.update({'trace': trace_name, 'policy': '%s-%s' % (argv.scaling_policy, argv.scaling_step)})
+            results.append(result)
+
+    previous = None
+    if argv.compare:
+        with open(argv.compare) as f:
+            previous = json.load(f)['results']
+    print_report(results, previous)
+    if argv.output:
+        with open(argv.output, 'w') as f:
+            json.dump({'version': autoscaling.__doc__.split()[-1], 'created': time.time(), 'results': results}, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
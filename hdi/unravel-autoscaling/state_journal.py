@@ -0,0 +1,148 @@
+"""
+ Warm restart journal for Unravel Auto Scaling on HDInsight
+
+ Append-only JSON lines file of the samples, threshold counts and resizes of
+ every cluster. Replayed on startup so a restarted autoscaler keeps its
+ history, and rewritten from a snapshot every compact_every records.
+
+ {"t": "sample", "c": "etl01", "v": {...sample...}}
+ {"t": "count", "c": "etl01", "v": 3}
+ {"t": "resize", "c": "etl01", "v": {"state": "pending", "from": 3, "target": 8, "at": 1539856800.0}}
+ {"t": "resize", "c": "etl01", "v": {"state": "running", "from": 3, "target": 8, "at": 1539856800.1}}
+ {"t": "resize", "c": "etl01", "v": {"state": "succeeded", "from": 3, "target": 8, "at": 1539857412.5}}
+
+ A resize is written when it is submitted, once it runs and once it finished.
+"""
+import json
+import os
+
+SAMPLE = 'sample'
+COUNT = 'count'
+RESIZE = 'resize'
+
+
+def empty_cluster_state():
+    return {'samples': [], 'threshold_count': 0, 'resize': None}
+
+
+def replay(path, history_size=None):
+    """cluster name -> {'samples': [...], 'threshold_count': , 'resize': } as of the last record"""
+    clusters = {}
+    if not os.path.exists(path):
+        return clusters
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Torn write of the last line when the process was killed
+                continue
+            cluster = clusters.setdefault(record['c'], empty_cluster_state())
+            if record['t'] == SAMPLE:
+                samples = cluster['samples']
+                if samples and samples[-1]['timestamp'] == record['v']['timestamp']:
+                    samples[-1] = record['v']
+                elif samples and samples[-1]['timestamp'] > record['v']['timestamp']:
+                    # Written again after a compaction which already had it
+                    continue
+                else:
+                    samples.append(record['v'])
+                    if history_size and len(samples) > 2 * history_size:
+                        del samples[:-history_size]
+            elif record['t'] == COUNT:
+                cluster['threshold_count'] = record['v']
+            elif record['t'] == RESIZE:
+                cluster['resize'] = record['v']
+    if history_size:
+        for cluster in clusters.values():
+            del cluster['samples'][:-history_size]
+    return clusters
+
+
+class StateJournal(object):
+    """
+    snapshot is a callable returning the current state of every cluster in the
+    format of replay(), used to compact the journal. on_compact, when given, is
+    called instead of compact() once compact_every records are written, e.g. to
+    run write_compaction() off the event loop between begin_compaction() and
+    finish_compaction(). Records appended meanwhile are carried over.
+    """
+    def __init__(self, path, snapshot=None, compact_every=10000, on_compact=None):
+        self.path = path
+        self.temp_path = path + '.compact'
+        self.snapshot = snapshot
+        self.compact_every = compact_every
+        self.on_compact = on_compact
+        self.records = 0
+        self.compacting = False
+        self.pending = None
+        self.file = open(path, 'a')
+
+    def append(self, kind, cluster_name, value):
+        line = json.dumps({'t': kind, 'c': cluster_name, 'v': value}, separators=(',', ':')) + '\n'
+        self.file.write(line)
+        self.file.flush()
+        self.records += 1
+        if self.pending is not None:
+            self.pending.append(line)
+        if self.snapshot is not None and self.records >= self.compact_every and not self.compacting:
+            if self.on_compact is not None:
+                self.compacting = True
+                self.on_compact()
+            else:
+                self.compact()
+
+    def record_sample(self, cluster_name, sample):
+        self.append(SAMPLE, cluster_name, sample)
+
+    def record_count(self, cluster_name, threshold_count):
+        self.append(COUNT, cluster_name, threshold_count)
+
+    def record_resize(self, cluster_name, resize):
+        self.append(RESIZE, cluster_name, resize)
+
+    def begin_compaction(self):
+        """Snapshot to hand to write_compaction(), records from now on are kept for finish_compaction()"""
+        self.compacting = True
+        self.pending = []
+        return self.snapshot()
+
+    def write_compaction(self, snapshot):
+        """Write snapshot to the temporary file, touches nothing else so it may run in another thread"""
+        with open(self.temp_path, 'w') as f:
+            for cluster_name, state in sorted(snapshot.items()):
+                for sample in state['samples']:
+                    f.write(json.dumps({'t': SAMPLE, 'c': cluster_name, 'v': sample}, separators=(',', ':')) + '\n')
+                f.write(json.dumps({'t': COUNT, 'c': cluster_name, 'v': state['threshold_count']}, separators=(',', ':')) + '\n')
+                if state['resize'] is not None:
+                    f.write(json.dumps({'t': RESIZE, 'c': cluster_name, 'v': state['resize']}, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def finish_compaction(self):
+        """Add the records appended since begin_compaction() and atomically replace the journal"""
+        with open(self.temp_path, 'a') as f:
+            f.writelines(self.pending)
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        os.rename(self.temp_path, self.path)
+        self.file = open(self.path, 'a')
+        self.records = len(self.pending)
+        self.pending = None
+        self.compacting = False
+
+    def abort_compaction(self):
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        self.records = 0
+        self.pending = None
+        self.compacting = False
+
+    def compact(self):
+        """Rewrite the journal as the current snapshot, atomically replacing the old file"""
+        self.write_compaction(self.begin_compaction())
+        self.finish_compaction()
+
+    def close(self):
+        self.file.close()
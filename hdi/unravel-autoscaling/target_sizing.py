@@ -0,0 +1,70 @@
+"""
+ Demand driven target sizing for Unravel Auto Scaling on HDInsight
+
+ Computes the workernode count that fits the allocated plus pending YARN
+ demand in one step, instead of moving the cluster one node per decision.
+"""
+import math
+
+
+class WorkerShape(object):
+    """YARN capacity of one workernode"""
+    def __init__(self, cores, memory):
+        self.cores = float(cores)
+        self.memory = float(memory)
+
+    @classmethod
+    def from_usage(cls, resources_usage):
+        """Derive the shape from the cluster totals, every workernode is the same VM size"""
+        nodes_count = resources_usage['nodes_count']
+        if not nodes_count or not resources_usage.get('total_cores') or not resources_usage.get('total_memory'):
+            return None
+        return cls(resources_usage['total_cores'] / nodes_count, resources_usage['total_memory'] / nodes_count)
+
+    def __repr__(self):
+        return 'WorkerShape(%g vcores, %g MB)' % (self.cores, self.memory)
+
+
+def nodes_for_demand(demand_cores, demand_memory, shape, utilization=100, container=None):
+    """
+    Workernodes needed so demand fits with every node filled up to utilization %.
+    container: (vcores, MB) of one YARN container. When given, the demand is
+    packed as whole containers so capacity a container can't use is not counted.
+    """
+    usable_cores = shape.cores * utilization / 100.0
+    usable_memory = shape.memory * utilization / 100.0
+    if container:
+        container_cores, container_memory = container
+        containers = max(math.ceil(demand_cores / float(container_cores)), math.ceil(demand_memory / float(container_memory)))
+        per_node = min(int(usable_cores // container_cores), int(usable_memory // container_memory))
+        if per_node < 1:
+            raise ValueError('Container %s does not fit on %r at %s%% utilization' % (container, shape, utilization))
+        return int(math.ceil(containers / float(per_node)))
+    return int(max(math.ceil(demand_cores / usable_cores), math.ceil(demand_memory / usable_memory)))
+
+
+def target_nodes(resources_usage, decision, cluster, shape=None, container=None):
+    """
+    Worker count to resize to for an 'Up Scaling' / 'Down Scaling' decision.
+    Sized so allocated + pending demand runs below the cluster thresholds, at
+    least one node more for a scale up, never more nodes for a scale down, and
+    within min/max_nodes. A scale down is sized below the thresholds less
+    threshold_tolerance, so the smaller cluster is not over them at once.
+    """
+    nodes_count = resources_usage['nodes_count']
+    step = 1 if decision == 'Up Scaling' else -1
+    shape = shape or WorkerShape.from_usage(resources_usage)
+    if shape is None or resources_usage.get('cores_allocated') is None:
+        target = nodes_count + step
+    else:
+        demand_cores = resources_usage['cores_allocated'] + (resources_usage.get('pending_cores') or 0)
+        demand_memory = resources_usage['memory_allocated'] + (resources_usage.get('pending_memory') or 0)
+        utilization = min(cluster['cpu_threshold'], cluster['memory_threshold'])
+        if step < 0:
+            utilization *= 1 - cluster['threshold_tolerance']
+        target = nodes_for_demand(demand_cores, demand_memory, shape, utilization, container)
+        if step > 0:
+            target = max(target, nodes_count + 1)
+        else:
+            target = min(target, nodes_count)
+    return max(cluster['min_nodes'], min(cluster['max_nodes'], target))
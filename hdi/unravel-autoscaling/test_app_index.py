@@ -0,0 +1,99 @@
+"""
+ Tests of the running / pending application index for Unravel Auto Scaling on HDInsight
+
+ python -m unittest test_app_index
+"""
+import json
+import unittest
+
+from app_index import PENDING, RUNNING, AppIndex, search_apps
+
+
+def app(app_id, state=RUNNING, duration=0, cluster='etl01', kind='spark', queue='default', **fields):
+    result = {'id': app_id, 'kind': kind, 'status': state, 'duration_long': duration, 'queue': queue,
+              'allocatedMB': 3072, 'allocatedVCores': 1, 'clusterId': cluster}
+    result.update(fields)
+    return result
+
+
+class Response(object):
+    def __init__(self, body):
+        self.text = json.dumps(body)
+
+    def raise_for_status(self):
+        pass
+
+
+class PagedSearch(object):
+    """Answers the apps search from results, a page at a time, and records every search input"""
+    def __init__(self, results, total=True):
+        self.results = results
+        self.total = total
+        self.inputs = []
+
+    def post(self, url, json=None, timeout=None):
+        self.inputs.append(json)
+        page = self.results[json['from']:json['from'] + json['size']]
+        body = {'results': page}
+        if self.total:
+            body['metadata'] = {'totalRecords': len(self.results)}
+        return Response(body)
+
+
+class AppIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.index = AppIndex('etl01', clock=lambda: self.now)
+
+    def test_refresh_diff(self):
+        self.assertEqual({'added': 2, 'updated': 0, 'finished': 0}, self.index.refresh([app('a1'), app('a2', PENDING)]))
+        self.now += 30
+        diff = self.index.refresh([app('a1', duration=30000), app('a2', PENDING), app('a3', PENDING)])
+        self.assertEqual({'added': 1, 'updated': 1, 'finished': 0}, diff)
+        self.now += 30
+        self.assertEqual({'added': 0, 'updated': 1, 'finished': 2}, self.index.refresh([app('a2', RUNNING)]))
+        self.assertEqual(['a2'], [record['id'] for record in self.index.running()])
+
+    def test_records_keep_when_they_were_first_seen(self):
+        self.index.refresh([app('a1', PENDING)])
+        self.now += 90
+        self.index.refresh([app('a1', PENDING), app('a2', PENDING)])
+        self.assertEqual(90, self.index.oldest_pending_age())
+        self.assertEqual(1000.0, self.index.apps['a1']['first_seen'])
+
+    def test_other_clusters_are_left_out(self):
+        diff = self.index.refresh([app('a1'), app('b1', cluster='adhoc02')])
+        self.assertEqual(1, diff['added'])
+        self.assertEqual(['a1'], list(self.index.apps))
+
+    def test_finished_running_apps_give_the_typical_duration(self):
+        for i, duration in enumerate((60000, 120000, 600000)):
+            self.index.refresh([app('a%d' % i, duration=duration)])
+        self.index.refresh([])
+        self.assertEqual(120000, self.index.typical_duration('spark'))
+        self.assertEqual(600000, self.index.typical_duration('spark', elapsed=120000))
+        self.assertIsNone(self.index.typical_duration('hive'))
+
+
+class SearchAppsTest(unittest.TestCase):
+    def test_pages_through_every_result(self):
+        session = PagedSearch([app('a%d' % i) for i in range(250)])
+        results = list(search_apps(session, 'http://unravel/api/v1/apps/search', page_size=100, cluster_name='etl01'))
+        self.assertEqual(250, len(results))
+        self.assertEqual([0, 100, 200], [search_input['from'] for search_input in session.inputs])
+        self.assertEqual(['etl01'], session.inputs[0]['clusters'])
+
+    def test_full_last_page_stops_at_the_total(self):
+        session = PagedSearch([app('a%d' % i) for i in range(200)])
+        self.assertEqual(200, len(list(search_apps(session, 'http://unravel/api/v1/apps/search', page_size=100))))
+        self.assertEqual(2, len(session.inputs))
+        self.assertNotIn('clusters', session.inputs[0])
+
+    def test_without_a_total_a_short_page_is_the_last(self):
+        session = PagedSearch([app('a%d' % i) for i in range(200)], total=False)
+        self.assertEqual(200, len(list(search_apps(session, 'http://unravel/api/v1/apps/search', page_size=100))))
+        self.assertEqual(3, len(session.inputs))
+
+
+if __name__ == '__main__':
+    unittest.main()
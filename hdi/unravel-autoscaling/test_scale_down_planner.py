@@ -0,0 +1,67 @@
+"""
+ Tests of the scale down planner for Unravel Auto Scaling on HDInsight
+
+ python -m unittest test_scale_down_planner
+"""
+import unittest
+
+from scale_down_planner import estimate_remaining, plan_scale_down
+from target_sizing import WorkerShape
+
+SHAPE = WorkerShape(8, 28672)
+
+
+def running_app(app_id, elapsed, vcores=8, memory=28672, app_type='spark'):
+    return {'id': app_id, 'type': app_type, 'duration': elapsed * 1000, 'vcores': vcores, 'memory': memory}
+
+
+def node(host, containers):
+    return {'host': host, 'containers': containers, 'used_vcores': containers, 'used_memory': containers * 3072}
+
+
+class EstimateRemainingTest(unittest.TestCase):
+    def test_runs_until_the_typical_duration(self):
+        self.assertEqual(500, estimate_remaining(running_app('a1', 100), typical_duration=600000))
+
+    def test_without_history_runs_as_long_again(self):
+        self.assertEqual(100, estimate_remaining(running_app('a1', 100)))
+        self.assertEqual(700, estimate_remaining(running_app('a1', 700), typical_duration=600000))
+
+
+class PlanScaleDownTest(unittest.TestCase):
+    def test_idle_cluster_goes_to_the_target(self):
+        plan = plan_scale_down(10, 4, SHAPE, [], free=(80, 10 * 28672))
+        self.assertEqual(4, plan.target)
+        self.assertFalse(plan.delayed)
+
+    def test_long_running_apps_keep_their_nodes(self):
+        apps = [running_app('a%d' % i, 1200) for i in range(6)]
+        plan = plan_scale_down(10, 4, SHAPE, apps, drain_window=600)
+        self.assertEqual(6, plan.target)
+        self.assertIn('long running', plan.reason)
+
+    def test_apps_finishing_within_the_drain_window_do_not_hold_nodes(self):
+        apps = [running_app('a%d' % i, 100) for i in range(6)]
+        plan = plan_scale_down(10, 4, SHAPE, apps, typical_duration=lambda app_type, elapsed: 300000, drain_window=600)
+        self.assertEqual(4, plan.target)
+
+    def test_no_more_than_the_free_capacity_goes(self):
+        plan = plan_scale_down(10, 4, SHAPE, [], free=(16, 2 * 28672))
+        self.assertEqual(8, plan.target)
+        self.assertIn('free capacity of 2', plan.reason)
+
+    def test_no_more_than_the_idle_nodes_go(self):
+        nodes = [node('wn%d' % i, 0 if i < 3 else 2) for i in range(10)]
+        plan = plan_scale_down(10, 4, SHAPE, [], nodes=nodes)
+        self.assertEqual(7, plan.target)
+        self.assertIn('3 idle', plan.reason)
+
+    def test_delayed_when_nothing_can_go(self):
+        nodes = [node('wn%d' % i, 1) for i in range(10)]
+        plan = plan_scale_down(10, 4, SHAPE, [], nodes=nodes, free=(0, 0))
+        self.assertEqual(10, plan.target)
+        self.assertTrue(plan.delayed)
+
+
+if __name__ == '__main__':
+    unittest.main()
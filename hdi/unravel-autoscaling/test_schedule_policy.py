@@ -0,0 +1,72 @@
+"""
+ Tests of the scheduled scaling policy for Unravel Auto Scaling on HDInsight
+
+ python -m unittest test_schedule_policy
+"""
+import calendar
+import time
+import unittest
+
+from schedule_policy import CronExpression, SchedulePolicy, parse_field
+
+
+def utc(year, month, day, hour=0, minute=0, second=0):
+    return calendar.timegm((year, month, day, hour, minute, second))
+
+
+class CronParsingTest(unittest.TestCase):
+    def test_fields(self):
+        self.assertEqual({0, 15, 30, 45}, parse_field('*/15', 0, 59))
+        self.assertEqual({1, 2, 3, 10}, parse_field('1-3,10', 0, 59))
+        self.assertEqual({8, 10, 12}, parse_field('8-12/2', 0, 23))
+        self.assertEqual({20, 22}, parse_field('20/2', 0, 23))
+
+    def test_out_of_range_fields_are_rejected(self):
+        for expression, first, last in (('60', 0, 59), ('0', 1, 31), ('5-3', 0, 23)):
+            self.assertRaises(ValueError, parse_field, expression, first, last)
+        self.assertRaises(ValueError, CronExpression, '0 1 * *')
+
+    def test_sunday_is_0_or_7(self):
+        self.assertEqual({0}, CronExpression('0 1 * * 7').weekdays)
+
+    def test_last_start(self):
+        cron = CronExpression('30 1 * * *')
+        self.assertEqual(utc(2018, 10, 18, 1, 30), cron.last_start(utc(2018, 10, 18, 1, 30), utc(2018, 10, 17)))
+        self.assertEqual(utc(2018, 10, 17, 1, 30), cron.last_start(utc(2018, 10, 18, 1, 29), utc(2018, 10, 17)))
+        self.assertIsNone(cron.last_start(utc(2018, 10, 18, 1, 29), utc(2018, 10, 17, 1, 30)))
+
+    def test_last_day_of_the_month(self):
+        cron = CronExpression('0 18 L * *')
+        self.assertEqual(utc(2019, 2, 28, 18), cron.last_start(utc(2019, 3, 1), utc(2019, 2, 1)))
+        self.assertEqual(utc(2020, 2, 29, 18), cron.last_start(utc(2020, 3, 1), utc(2020, 2, 1)))
+
+    def test_day_of_month_or_day_of_week(self):
+        # 2018-10-15 is a Monday
+        cron = CronExpression('0 0 1 * 1')
+        self.assertTrue(cron.matches_day(time.gmtime(utc(2018, 10, 15))))
+        self.assertTrue(cron.matches_day(time.gmtime(utc(2018, 11, 1))))
+        self.assertFalse(cron.matches_day(time.gmtime(utc(2018, 10, 16))))
+
+
+class ScheduleWindowTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = SchedulePolicy([{'name': 'nightly-etl', 'cron': '0 1 * * *', 'duration': 7200, 'min_nodes': 12}], lead_time=600)
+        self.start = utc(2018, 10, 18, 1)
+
+    def test_window_boundaries(self):
+        self.assertIsNone(self.policy.min_nodes(self.start - 601))
+        # Scaled up lead_time before the window starts
+        self.assertEqual(12, self.policy.min_nodes(self.start - 600))
+        self.assertEqual(12, self.policy.min_nodes(self.start))
+        self.assertEqual(12, self.policy.min_nodes(self.start + 7199))
+        self.assertIsNone(self.policy.min_nodes(self.start + 7200))
+
+    def test_overlapping_windows_need_the_larger_minimum(self):
+        policy = SchedulePolicy([{'cron': '0 1 * * *', 'duration': 7200, 'min_nodes': 12},
+                                 {'cron': '0 2 18 10 *', 'duration': 3600, 'min_nodes': 20}], lead_time=0)
+        self.assertEqual(12, policy.min_nodes(self.start + 1800))
+        self.assertEqual(20, policy.min_nodes(self.start + 3600))
+
+
+if __name__ == '__main__':
+    unittest.main()
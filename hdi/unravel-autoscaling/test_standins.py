@@ -0,0 +1,49 @@
+"""
+ Smoke tests of the fleet loop against the local stand-ins for Unravel Auto Scaling on HDInsight
+
+ Runs load_benchmark for a few seconds against the Unravel / Elasticsearch /
+ Azure stand-in and against the YARN ResourceManager stand-in, and checks that
+ every cluster takes decisions without a failed cycle.
+
+ python -m unittest test_standins
+"""
+import unittest
+
+import load_benchmark
+
+CLUSTERS = 12
+
+
+def smoke_run(*args):
+    argv = load_benchmark.new_parser().parse_args(['--clusters', str(CLUSTERS), '--duration', '6', '--sample-interval', '1',
+                                                   '--poll-interval', '1', '--es-batch-size', '5'] + list(args))
+    return load_benchmark.run(argv)
+
+
+class StandInSmokeTest(unittest.TestCase):
+    def assert_decides(self, result):
+        self.assertEqual(0, result['cycle_errors'])
+        # The first cycle of every cluster runs once the first poll is in, at least one decision each
+        self.assertGreaterEqual(result['decisions'], CLUSTERS)
+
+    def test_unravel_standin(self):
+        result = smoke_run()
+        self.assert_decides(result)
+        self.assertGreater(result['standin_requests'].get('es_search', 0), 0)
+        self.assertEqual(1, result['logins'])
+
+    def test_unravel_standin_with_the_journal(self):
+        result = smoke_run('--journal-compact-every', '20')
+        self.assert_decides(result)
+        self.assertGreater(result['journal_bytes'], 0)
+        self.assertGreater(result['journal_compaction_seconds']['count'], 0)
+
+    def test_yarn_rm_standin(self):
+        result = smoke_run('--metrics-source', 'yarn')
+        self.assert_decides(result)
+        self.assertGreaterEqual(result['rm_polls'], CLUSTERS)
+        self.assertEqual(0, result['standin_requests'].get('es_search', 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+"""
+ Tests of the warm restart journal for Unravel Auto Scaling on HDInsight
+
+ python -m unittest test_state_journal
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import state_journal
+import unravel_HDInsight_autoscaling as autoscaling
+from state_journal import StateJournal
+
+
+def sample(timestamp, cpu=50.0):
+    return {'timestamp': timestamp, 'cpu_usage': cpu, 'memory_usage': cpu, 'nodes_count': 3}
+
+
+class StateJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'hdinsight_autoscaling.journal')
+        self.state = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def snapshot(self):
+        return dict((name, {'samples': list(state['samples']), 'threshold_count': state['threshold_count'], 'resize': state['resize']})
+                    for name, state in self.state.items())
+
+    def record(self, journal, name, timestamp, count):
+        state = self.state.setdefault(name, state_journal.empty_cluster_state())
+        state['samples'].append(sample(timestamp))
+        state['threshold_count'] = count
+        journal.record_sample(name, sample(timestamp))
+        journal.record_count(name, count)
+
+    def test_replay_keeps_the_last_record_of_every_cluster(self):
+        journal = StateJournal(self.path)
+        journal.record_sample('etl01', sample(1000))
+        journal.record_sample('etl01', sample(2000, 60.0))
+        journal.record_sample('etl01', sample(2000, 70.0))
+        journal.record_count('etl01', 2)
+        journal.record_resize('etl01', {'state': 'pending', 'from': 3, 'target': 8, 'at': 1.0})
+        journal.record_resize('etl01', {'state': 'running', 'from': 3, 'target': 8, 'at': 2.0})
+        journal.record_count('etl02', -1)
+        journal.close()
+        replayed = state_journal.replay(self.path)
+        self.assertEqual([1000, 2000], [s['timestamp'] for s in replayed['etl01']['samples']])
+        self.assertEqual(70.0, replayed['etl01']['samples'][-1]['cpu_usage'])
+        self.assertEqual(2, replayed['etl01']['threshold_count'])
+        self.assertEqual('running', replayed['etl01']['resize']['state'])
+        self.assertEqual(-1, replayed['etl02']['threshold_count'])
+
+    def test_torn_last_line_is_skipped(self):
+        journal = StateJournal(self.path)
+        journal.record_count('etl01', 3)
+        journal.close()
+        with open(self.path, 'a') as f:
+            f.write('{"t":"count","c":"etl01","v":')
+        self.assertEqual(3, state_journal.replay(self.path)['etl01']['threshold_count'])
+
+    def test_replay_keeps_history_size_samples(self):
+        journal = StateJournal(self.path)
+        for i in range(10):
+            journal.record_sample('etl01', sample(i * 1000))
+        journal.close()
+        replayed = state_journal.replay(self.path, history_size=4)
+        self.assertEqual([6000, 7000, 8000, 9000], [s['timestamp'] for s in replayed['etl01']['samples']])
+
+    def test_replay_after_compaction(self):
+        journal = StateJournal(self.path, snapshot=self.snapshot, compact_every=5)
+        for i in range(6):
+            self.record(journal, 'etl01', i * 1000, i)
+        journal.close()
+        # The last compaction rewrote the journal, fewer lines than records written
+        with open(self.path) as f:
+            self.assertLess(len(f.readlines()), 12)
+        replayed = state_journal.replay(self.path)
+        self.assertEqual([i * 1000 for i in range(6)], [s['timestamp'] for s in replayed['etl01']['samples']])
+        self.assertEqual(5, replayed['etl01']['threshold_count'])
+
+    def test_records_appended_during_a_compaction_are_carried_over(self):
+        journal = StateJournal(self.path, snapshot=self.snapshot, compact_every=1000)
+        self.record(journal, 'etl01', 1000, 1)
+        snapshot = journal.begin_compaction()
+        # Appended while write_compaction() runs, newer than the snapshot
+        self.record(journal, 'etl01', 2000, 2)
+        # Journaled again after the snapshot was taken, already in it
+        journal.record_sample('etl01', sample(1000))
+        journal.write_compaction(snapshot)
+        journal.finish_compaction()
+        self.record(journal, 'etl01', 3000, 3)
+        journal.close()
+        replayed = state_journal.replay(self.path)
+        self.assertEqual([1000, 2000, 3000], [s['timestamp'] for s in replayed['etl01']['samples']])
+        self.assertEqual(3, replayed['etl01']['threshold_count'])
+
+    def test_aborted_compaction_leaves_the_journal(self):
+        journal = StateJournal(self.path, snapshot=self.snapshot, compact_every=1000)
+        self.record(journal, 'etl01', 1000, 1)
+        journal.write_compaction(journal.begin_compaction())
+        journal.abort_compaction()
+        self.record(journal, 'etl01', 2000, 2)
+        journal.close()
+        self.assertFalse(os.path.exists(journal.temp_path))
+        self.assertEqual(2, state_journal.replay(self.path)['etl01']['threshold_count'])
+
+
+class RestoreResizeTest(unittest.TestCase):
+    def setUp(self):
+        # Other tests may have configured the autoscaler module for the stand-ins
+        self.settings = autoscaling.resize_timeout, autoscaling.resize_cooldown
+        autoscaling.resize_timeout, autoscaling.resize_cooldown = 1800, 300
+
+    def tearDown(self):
+        autoscaling.resize_timeout, autoscaling.resize_cooldown = self.settings
+
+    def restored_hold(self, resize_state, age):
+        cluster = autoscaling.default_cluster()
+        state = autoscaling.new_cluster_state(cluster)
+        restored = state_journal.empty_cluster_state()
+        restored['resize'] = {'state': resize_state, 'from': 3, 'target': 8, 'at': time.time() - age}
+        autoscaling.restore_cluster_state(cluster, state, restored)
+        resizer = state['resizer']
+        return None if resizer.hold_until is None else resizer.hold_until - resizer.clock()
+
+    def test_submitted_or_running_resize_holds_for_the_resize_timeout(self):
+        for resize_state in ('pending', 'running'):
+            hold = self.restored_hold(resize_state, 60)
+            self.assertAlmostEqual(autoscaling.resize_timeout - 60, hold, delta=5)
+
+    def test_finished_resize_holds_for_the_cooldown(self):
+        hold = self.restored_hold('succeeded', 60)
+        self.assertAlmostEqual(autoscaling.resize_cooldown - 60, hold, delta=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
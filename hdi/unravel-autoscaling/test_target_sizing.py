@@ -0,0 +1,55 @@
+"""
+ Tests of the demand driven target sizing for Unravel Auto Scaling on HDInsight
+
+ python -m unittest test_target_sizing
+"""
+import random
+import unittest
+
+import unravel_HDInsight_autoscaling as autoscaling
+from target_sizing import WorkerShape, target_nodes
+
+
+def usage_on(nodes, shape, cores, memory):
+    return {'nodes_count': nodes, 'cores_allocated': cores, 'memory_allocated': memory,
+            'total_cores': nodes * shape.cores, 'total_memory': nodes * shape.memory,
+            'cpu_usage': cores / (nodes * shape.cores) * 100, 'memory_usage': memory / (nodes * shape.memory) * 100}
+
+
+class ScaleDownTargetTest(unittest.TestCase):
+    def setUp(self):
+        self.cluster = autoscaling.default_cluster()
+        self.cluster.update({'min_nodes': 1, 'max_nodes': 200, 'cpu_threshold': 80, 'memory_threshold': 80,
+                             'threshold_count_limit': 3, 'threshold_tolerance': 0.2})
+        self.shape = WorkerShape(8, 28672)
+
+    def test_scale_down_target_is_not_over_the_thresholds(self):
+        rand = random.Random(7)
+        for container in (None, (1, 3072), (4, 12288)):
+            for _ in range(2000):
+                nodes = rand.randint(2, 100)
+                cores = rand.uniform(0, nodes * self.shape.cores)
+                memory = cores * rand.uniform(1024, 3584)
+                usage = usage_on(nodes, self.shape, cores, memory)
+                if autoscaling.check_threshold(-self.cluster['threshold_count_limit'], usage, self.cluster) != 'Down Scaling':
+                    continue
+                target = target_nodes(usage, 'Down Scaling', self.cluster, self.shape, container)
+                self.assertLessEqual(target, nodes)
+                after = usage_on(target, self.shape, cores, memory)
+                self.assertNotIn(autoscaling.check_threshold(0, after, self.cluster), ('Up Scale threshold reach', 'Up Scaling'),
+                                 'down from %d to %d nodes with %.1f vcores %.0f MB' % (nodes, target, cores, memory))
+
+    def test_scale_down_leaves_room_below_the_thresholds(self):
+        usage = usage_on(10, self.shape, 24, 24 * 3072)
+        target = target_nodes(usage, 'Down Scaling', self.cluster, self.shape)
+        self.assertEqual(5, target)
+        after = usage_on(target, self.shape, 24, 24 * 3072)
+        self.assertLessEqual(after['cpu_usage'], self.cluster['cpu_threshold'] * (1 - self.cluster['threshold_tolerance']))
+
+    def test_scale_up_still_fills_to_the_thresholds(self):
+        usage = usage_on(4, self.shape, 31, 31 * 3072)
+        self.assertEqual(5, target_nodes(usage, 'Up Scaling', self.cluster, self.shape))
+
+
+if __name__ == '__main__':
+    unittest.main()
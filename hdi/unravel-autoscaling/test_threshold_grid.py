@@ -0,0 +1,44 @@
+"""
+ Tests of the threshold grid search for Unravel Auto Scaling on HDInsight
+
+ The vectorised grid has to replay a trace exactly as simulator.simulate()
+ steps the autoscaler's own decide() through it.
+
+ python -m unittest test_threshold_grid
+"""
+import unittest
+
+import unravel_HDInsight_autoscaling as autoscaling
+from simulator import get_trace, simulate
+from threshold_grid import GRID_PARAMETERS, build_grid, evaluate_grid
+
+GRID = {'cpu_threshold': [60, 80], 'memory_threshold': [80], 'threshold_count_limit': [1, 3], 'threshold_tolerance': [0.2]}
+# Grid result column -> simulate() result key
+MATCHING = {'node_hours': 'node_hours', 'resizes': 'resizes', 'saturated_minutes': 'queued_minutes', 'queued_vcore_hours': 'queued_vcore_hours'}
+
+
+class GridMatchesSimulatorTest(unittest.TestCase):
+    def assert_matches(self, trace_name, scaling_step):
+        trace = get_trace(trace_name)
+        cluster = autoscaling.default_cluster()
+        cluster.update({'min_nodes': 2, 'max_nodes': 40, 'worker_shape': [8, 28672], 'scaling_step': scaling_step})
+        grid = build_grid(GRID)
+        results = evaluate_grid(trace, grid, cluster)
+        for i in range(len(grid['cpu_threshold'])):
+            setting = dict((name, float(grid[name][i])) for name in GRID_PARAMETERS)
+            simulated = simulate(trace, dict(cluster, **setting))
+            for column, key in MATCHING.items():
+                self.assertAlmostEqual(simulated[key], float(results[column][i]), places=6,
+                                       msg='%s of %s %s with %r' % (column, trace_name, scaling_step, setting))
+
+    def test_step_trace(self):
+        for scaling_step in ('single', 'demand'):
+            self.assert_matches('step', scaling_step)
+
+    def test_spiky_trace(self):
+        for scaling_step in ('single', 'demand'):
+            self.assert_matches('spiky', scaling_step)
+
+
+if __name__ == '__main__':
+    unittest.main()
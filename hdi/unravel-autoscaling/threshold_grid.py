@@ -0,0 +1,235 @@
+"""
+ Threshold grid search for Unravel Auto Scaling on HDInsight
+
+ Replays one demand trace against thousands of threshold policy settings at
+ once. Each setting is one element of NumPy arrays and the check_threshold() /
+ update_threshold_count() state machine steps all of them together, with the
+ cluster model of simulator.py, so a month of 30s samples takes seconds.
+ Ranks the settings by node hours against minutes of saturation (demand YARN
+ could not allocate).
+
+ python threshold_grid.py --trace diurnal
+ python threshold_grid.py --journal hdinsight_autoscaling.journal --cluster etl01 --cpu-threshold 60 70 80 90
+"""
+import argparse
+import json
+import time
+try:
+    import numpy
+except Exception as e:
+    numpy = None
+    print(e)
+    print('numpy module is missing, the threshold grid needs it')
+
+import state_journal
+import unravel_HDInsight_autoscaling as autoscaling
+from simulator import STEP_SECONDS, get_trace, to_trace
+from target_sizing import WorkerShape
+
+GRID_PARAMETERS = ('cpu_threshold', 'memory_threshold', 'threshold_count_limit', 'threshold_tolerance')
+RESULT_COLUMNS = ('node_hours', 'saturated_minutes', 'queued_vcore_hours', 'resizes')
+
+def build_grid(values):
+    """parameter -> list of values, returns parameter -> array over every combination"""
+    axes = numpy.meshgrid(*[numpy.asarray(values[name], dtype=float) for name in GRID_PARAMETERS], indexing='ij')
+    return dict((name, axis.ravel()) for name, axis in zip(GRID_PARAMETERS, axes))
+
+
+def usage_tables(trace, shape, max_nodes):
+    """
+    Usage of every trace point on 0..max_nodes workernodes, rows are points:
+    cpu and memory usage %, and prefix sums over the points of the pending
+    vcores and of the points with pending work, to sum any range in one step
+    """
+    cores = numpy.array([point['cores'] for point in trace], dtype=float)[:, None]
+    memory = numpy.array([point['memory'] for point in trace], dtype=float)[:, None]
+    total_cores = numpy.arange(max_nodes + 1, dtype=float)[None, :] * shape.cores
+    total_memory = numpy.arange(max_nodes + 1, dtype=float)[None, :] * shape.memory
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        # Containers need both vcores and memory, the scarcer one limits allocation
+        fraction = numpy.minimum(1.0, numpy.minimum(numpy.where(cores > 0, total_cores / cores, 1.0),
+                                                    numpy.where(memory > 0, total_memory / memory, 1.0)))
+        cpu_usage = cores * fraction / total_cores * 100
+        memory_usage = memory * fraction / total_memory * 100
+    pending_cores = cores * (1 - fraction)
+    zeros = numpy.zeros((1, max_nodes + 1))
+    pending_sum = numpy.concatenate((zeros, numpy.cumsum(pending_cores, axis=0)))
+    saturated_sum = numpy.concatenate((zeros, numpy.cumsum(pending_cores > 0, axis=0)))
+    return cpu_usage, memory_usage, pending_sum, saturated_sum
+
+
+def evaluate_grid(trace, grid, cluster, initial_nodes=None, resize_latency=900, resize_cooldown=300, sample_interval=120):
+    """
+    Replay trace against every setting of grid, the other settings come from
+    cluster (worker_shape required, scaling_step 'single' or 'demand').
+    Returns result column -> array, one element per grid setting.
+
+    The node count only changes when a resize finishes, so usage is looked up
+    per node count and the totals are summed per run of steps at one node
+    count; only the decision steps are stepped through.
+    """
+    shape = WorkerShape(*cluster['worker_shape'])
+    min_nodes, max_nodes = cluster['min_nodes'], cluster['max_nodes']
+    cpu_limit = grid['cpu_threshold']
+    memory_limit = grid['memory_threshold']
+    count_limit = grid['threshold_count_limit']
+    down_cpu = cpu_limit * (1 - grid['threshold_tolerance'])
+    down_memory = memory_limit * (1 - grid['threshold_tolerance'])
+    # Demand sizing fills nodes up to the lower threshold
+    usable_cores = shape.cores * numpy.minimum(cpu_limit, memory_limit) / 100.0
+    usable_memory = shape.memory * numpy.minimum(cpu_limit, memory_limit) / 100.0
+    # Scale downs are sized below the thresholds less the tolerance, as in target_nodes()
+    down_usable_cores = usable_cores * (1 - grid['threshold_tolerance'])
+    down_usable_memory = usable_memory * (1 - grid['threshold_tolerance'])
+    size = len(cpu_limit)
+    steps = len(trace)
+    cpu_usage, memory_usage, pending_sum, saturated_sum = usage_tables(trace, shape, max(max_nodes, initial_nodes or 0))
+    latency_steps = -(-resize_latency // STEP_SECONDS)
+
+    nodes = numpy.full(size, initial_nodes or min_nodes, dtype=int)
+    target_count = nodes.copy()
+    since = numpy.zeros(size, dtype=int)          # First step at the current node count
+    resizing = numpy.zeros(size, dtype=bool)
+    resize_step = numpy.zeros(size, dtype=int)   # Step the resize in flight finishes
+    resize_target = nodes.copy()
+    cooldown_until = numpy.zeros(size)
+    threshold_count = numpy.zeros(size)
+    node_steps = numpy.zeros(size)
+    pending_steps = numpy.zeros(size)
+    saturated_steps = numpy.zeros(size)
+    resizes = numpy.zeros(size)
+    everyone = numpy.arange(size)
+
+    def close_runs(which, until):
+        node_steps[which] += nodes[which] * (until - since[which])
+        pending_steps[which] += pending_sum[until, nodes[which]] - pending_sum[since[which], nodes[which]]
+        saturated_steps[which] += saturated_sum[until, nodes[which]] - saturated_sum[since[which], nodes[which]]
+        since[which] = until
+
+    for i in range(0, steps, max(1, sample_interval // STEP_SECONDS)):
+        now = i * STEP_SECONDS
+        finished = numpy.flatnonzero(resizing & (resize_step <= i))
+        if len(finished):
+            close_runs(finished, resize_step[finished])
+            nodes[finished] = resize_target[finished]
+            cooldown_until[finished] = resize_step[finished] * STEP_SECONDS + resize_cooldown
+            resizing[finished] = False
+
+        # HDInsight reports the target instance count as soon as a resize starts
+        cpu = cpu_usage[i][nodes]
+        memory = memory_usage[i][nodes]
+        up = (cpu > cpu_limit) | (memory > memory_limit)
+        down = ~up & (cpu < down_cpu) & (memory < down_memory)
+        up_reach = up & (threshold_count < count_limit)
+        up_scaling = up & ~up_reach & (target_count < max_nodes)
+        down_reach = down & (threshold_count > -count_limit) & (target_count > min_nodes)
+        down_scaling = down & ~down_reach & (threshold_count <= -count_limit)
+        scaling = up_scaling | down_scaling
+
+        resize_accepted = scaling
+        if scaling.any():
+            if cluster['scaling_step'] == 'single':
+                target = numpy.where(up_scaling, target_count + 1, target_count - 1)
+            else:
+                point = trace[i]
+                up_target = numpy.ceil(numpy.maximum(point['cores'] / usable_cores, point['memory'] / usable_memory)).astype(int)
+                down_target = numpy.ceil(numpy.maximum(point['cores'] / down_usable_cores, point['memory'] / down_usable_memory)).astype(int)
+                target = numpy.where(up_scaling, numpy.maximum(up_target, target_count + 1), numpy.minimum(down_target, target_count))
+            target = numpy.clip(target, min_nodes, max_nodes)
+            resize_accepted = scaling & (target != target_count) & ~resizing & (now >= cooldown_until)
+            resizing |= resize_accepted
+            resize_step[resize_accepted] = i + latency_steps
+            resize_target[resize_accepted] = target[resize_accepted]
+            target_count[resize_accepted] = target[resize_accepted]
+            resizes += resize_accepted
+
+        # A refused resize keeps the count, as in update_threshold_count()
+        no_action = ~(up_reach | scaling | down_reach)
+        threshold_count += up_reach
+        threshold_count -= down_reach
+        threshold_count[no_action | resize_accepted] = 0
+
+    # Resizes finishing after the last decision still count, up to the end of the trace
+    finished = numpy.flatnonzero(resizing & (resize_step < steps))
+    close_runs(finished, resize_step[finished])
+    nodes[finished] = resize_target[finished]
+    close_runs(everyone, numpy.full(size, steps))
+
+    results = dict(grid)
+    results.update({'node_hours': node_steps * STEP_SECONDS / 3600.0,
+                    'saturated_minutes': saturated_steps * STEP_SECONDS / 60.0,
+                    'queued_vcore_hours': pending_steps * STEP_SECONDS / 3600.0,
+                    'resizes': resizes})
+    return results
+
+
+def rank(results, saturation_weight=1.0):
+    """
+    Order of the settings by node hours + saturation_weight * saturated minutes,
+    and which settings are on the Pareto front of node hours against saturation
+    """
+    score = results['node_hours'] + saturation_weight * results['saturated_minutes']
+    order = numpy.lexsort((results['node_hours'], score))
+    # Pareto optimal: fewer node hours than every setting saturated for less or as long
+    by_saturation = numpy.lexsort((results['node_hours'], results['saturated_minutes']))
+    hours = results['node_hours'][by_saturation]
+    best_before = numpy.concatenate(([numpy.inf], numpy.minimum.accumulate(hours)[:-1]))
+    pareto = numpy.zeros(len(score), dtype=bool)
+    pareto[by_saturation] = hours < best_before
+    return order, pareto
+
+
+def print_table(results, order, pareto, top=20):
+    columns = GRID_PARAMETERS + RESULT_COLUMNS
+    print('%4s ' % 'rank' + ' '.join('%23s' % column for column in columns) + ' pareto')
+    for position, i in enumerate(order[:top]):
+        print('%4d ' % (position + 1) + ' '.join('%23.4g' % results[column][i] for column in columns) + ('      *' if pareto[i] else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trace', help='Canonical simulator trace or JSON trace file')
+    parser.add_argument('--journal', help='Replay the samples of --cluster from an autoscaler journal instead')
+    parser.add_argument('--cluster', help='Cluster name in --journal')
+    parser.add_argument('--cpu-threshold', type=float, nargs='+', default=list(range(50, 100, 5)))
+    parser.add_argument('--memory-threshold', type=float, nargs='+', default=list(range(50, 100, 5)))
+    parser.add_argument('--threshold-count-limit', type=float, nargs='+', default=list(range(1, 11)))
+    parser.add_argument('--threshold-tolerance', type=float, nargs='+', default=[0.05, 0.1, 0.2, 0.3, 0.4])
+    parser.add_argument('--saturation-weight', type=float, default=1.0, help='Node hours one minute of saturation is worth')
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--output', help='Write every setting and its results as JSON')
+    parser.add_argument('--min-nodes', type=int, default=2)
+    parser.add_argument('--max-nodes', type=int, default=40)
+    parser.add_argument('--initial-nodes', type=int)
+    parser.add_argument('--worker-shape', type=float, nargs=2, default=[8, 28672], metavar=('VCORES', 'MB'))
+    parser.add_argument('--scaling-step', default=autoscaling.scaling_step)
+    parser.add_argument('--resize-latency', type=int, default=900, help='Seconds until a resize takes effect')
+    parser.add_argument('--resize-cooldown', type=int, default=autoscaling.resize_cooldown)
+    parser.add_argument('--sample-interval', type=int, default=autoscaling.sample_interval)
+    argv = parser.parse_args()
+
+    if argv.journal:
+        samples = state_journal.replay(argv.journal).get(argv.cluster, {}).get('samples')
+        if not samples:
+            parser.error('No samples of cluster %s in %s' % (argv.cluster, argv.journal))
+        trace = to_trace(samples)
+    else:
+        trace = get_trace(argv.trace or 'diurnal')
+
+    cluster = autoscaling.default_cluster()
+    cluster.update({'min_nodes': argv.min_nodes, 'max_nodes': argv.max_nodes,
+                    'worker_shape': argv.worker_shape, 'scaling_step': argv.scaling_step})
+    grid = build_grid({'cpu_threshold': argv.cpu_threshold, 'memory_threshold': argv.memory_threshold,
+                       'threshold_count_limit': argv.threshold_count_limit, 'threshold_tolerance': argv.threshold_tolerance})
+    started = time.time()
+    results = evaluate_grid(trace, grid, cluster, argv.initial_nodes, argv.resize_latency, argv.resize_cooldown, argv.sample_interval)
+    print('%d settings over %.1f hours of samples in %.1fs' % (len(grid['cpu_threshold']), len(trace) * STEP_SECONDS / 3600.0, time.time() - started))
+    order, pareto = rank(results, argv.saturation_weight)
+    print_table(results, order, pareto, argv.top)
+    if argv.output:
+        with open(argv.output, 'w') as f:
+            json.dump([dict([(column, float(values[i])) for column, values in results.items()], pareto=bool(pareto[i])) for i in order], f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,159 @@
+"""
+ Cluster topology for Unravel Auto Scaling on HDInsight
+
+ Worker count, role layout and VM sizes are read through a provider (Azure
+ CLI, Azure REST API or a static stand-in) and cached per cluster for a TTL,
+ so sampling doesn't start a CLI process every cycle.
+"""
+import json
+import subprocess
+import threading
+import time
+
+WORKER_ROLE = 'workernode'
+AZURE_MANAGEMENT_URL = 'https://management.azure.com'
+HDINSIGHT_API_VERSION = '2018-06-01-preview'
+
+
+class Topology(object):
+    def __init__(self, cluster_name, roles, fetched=None):
+        self.cluster_name = cluster_name
+        self.roles = roles                 # role name -> {'count': , 'vm_size': }
+        self.fetched = fetched if fetched is not None else time.time()
+
+    @property
+    def worker_count(self):
+        return self.roles.get(WORKER_ROLE, {}).get('count', 0)
+
+    @property
+    def vm_size(self):
+        return self.roles.get(WORKER_ROLE, {}).get('vm_size')
+
+    @classmethod
+    def from_cluster_json(cls, cluster_json):
+        """Parse `azure hdinsight cluster show --json` output or the ARM cluster resource"""
+        roles = {}
+        for role in cluster_json['properties']['computeProfile']['roles']:
+            roles[role['name']] = {'count': role['targetInstanceCount'],
+                                   'vm_size': role.get('hardwareProfile', {}).get('vmSize')}
+        return cls(cluster_json['name'], roles)
+
+    def __repr__(self):
+        return 'Topology(%s, %s)' % (self.cluster_name, self.roles)
+
+
+class TopologyProvider(object):
+    def fetch(self, cluster):
+        raise NotImplementedError
+
+
+class AzureCliProvider(TopologyProvider):
+    """Azure CLI 1.0, starts one process per fetch"""
+    def fetch(self, cluster):
+        cluster_info = subprocess.check_output(['azure', 'hdinsight', 'cluster', 'show', '-g', cluster['resource_group'], '-c', cluster['cluster_name'], '--json'])
+        return Topology.from_cluster_json(json.loads(cluster_info))
+
+
+class AzureRestProvider(TopologyProvider):
+    """
+    In-process Azure Resource Manager client, also resizes clusters.
+    get_token is a callable returning a bearer token for management.azure.com
+    """
+    def __init__(self, session, subscription_id, get_token, timeout=10, management_url=AZURE_MANAGEMENT_URL):
+        self.session = session
+        self.subscription_id = subscription_id
+        self.get_token = get_token
+        self.timeout = timeout
+        self.management_url = management_url
+
+    def cluster_url(self, cluster):
+        return '%s/subscriptions/%s/resourceGroups/%s/providers/Microsoft.HDInsight/clusters/%s' % (
+            self.management_url, self.subscription_id, cluster['resource_group'], cluster['cluster_name'])
+
+    def headers(self):
+        return {'Authorization': 'Bearer %s' % self.get_token()}
+
+    def fetch(self, cluster):
+        res = self.session.get(self.cluster_url(cluster), params={'api-version': HDINSIGHT_API_VERSION},
+                               headers=self.headers(), timeout=self.timeout)
+        res.raise_for_status()
+        return Topology.from_cluster_json(res.json())
+
+    def start_resize(self, cluster, target_nodes):
+        """
+        Ask ARM to resize the workernodes, returns the URL to poll with
+        resize_status() and the seconds to wait first, None when ARM is done
+        """
+        res = self.session.post(self.cluster_url(cluster) + '/roles/%s/resize' % WORKER_ROLE, params={'api-version': HDINSIGHT_API_VERSION},
+                                headers=self.headers(), json={'targetInstanceCount': target_nodes}, timeout=self.timeout)
+        res.raise_for_status()
+        status_url = res.headers.get('Azure-AsyncOperation') or res.headers.get('Location')
+        if res.status_code == 200 or not status_url:
+            return None
+        return status_url, int(res.headers.get('Retry-After', 10))
+
+    def resize_status(self, status_url):
+        """('InProgress' / 'Succeeded' / 'Failed' / 'Canceled', seconds to wait before polling again)"""
+        res = self.session.get(status_url, headers=self.headers(), timeout=self.timeout)
+        res.raise_for_status()
+        return res.json().get('status'), int(res.headers.get('Retry-After', 10))
+
+
+class StaticProvider(TopologyProvider):
+    """Local stand-in holding the topologies in memory, for tests and simulations"""
+    def __init__(self, topologies=None):
+        self.topologies = dict(topologies or {})
+        self.fetches = 0
+
+    def set_workers(self, cluster_name, count, vm_size=None):
+        roles = self.topologies.setdefault(cluster_name, {})
+        roles[WORKER_ROLE] = {'count': count, 'vm_size': vm_size or roles.get(WORKER_ROLE, {}).get('vm_size')}
+
+    def fetch(self, cluster):
+        self.fetches += 1
+        roles = self.topologies[cluster['cluster_name']]
+        return Topology(cluster['cluster_name'], dict((name, dict(role)) for name, role in roles.items()))
+
+
+def azure_cli_token():
+    """Bearer token from Azure CLI 2.0 (`az login`), with its expiry time"""
+    token = json.loads(subprocess.check_output(['az', 'account', 'get-access-token', '--resource', AZURE_MANAGEMENT_URL + '/']))
+    return token['accessToken'], time.mktime(time.strptime(token['expiresOn'].split('.')[0], '%Y-%m-%d %H:%M:%S'))
+
+
+class CachedToken(object):
+    """Calls fetch() -> (token, expires at) again only shortly before the token expires"""
+    def __init__(self, fetch=azure_cli_token, margin=300):
+        self.fetch = fetch
+        self.margin = margin
+        self.token = None
+        self.expires = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            if self.token is None or time.time() > self.expires - self.margin:
+                self.token, self.expires = self.fetch()
+            return self.token
+
+
+class TopologyCache(object):
+    """Topology per cluster name, fetched again after ttl seconds or once invalidated"""
+    def __init__(self, provider, ttl=600):
+        self.provider = provider
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, cluster):
+        with self.lock:
+            topology = self.entries.get(cluster['cluster_name'])
+        if topology is None or time.time() - topology.fetched >= self.ttl:
+            topology = self.provider.fetch(cluster)
+            with self.lock:
+                self.entries[cluster['cluster_name']] = topology
+        return topology
+
+    def invalidate(self, cluster_name):
+        with self.lock:
+            self.entries.pop(cluster_name, None)
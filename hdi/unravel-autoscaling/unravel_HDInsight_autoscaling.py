@@ -1,13 +1,30 @@
 """
  Unravel Auto Scaling on HDInsight
- v0.2.3
+ v0.3.0
 """
+import argparse
+import asyncio
 import json
 import logging
 import subprocess
-from time import sleep
+import time
+from concurrent.futures import ThreadPoolExecutor
+import autoscaling_metrics as metrics
+from app_index import AppIndex, search_apps
+import state_journal
+from forecast_policy import ForecastPolicy
+from metric_ingest import BUCKET_INTERVAL, FleetIngestor, MetricIngestor, window_ms
+from metric_sources import YarnRmSource
+from scale_down_planner import plan_scale_down, yarn_nodes
+from scale_operation import FINISHED_STATES, ResizeExecutor
+from schedule_policy import SchedulePolicy
+from target_sizing import WorkerShape, target_nodes
+from topology import AzureCliProvider, AzureRestProvider, CachedToken, TopologyCache
+from unravel_session import UnravelSession
 try:
     import requests
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3.util.retry import Retry
 except Exception as e:
     print(e)
     print('requests module is missing')
@@ -21,267 +38,734 @@ except Exception as e:
 unravel_base_url = 'http://52.170.202.86:3000'
 memory_threshold = 80              #%
 cpu_threshold = 80                 #%
+threshold_count_limit = 5          # Decisions in a row over/under the thresholds before a resize
+threshold_tolerance = 0.2          # Scale down only below (1 - threshold_tolerance) of both thresholds
 min_nodes = 1                      # Min workerNodes
 max_nodes = 3                      # Max workernodes Allowed
 resource_group = 'UNRAVEL01'
 cluster_name = 'autoscaling1'
+scaling_policy = 'threshold'       # 'threshold' or 'predictive' (threshold + forecast, needs numpy)
+threshold_statistic = 'avg'        # 'avg' compares the 30s average allocation to the thresholds, 'p95' the 95th percentile of the last 5 minutes
+node_provision_time = 600          # Seconds until a new workernode runs containers
+forecast_season_length = None      # 30s buckets in one load cycle, e.g. 2880 for daily, None = trend only
+                                   # (the history of the cluster grows to two seasons, the least the seasonal forecast needs)
+schedule = []                      # Windows of a minimum node count (UTC), reached node_provision_time before they start, e.g.
+                                   # [{"name": "nightly-etl", "cron": "0 1 * * *", "duration": 7200, "min_nodes": 12}]
+scaling_step = 'demand'            # 'demand' resizes to fit the YARN demand in one step, 'single' adds/removes 1 node
+worker_shape = None                # [vcores, MB] YARN capacity of one workernode, None = derived from cluster totals
+container_size = None              # [vcores, MB] of a typical YARN container, None = size on total vcores/MB only
+queue_aware = False                # Track running/pending apps, scale up on queued work and never down while apps wait
+pending_app_age_limit = 300        # Seconds an app may stay pending before the cluster is scaled up
+scale_down_planner = True          # Only remove capacity that is idle or held by apps finishing within the drain window
+scale_down_drain_window = 600      # Seconds running apps are given to finish before their capacity may be removed
+yarn_rm_url = None                 # e.g. 'http://headnodehost:8088', per node containers for the scale down planner
+metrics_source = 'elasticsearch'   # 'elasticsearch' through Unravel, or 'yarn' straight from the cluster metrics of yarn_rm_url
 
 #Unravel Log in credentials
 login_data = {'user':{'login':'admin','password':'unraveldata'}}
+login_max_age = 3600               # Seconds before the Unravel session is renewed, None = only when Unravel expires it
+
+# Fleet mode: JSON file with a list of clusters to autoscale from this process, e.g.
+# [{"cluster_name": "etl01", "resource_group": "UNRAVEL01", "max_nodes": 10}, ...]
+# Any of the variables above can be overridden per cluster. None = single cluster mode
+fleet_config = None
+max_clusters_in_flight = 8         # Clusters sampled/decided at the same time
+sample_interval = 120              # Seconds between two decisions of a cluster
+poll_interval = 15                 # Seconds between two metric polls of a cluster
+stale_sample_polls = 3             # Cycles are skipped while the newest sample is older than this many poll_intervals past its 30s bucket
+metric_history_size = 720          # 30s samples kept per cluster (6 hours), more with a forecast_season_length
+es_batch_size = 100                # Clusters polled with one Elasticsearch request
+request_timeout = 10               # Seconds before an Unravel API request is given up
+request_retries = 3                # Retries of a failed Unravel API request (connection errors, 502/503/504)
+topology_provider = 'cli'          # 'cli' Azure CLI 1.0 or 'rest' Azure REST API (token from Azure CLI 2.0 `az login`)
+topology_ttl = 600                 # Seconds a cluster's workernode count is cached, refreshed after every resize
+azure_subscription_id = None       # Needed by the 'rest' topology provider
+journal_path = 'hdinsight_autoscaling.journal'  # Samples and counters kept across restarts, None = off
+journal_compact_every = 10000      # Journal records between two compactions
+metrics_port = 9108                # Local port serving the autoscaler's own metrics in Prometheus format, None = off
+resize_timeout = 1800              # Seconds before a running resize is marked timed-out
+resize_cooldown = 300              # Seconds after a resize before the next one may start
 
 #############################################################
 #                                                           #
 #   DO NOT Modify the variables below                       #
 #                                                           #
 #############################################################
+LOGGER = logging.getLogger('hdinsight_autoscaling')
+
+# Cluster settings that can be overridden per cluster in the fleet config
+CLUSTER_SETTINGS = ('cluster_name', 'resource_group', 'min_nodes', 'max_nodes', 'cpu_threshold', 'memory_threshold',
+                    'threshold_count_limit', 'threshold_tolerance',
+                    'scaling_policy', 'threshold_statistic', 'node_provision_time', 'forecast_season_length', 'schedule',
+                    'scaling_step', 'worker_shape', 'container_size', 'queue_aware', 'pending_app_age_limit',
+                    'scale_down_planner', 'scale_down_drain_window', 'yarn_rm_url', 'metrics_source')
+
+# Unravel resource endpoints read by get_resources(): sample key -> (path, field of the last data point)
+RESOURCE_PATHS = {'total_cores': ('/api/v1/clusters/resources/cpu/total', 'avg_totalvc'),
+                  'cores_allocated': ('/api/v1/clusters/resources/cpu/allocated', 'avg_allocatedvcores'),
+                  'total_memory': ('/api/v1/clusters/resources/memory/total', 'avg_totalmb'),
+                  'memory_allocated': ('/api/v1/clusters/resources/memory/allocated', 'avg_allocatedmb')}
+
+
+def pooled_session(hosts, connections_per_host):
+    session = requests.Session()
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, HTTPAdapter(pool_connections=hosts, pool_maxsize=connections_per_host,
+                                          max_retries=Retry(total=request_retries, backoff_factor=0.2, status_forcelist=(502, 503, 504))))
+    return session
+
+
+# One pooled keep-alive session shared by every cluster, sized for the
+# clusters in flight each fetching all resource endpoints at once
+def new_session(in_flight):
+    return pooled_session(1, in_flight * len(RESOURCE_PATHS))
+
+
+# ResourceManager calls go to one host per cluster and never carry the Unravel
+# or Azure credentials, a separate session keeps a pool per cluster in flight
+def new_rm_session(in_flight):
+    return pooled_session(in_flight, 2)
+
+
+# Point the Unravel URLs and the authenticated Unravel session at base_url
+def use_unravel(base_url):
+    global login_uri, app_search_uri, es_query_url, RESOURCE_ENDPOINTS, unravel
+    login_uri = base_url + '/users/sign_in'
+    app_search_uri = base_url + '/api/v1/apps/search'
+    es_query_url = base_url + '/search/q/rm-search/cm'
+    RESOURCE_ENDPOINTS = dict((name, (base_url + path, field)) for name, (path, field) in RESOURCE_PATHS.items())
+    # Unravel API calls log in once and again only when the session expires
+    unravel = UnravelSession(s, login_uri, login_data, max_age=login_max_age, timeout=request_timeout,
+                             on_login=lambda reason: metrics.LOGINS_TOTAL.inc(reason=reason))
+
+s = new_session(max_clusters_in_flight)
+rm_session = new_rm_session(max_clusters_in_flight)
 try:
-    login_uri = unravel_base_url + '/users/sign_in'
-    app_search_uri = unravel_base_url + '/api/v1/apps/search'
-    total_cores_across_hosts = unravel_base_url + '/api/v1/clusters/resources/cpu/total'
-    total_memory_across_hosts = unravel_base_url + '/api/v1/clusters/resources/memory/total'
-    allocated_cores_across_hosts = unravel_base_url + '/api/v1/clusters/resources/cpu/allocated'
-    allocated_memory_across_hosts = unravel_base_url + '/api/v1/clusters/resources/memory/allocated'
+    use_unravel(unravel_base_url)
 except:
     LOGGER.error("Unravel Url is not exist")
     exit()
+resource_pool = ThreadPoolExecutor(max_workers=max_clusters_in_flight * (len(RESOURCE_ENDPOINTS) + 1))
 
-threshold_count_limit = 5
 
-s = requests.Session()
+def new_topology_provider():
+    if topology_provider == 'rest':
+        return AzureRestProvider(requests.Session(), azure_subscription_id, CachedToken(), timeout=request_timeout)
+    return AzureCliProvider()
+
+topology_cache = TopologyCache(new_topology_provider(), ttl=topology_ttl)
+
+
+def default_cluster():
+    return dict((name, globals()[name]) for name in CLUSTER_SETTINGS)
+
+
+def load_fleet(path):
+    with open(path) as f:
+        fleet = json.load(f)
+    clusters = []
+    for entry in fleet:
+        unknown = set(entry) - set(CLUSTER_SETTINGS)
+        if unknown:
+            raise ValueError('Unknown cluster settings %s in %s' % (sorted(unknown), path))
+        cluster = default_cluster()
+        cluster.update(entry)
+        clusters.append(cluster)
+    return clusters
+
 
 def check_login():
     try:
-        response = s.post(login_uri,json=login_data)
-        # res = s.post(cdh_login, data=cdh_secret)
+        unravel.ensure_login()
     except Exception as e:
-        print(e)
-
-    if response.status_code == 200:
-        return True
-    else:
-        return True
+        LOGGER.error('Unravel login failed: %s' % e)
+        return False
+    return True
 
 
-def check_threshold(threshold_count, resources_usage):
-    threshold_tolerance = 0.2
+def check_threshold(threshold_count, resources_usage, cluster=None):
+    cluster = cluster or default_cluster()
+    threshold_count_limit = cluster['threshold_count_limit']
+    threshold_tolerance = cluster['threshold_tolerance']
     cpu_usage = resources_usage['cpu_usage']
     memory_usage = resources_usage['memory_usage']
     total_cores = resources_usage['total_cores']
     total_memory = resources_usage['total_memory']
     nodes_count = resources_usage['nodes_count']
-    if cpu_usage > cpu_threshold or memory_usage > memory_threshold:
+    cpu_limit = cluster['cpu_threshold']
+    memory_limit = cluster['memory_threshold']
+    if cpu_usage > cpu_limit or memory_usage > memory_limit:
         if threshold_count < threshold_count_limit:
             return ('Up Scale threshold reach')
         # if threshold_count >= threshold_count_limit and (total_cores < max_cpu_allow or total_memory < max_memory_allow):
-        if threshold_count >= threshold_count_limit and nodes_count < max_nodes:
+        if threshold_count >= threshold_count_limit and nodes_count < cluster['max_nodes']:
             return ('Up Scaling')
-    elif cpu_usage < (cpu_threshold - (cpu_threshold * threshold_tolerance)) and memory_usage < (memory_threshold - (memory_threshold * threshold_tolerance)):
+    elif cpu_usage < (cpu_limit - (cpu_limit * threshold_tolerance)) and memory_usage < (memory_limit - (memory_limit * threshold_tolerance)):
         # if threshold_count > -threshold_count_limit and (total_cores > min_cpu_allow or total_memory > min_memory_allow):
-        if threshold_count > -threshold_count_limit and nodes_count > min_nodes:
+        if threshold_count > -threshold_count_limit and nodes_count > cluster['min_nodes']:
             return ('Down Scale threshold reach')
         if threshold_count <= -threshold_count_limit :
             return ('Down Scaling')
     return ('No Action Needed')
 
 # Get Cluster Workdernode Count
-def get_workdernode():
+def get_workdernode(cluster=None):
+    cluster = cluster or default_cluster()
     try:
-        cluster_info = subprocess.check_output(['azure', 'hdinsight', 'cluster', 'show', '-g', resource_group, '-c', cluster_name, '--json'])
-        cluster = json.loads(cluster_info)
-        if cluster['name'] == cluster_name:
-    		if cluster['properties']['computeProfile']['roles'][1]['name'] == 'workernode':
-    			workerNodes = cluster['properties']['computeProfile']['roles'][1]['targetInstanceCount']
-        return workerNodes
+        with metrics.TOPOLOGY_LOOKUP_SECONDS.time(cluster=cluster['cluster_name']):
+            return topology_cache.get(cluster).worker_count
     except:
         return 0
 
 
-def elastic_search():
-    query_url = unravel_base_url + '/search/q/rm-search/cm'
-    query_str = """{"sort":[{"startedTime":{"order":"desc"}}],
-                    "from":0,
-                    "size":0,
-                    "query":{
-                        "bool":{
-                            "must":[{
-                                        "range":{
-                                            "date":{
-                                                "gte":"now-2m/m","lt":"now"
-                                            }
-                                        }
-                                    },
-                                    {
-                                        "term":{
-                                            "clusterName": "%s"
-                                        }
-                                    }
-                            ]
-                        }
-                    },
-                    "aggs":{
-                        "apps_over_time":{
-                            "date_histogram":{"field":"date","interval":"30s"},
-                                "aggs":{
-                                    "avg_totalmb":{"avg":{"field":"totalMB"}},
-                                    "avg_totalvc":{"avg":{"field":"totalVCores"}},
-                                    "avg_allocatedmb":{"avg":{"field":"allocatedMB"}},
-                                    "avg_allocatedvc":{"avg":{"field":"allocatedVCores"}}
-                                }
-                            }
-                        }
-                }""" % cluster_name
-    res = s.post(query_url, data=str(query_str))
-    search_result = json.loads(res.text).get("aggregations", "None")
-    if search_result != "None":
-        search_result = search_result['apps_over_time']['buckets'][-1]
-        total_cores = search_result['avg_totalvc']['value']
-        total_memory = search_result['avg_totalmb']['value']
-        cores_allocated = search_result['avg_allocatedvc']['value']
-        memory_allocated = search_result['avg_allocatedmb']['value']
-        try:
-            cpu_percent_usage = cores_allocated / total_cores  * 100
-            memory_percent_usage = memory_allocated / total_memory  * 100
-        except:
-            cpu_percent_usage = 1.0
-            memory_percent_usage = 1.0
-        nodes_count = get_workdernode()
-
-    return({'cpu_usage' : cpu_percent_usage,
-            'memory_usage' : memory_percent_usage,
-            'total_memory': total_memory,
-            'total_cores': total_cores,
-            'nodes_count' : nodes_count
-           })
-
-# Retrieve Allocated resources
-def get_resources():
+# Seconds the newest sample may be old, its bucket and a few missed polls
+def sample_age_limit():
+    return window_ms(BUCKET_INTERVAL) / 1000.0 + stale_sample_polls * poll_interval
+
+
+# Latest sample of a cluster, poll=False when the FleetIngestor already polled it.
+# None when the newest sample is too old to decide on (failing polls, a stalled source)
+def elastic_search(cluster=None, ingestor=None, poll=True):
+    cluster = cluster or default_cluster()
+    ingestor = ingestor or new_ingestor(cluster)
+    if poll:
+        poll_metrics(ingestor)
+    sample = ingestor.buffer.latest()
+    if sample is None:
+        raise ValueError('No metrics from %s for cluster %s' % (cluster['metrics_source'], cluster['cluster_name']))
+    age = time.time() - sample['timestamp'] / 1000.0
+    if age > sample_age_limit():
+        LOGGER.warning('[%s] Newest sample from %s is %.0fs old, no decision this cycle' % (cluster['cluster_name'], cluster['metrics_source'], age))
+        return None
+    nodes_count = get_workdernode(cluster)
+
+    resources_usage = dict((name, value) for name, value in sample.items() if name != 'timestamp')
+    resources_usage['nodes_count'] = nodes_count
+    # Short saturation spikes are averaged away in a 30s bucket but not in its 95th percentile
+    if cluster['threshold_statistic'] == 'p95' and sample.get('cores_allocated_p95') is not None:
+        resources_usage['cpu_usage'] = sample['cores_allocated_p95'] / sample['total_cores'] * 100
+        resources_usage['memory_usage'] = sample['memory_allocated_p95'] / sample['total_memory'] * 100
+    return resources_usage
+
+
+def poll_metrics(ingestor, names=None):
+    if isinstance(ingestor, YarnRmSource):
+        with metrics.RM_QUERY_SECONDS.time(cluster=ingestor.cluster_name):
+            return ingestor.poll()
+    with metrics.ES_QUERY_SECONDS.time():
+        if names is not None:
+            return ingestor.poll(names)
+        return ingestor.poll()
+
+
+# Samples kept for the cluster, the seasonal forecast only engages with two full seasons of history
+def history_size(cluster):
+    if cluster['scaling_policy'] == 'predictive' and cluster['forecast_season_length']:
+        return max(metric_history_size, 2 * cluster['forecast_season_length'])
+    return metric_history_size
+
+
+def new_ingestor(cluster):
+    buffer_size = history_size(cluster)
+    if buffer_size > metric_history_size:
+        cluster_logger(cluster).info('Keeping %d samples for forecast_season_length %d' % (buffer_size, cluster['forecast_season_length']))
+    if cluster['metrics_source'] == 'yarn':
+        if not cluster['yarn_rm_url']:
+            raise ValueError('metrics_source yarn needs the yarn_rm_url of cluster %s' % cluster['cluster_name'])
+        return YarnRmSource(cluster['cluster_name'], rm_session, cluster['yarn_rm_url'], buffer_size=buffer_size, timeout=request_timeout)
+    return MetricIngestor(cluster['cluster_name'], unravel, es_query_url, buffer_size=buffer_size, timeout=request_timeout)
+
+# Returns (result, seconds taken)
+def timed(func, *args):
+    started = time.time()
+    result = func(*args)
+    return result, time.time() - started
+
+
+def fetch_resource(url, field):
+    res = unravel.get(url, timeout=request_timeout)
+    res.raise_for_status()
+    return float(json.loads(res.text)[-1][field])
+
+
+# Retrieve Allocated resources, all endpoints and the workernode count at once
+def get_resources(cluster=None):
+    cluster = cluster or default_cluster()
     try:
-        # Current cpu percentage
-        res = s.get(total_cores_across_hosts)
-        res1 = s.get(allocated_cores_across_hosts)
-        total_cores = float(json.loads(res.text)[-1]['avg_totalvc'])
-        cores_allocated = float(json.loads(res1.text)[-1]['avg_allocatedvcores'])
-        cpu_percent_usage = cores_allocated / total_cores  * 100
-
-        # Current memory percentage and total_memory
-        res = s.get(total_memory_across_hosts)
-        res1 = s.get(allocated_memory_across_hosts)
-        total_memory = float(json.loads(res.text)[-1]['avg_totalmb'])
-        memory_allocated = float(json.loads(res1.text)[-1]['avg_allocatedmb'])
-        memory_percent_usage = memory_allocated / total_memory  * 100
-
+        futures = dict((name, resource_pool.submit(timed, fetch_resource, url, field)) for name, (url, field) in RESOURCE_ENDPOINTS.items())
         # Get the number of workerNodes in cluster
-        nodes_count = get_workdernode()
-
-        return {'cpu_usage' : cpu_percent_usage,
-                'memory_usage' : memory_percent_usage,
-                'total_memory': total_memory,
-                'total_cores': total_cores,
-                'nodes_count' : nodes_count
-               }
+        futures['nodes_count'] = resource_pool.submit(timed, get_workdernode, cluster)
+
+        resources_usage = {'latency': {}}
+        for name, future in futures.items():
+            resources_usage[name], resources_usage['latency'][name] = future.result()
+            if name in RESOURCE_ENDPOINTS:
+                metrics.RESOURCE_REQUEST_SECONDS.observe(resources_usage['latency'][name], endpoint=name)
+        resources_usage['cpu_usage'] = resources_usage['cores_allocated'] / resources_usage['total_cores']  * 100
+        resources_usage['memory_usage'] = resources_usage['memory_allocated'] / resources_usage['total_memory']  * 100
+        return resources_usage
     except Exception as e:
-        LOGGER.error("Get Resource Usage from Unravel Failed")
-        print(e)
-        exit()
-
+        LOGGER.error("Get Resource Usage from Unravel Failed: %s" % e)
+        raise
 
-# Retrieve Running Jobs
-def get_run():
-    search_input = {
-                    "appStatus":["R"],
-                    "from":0,
-                    "appTypes":["mr","hive","spark","cascading","pig"]
-                   }
 
+# Retrieve Running and Pending Jobs into the cluster's application index
+def get_run(cluster=None, index=None):
+    cluster = cluster or default_cluster()
+    if index is None:
+        index = AppIndex(cluster['cluster_name'])
     try:
-        response = s.post(login_uri,json=login_data)
-        res = s.post(app_search_uri,json=search_input)
+        diff = index.refresh(search_apps(unravel, app_search_uri, timeout=request_timeout, cluster_name=cluster['cluster_name']))
     except requests.exceptions.RequestException as e:
-        LOGGER.error("Unable to connect to Unravel Server\n")
-        print(e)
-        exit()
-
-    if res.status_code == 200:
-            parsed = json.loads(res.text)
-            if parsed:
-                for job_num in range(len(parsed['results'])):
-                    duration = parsed['results'][job_num]['duration_long']
-                    app_id = parsed['results'][job_num]['id'].encode('utf-8')
-                    # print(app_id,duration,len(parsed['results']))
-                    jobs_dict[app_id] = duration
-                # print(json.dumps(parsed, indent=4, sort_keys=True))
-                return (jobs_dict)
+        LOGGER.error("Unable to connect to Unravel Server: %s" % e)
+        raise
+    LOGGER.debug('[%s] Applications %s, %d running, %d pending' % (cluster['cluster_name'], diff, len(index.running()), index.pending_count()))
+    return index
+
+
+# get_run() for the fleet loop, None when the index could not be refreshed this cycle
+def refresh_apps(cluster, index):
+    try:
+        return get_run(cluster, index)
+    except Exception as e:
+        cluster_logger(cluster).error('Application search failed, no queue signals or scale down plan this cycle: %s' % e)
+        return None
+
+
+# The application index was refreshed with the sample, every cycle
+def plan_cluster_scale_down(cluster, state, resources_usage, target):
+    nodes = yarn_nodes(rm_session, cluster['yarn_rm_url'], request_timeout) if cluster['yarn_rm_url'] else None
+    shape = WorkerShape(*cluster['worker_shape']) if cluster['worker_shape'] else WorkerShape.from_usage(resources_usage)
+    free = None
+    if resources_usage.get('cores_allocated') is not None and resources_usage.get('total_cores') is not None:
+        free = (resources_usage['total_cores'] - resources_usage['cores_allocated'], resources_usage['total_memory'] - resources_usage['memory_allocated'])
+    return plan_scale_down(resources_usage['nodes_count'], target, shape, state['apps'].running(),
+                           state['apps'].typical_duration, nodes, cluster['scale_down_drain_window'], free)
+
+
+def add_queue_signals(resources_usage, index, container_size=None):
+    resources_usage['pending_apps'] = index.pending_count()
+    resources_usage['oldest_pending_age'] = index.oldest_pending_age()
+    pending_cores, pending_memory = index.pending_demand(container_size)
+    # A metrics source with pending resources of its own takes precedence
+    if resources_usage.get('pending_cores') is None:
+        resources_usage['pending_cores'] = pending_cores
+        resources_usage['pending_memory'] = pending_memory
+
+
+# Resize the workernodes of a cluster, returns True when Azure reports success
+async def resize_cluster(cluster, target_nodes):
+    if isinstance(topology_cache.provider, AzureRestProvider):
+        return await resize_cluster_rest(cluster, target_nodes, topology_cache.provider)
+    log = cluster_logger(cluster)
+    try:
+        resizing = await asyncio.create_subprocess_exec('azure', 'hdinsight', 'cluster', 'resize', '-g', cluster['resource_group'], '-c', cluster['cluster_name'], str(target_nodes), stdout=subprocess.PIPE)
+    except Exception as e:
+        log.error('Resizing Fail: %s' % e)
+        return False
+
+    resizing_ok = False
+    try:
+        async for line in resizing.stdout:
+            line = line.decode('utf-8', 'replace')
+            if line.find('Operation state:  Succeeded') > -1:
+                resizing_ok = True
+            log.info(line.rstrip())
+        await resizing.wait()
+    except asyncio.CancelledError:
+        # Timed out, stop waiting on the CLI. Azure may still finish the operation
+        resizing.kill()
+        raise
+
+    if resizing_ok:
+        log.info('Resizing Success')
     else:
-        LOGGER.error("Unravel Search endpoint failed")
+        log.error('Resizing Fail')
+    return resizing_ok
 
 
-def main():
-    threshold_count = 0
-    while True:
-        if check_login:
-            resources_usage = elastic_search()
-            LOGGER.debug(resources_usage)
-
-            decision = check_threshold(threshold_count, resources_usage)
-            LOGGER.info(str("\ndecision: " + decision + "\nthreshold_count: " + str(threshold_count) + '\nWorkdernode: '+ str(resources_usage['nodes_count'])))
-            if decision == 'Up Scale threshold reach':
-                LOGGER.info('Threshold reach')
-                threshold_count += 1
-            elif decision == 'Up Scaling':
-                LOGGER.info('More Resources Needed')
-                #Adding more resources command goes here
-                try:
-                    resizing = subprocess.Popen(['azure', 'hdinsight', 'cluster', 'resize', '-g', resource_group, '-c', cluster_name, str(resources_usage['nodes_count']+1)],stdout=subprocess.PIPE, bufsize=1)
-                except:
-                    pass
-
-                for line in iter(resizing.stdout.readline, b''):
-                    if (line.find('Operation state:  Succeeded') > -1):
-                    	resizing_err = 1
-                    LOGGER.info(line)
-                resizing.stdout.close()
-                resizing.wait()
-
-                if resizing_err:
-                	LOGGER.info('Resizing Success')
-                else:
-                	LOGGER.error('Resizing Fail')
-
-                #Adding more resources command goes here
-                threshold_count = 0
-            elif decision == 'Down Scale threshold reach':
-                threshold_count -= 1
-            elif decision == 'Down Scaling':
-                LOGGER.info('No Extra Resources Needed')
-                #Removing extra resources command goes here
-                try:
-                    resizing = subprocess.Popen(['azure', 'hdinsight', 'cluster', 'resize', '-g', resource_group, '-c', cluster_name, str(resources_usage['nodes_count']-1)],stdout=subprocess.PIPE, bufsize=1)
-                except:
-                    pass
-
-                for line in iter(resizing.stdout.readline, b''):
-                    if (line.find('Operation state:  Succeeded') > -1):
-                    	resizing_err = 1
-                    LOGGER.info(line)
-                resizing.stdout.close()
-                resizing.wait()
-
-                if resizing_err:
-                    LOGGER.info('Resizing Success')
-                else:
-                    LOGGER.error('Resizing Fail')
-
-                #Removing extra resources command goes here
-                threshold_count = 0
-            elif decision == 'No Action Needed':
-                threshold_count = 0
+# Same through the Azure REST API, the async operation is polled without holding a thread
+async def resize_cluster_rest(cluster, target_nodes, provider):
+    loop = asyncio.get_running_loop()
+    log = cluster_logger(cluster)
+    try:
+        operation = await loop.run_in_executor(None, provider.start_resize, cluster, target_nodes)
+        status = 'Succeeded'
+        while operation is not None:
+            status_url, wait = operation
+            await asyncio.sleep(wait)
+            status, wait = await loop.run_in_executor(None, provider.resize_status, status_url)
+            operation = (status_url, wait) if status == 'InProgress' else None
+    except requests.exceptions.RequestException as e:
+        log.error('Resizing Fail: %s' % e)
+        return False
+
+    if status == 'Succeeded':
+        log.info('Resizing Success')
+        return True
+    log.error('Resizing Fail: operation %s' % status)
+    return False
+
+
+# Prefix every log line with the cluster it belongs to
+class ClusterLogger(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        return '[%s] %s' % (self.extra['cluster'], msg), kwargs
+
+
+def cluster_logger(cluster):
+    return ClusterLogger(LOGGER, {'cluster': cluster['cluster_name']})
+
+
+def new_cluster_state(cluster, journal=None):
+    state = {'threshold_count': 0,
+             'ingestor': new_ingestor(cluster),
+             'forecast': new_forecast(cluster),
+             'schedule': new_schedule(cluster),
+             'apps': AppIndex(cluster['cluster_name']),
+             'journal': journal,
+             'journaled': None,           # Timestamp of the newest sample in the journal
+             'journaled_sample': None,    # Copy of that sample as it was written
+             'compacted': None,           # Timestamp of the newest sample of the last journal compaction
+             'resize_record': None}       # Last resize written to the journal
+    state['resizer'] = ResizeExecutor(cluster, resize_cluster, timeout=resize_timeout, cooldown=resize_cooldown, logger=cluster_logger(cluster),
+                                      on_started=lambda operation: journal_resize(cluster, state, operation),
+                                      on_finished=lambda operation: resize_finished(cluster, state, operation))
+    return state
+
+
+def resize_finished(cluster, state, operation):
+    topology_cache.invalidate(cluster['cluster_name'])
+    metrics.RESIZE_SECONDS.observe(operation.elapsed(), cluster=cluster['cluster_name'], state=operation.state)
+    journal_resize(cluster, state, operation)
+
+
+#############################################################
+#   Warm restart journal                                    #
+#############################################################
+def journal_samples(cluster, state):
+    if state['journal'] is None:
+        return
+    # The newest journaled bucket is written again only if it changed, it may have been partial
+    samples = state['ingestor'].buffer.since(state['journaled'])
+    if samples and samples[0] == state['journaled_sample']:
+        samples = samples[1:]
+    for sample in samples:
+        state['journal'].record_sample(cluster['cluster_name'], sample)
+    if samples:
+        state['journaled'] = samples[-1]['timestamp']
+        state['journaled_sample'] = dict(samples[-1])
+
+
+def journal_count(cluster, state, previous_count):
+    if state['journal'] is not None and state['threshold_count'] != previous_count:
+        state['journal'].record_count(cluster['cluster_name'], state['threshold_count'])
+
+
+def journal_resize(cluster, state, operation):
+    state['resize_record'] = {'state': operation.state, 'from': operation.from_nodes, 'target': operation.target_nodes, 'at': time.time()}
+    if state['journal'] is not None:
+        state['journal'].record_resize(cluster['cluster_name'], state['resize_record'])
+
+
+# Samples older than the last compaction are no longer changed, only the newer tail is copied
+def snapshot_states(states):
+    snapshot = {}
+    for name, state in states.items():
+        samples = list(state['ingestor'].buffer)
+        if samples:
+            since = state['compacted'] if state['compacted'] is not None else samples[-1]['timestamp']
+            tail = len(samples)
+            while tail > 0 and samples[tail - 1]['timestamp'] >= since:
+                tail -= 1
+            samples[tail:] = [dict(sample) for sample in samples[tail:]]
+            state['compacted'] = samples[-1]['timestamp']
+        snapshot[name] = {'samples': samples, 'threshold_count': state['threshold_count'], 'resize': state['resize_record']}
+    return snapshot
+
+
+# The journal is rewritten in a worker thread, the fleet keeps running meanwhile
+async def compact_journal(journal):
+    loop = asyncio.get_running_loop()
+    started = time.time()
+    try:
+        await loop.run_in_executor(None, journal.write_compaction, journal.begin_compaction())
+        journal.finish_compaction()
+    except Exception as e:
+        LOGGER.error('Journal compaction failed: %s' % e)
+        journal.abort_compaction()
+        return
+    metrics.JOURNAL_COMPACTION_SECONDS.observe(time.time() - started)
+
+
+def schedule_compaction(journal):
+    global compaction_task
+    compaction_task = asyncio.ensure_future(compact_journal(journal))
+
+
+# Journal state is only restored while it can still matter: a resize that may
+# still run, or a threshold count that is not yet outdated by newer samples
+def journal_max_age(cluster):
+    return max(resize_timeout, cluster['threshold_count_limit'] * sample_interval)
+
+
+def restore_cluster_state(cluster, state, restored):
+    log = cluster_logger(cluster)
+    ingestor = state['ingestor']
+    times = [restored['samples'][-1]['timestamp'] / 1000.0] if restored['samples'] else []
+    if restored['resize'] is not None:
+        times.append(restored['resize']['at'])
+    if not times:
+        return
+    age = time.time() - max(times)
+    if age > journal_max_age(cluster):
+        log.info('Journal state is %.0fs old, older than %.0fs, not restored' % (age, journal_max_age(cluster)))
+        return
+    for sample in restored['samples']:
+        ingestor.buffer.add(sample)
+    latest = ingestor.buffer.latest()
+    if latest is not None:
+        ingestor.cursor = state['journaled'] = state['compacted'] = latest['timestamp']
+        state['journaled_sample'] = dict(latest)
+    state['threshold_count'] = restored['threshold_count']
+    resize = state['resize_record'] = restored['resize']
+    # The outcome of a resize interrupted by the restart is unknown, wait for it as if it was still running.
+    # A pending one may have been sent to Azure right before the restart
+    if resize is not None:
+        age = time.time() - resize['at']
+        hold = resize_cooldown - age if resize['state'] in FINISHED_STATES else resize_timeout - age
+        if hold > 0:
+            state['resizer'].hold(hold)
+            log.info('Resize %s -> %s was %s %.0fs ago, no resize for %.0fs' % (resize['from'], resize['target'], resize['state'], age, hold))
+    log.info('Restored %d samples, threshold_count %d' % (len(restored['samples']), state['threshold_count']))
+
+
+def new_forecast(cluster):
+    if cluster['scaling_policy'] == 'predictive':
+        return ForecastPolicy(cluster['node_provision_time'], cluster['forecast_season_length'])
+    return None
+
+
+def new_schedule(cluster):
+    if cluster['schedule']:
+        return SchedulePolicy(cluster['schedule'], lead_time=cluster['node_provision_time'])
+    return None
+
+
+def resize_target(cluster, resources_usage, decision):
+    if cluster['scaling_step'] == 'single':
+        target = resources_usage['nodes_count'] + (1 if decision == 'Up Scaling' else -1)
+        return max(cluster['min_nodes'], min(cluster['max_nodes'], target))
+    shape = WorkerShape(*cluster['worker_shape']) if cluster['worker_shape'] else None
+    return target_nodes(resources_usage, decision, cluster, shape, cluster['container_size'])
+
+
+# Scaling decision for one sample at now (epoch seconds), shared by the live loop and the simulator.
+# Returns (decision, target_nodes), target_nodes is None unless a resize is needed
+def decide(cluster, state, resources_usage, buffer, log=None, now=None):
+    decision = check_threshold(state['threshold_count'], resources_usage, cluster)
+    if state['forecast'] is not None and decision in ('Up Scale threshold reach', 'No Action Needed'):
+        predicted_decision, predicted = state['forecast'].check(buffer, resources_usage, cluster)
+        if log:
+            log.debug('Forecast in %ss: %s' % (cluster['node_provision_time'], predicted))
+        if predicted_decision:
+            if log:
+                log.info('Usage forecast over threshold when a new node would be ready')
+            decision = predicted_decision
+
+    if cluster['queue_aware'] and 'pending_apps' in resources_usage:
+        if decision in ('Up Scale threshold reach', 'No Action Needed') and resources_usage['nodes_count'] < cluster['max_nodes'] \
+                and resources_usage['oldest_pending_age'] > cluster['pending_app_age_limit']:
+            if log:
+                log.info('%d app(s) pending, oldest for %.0fs' % (resources_usage['pending_apps'], resources_usage['oldest_pending_age']))
+            decision = 'Up Scaling'
+        elif decision in ('Down Scale threshold reach', 'Down Scaling') and resources_usage['pending_apps'] > 0:
+            decision = 'No Action Needed'
+
+    # A scheduled window sets the floor, the reactive policies scale above it
+    scheduled = None
+    if state.get('schedule') is not None:
+        scheduled = state['schedule'].min_nodes(time.time() if now is None else now)
+    if scheduled is not None:
+        scheduled = min(scheduled, cluster['max_nodes'])
+        if resources_usage['nodes_count'] < scheduled and decision != 'Up Scaling':
+            if log:
+                log.info('Scheduled window needs %d workernodes' % scheduled)
+            decision = 'Up Scaling'
+
+    target = None
+    if decision in ('Up Scaling', 'Down Scaling'):
+        target = resize_target(cluster, resources_usage, decision)
+        if scheduled is not None:
+            target = max(target, scheduled)
+        if target == resources_usage['nodes_count']:
+            target = None
+    return decision, target
+
+
+def update_threshold_count(state, decision, resize_accepted=False):
+    if decision == 'Up Scale threshold reach':
+        state['threshold_count'] += 1
+    elif decision == 'Down Scale threshold reach':
+        state['threshold_count'] -= 1
+    elif decision == 'No Action Needed' or resize_accepted:
+        state['threshold_count'] = 0
+    # A refused resize keeps the count, it is retried once the running resize or the cooldown is over
+
+
+async def evaluate_cluster(cluster, state, semaphore, executor):
+    loop = asyncio.get_running_loop()
+    log = cluster_logger(cluster)
+    # Only sampling and the decision count against max_clusters_in_flight,
+    # resizes run in the background of the cluster's ResizeExecutor
+    async with semaphore:
+        # The scale down planner learns app durations from every refresh of the index, not only when it plans
+        if cluster['queue_aware'] or cluster['scale_down_planner']:
+            resources_usage, apps = await asyncio.gather(loop.run_in_executor(executor, elastic_search, cluster, state['ingestor'], False),
+                                                         loop.run_in_executor(executor, refresh_apps, cluster, state['apps']))
         else:
-            LOGGER.error('Login Fail')
+            resources_usage, apps = await loop.run_in_executor(executor, elastic_search, cluster, state['ingestor'], False), None
+        # The threshold count is kept as it is, the next fresh sample carries on from it
+        if resources_usage is None:
+            metrics.STALE_SAMPLES_TOTAL.inc(cluster=cluster['cluster_name'])
+            return None
+        if cluster['queue_aware'] and apps is not None:
+            add_queue_signals(resources_usage, apps, cluster['container_size'])
+        log.debug(resources_usage)
+        with metrics.DECISION_SECONDS.time(cluster=cluster['cluster_name']):
+            decision, target = decide(cluster, state, resources_usage, state['ingestor'].buffer, log)
+        if decision == 'Down Scaling' and target is not None and cluster['scale_down_planner'] and apps is None:
+            # Without the running applications a scale down could kill their containers, wait for the next cycle
+            log.info('Scale down to %s delayed, the applications are unknown' % target)
+            target = None
+        elif decision == 'Down Scaling' and target is not None and cluster['scale_down_planner']:
+            plan = await loop.run_in_executor(executor, plan_cluster_scale_down, cluster, state, resources_usage, target)
+            log.info('%r' % plan)
+            target = None if plan.delayed else plan.target
+    metrics.DECISIONS_TOTAL.inc(cluster=cluster['cluster_name'], decision=decision)
+    metrics.CPU_USAGE.set(resources_usage['cpu_usage'], cluster=cluster['cluster_name'])
+    metrics.MEMORY_USAGE.set(resources_usage['memory_usage'], cluster=cluster['cluster_name'])
+    metrics.WORKERNODES.set(resources_usage['nodes_count'], cluster=cluster['cluster_name'])
+    log.info(str("\ndecision: " + decision + "\nthreshold_count: " + str(state['threshold_count']) + '\nWorkdernode: '+ str(resources_usage['nodes_count'])))
+    if state['resizer'].busy:
+        log.info('Resize in flight: %r' % state['resizer'].current)
+
+    if decision == 'Up Scale threshold reach':
+        log.info('Threshold reach')
+    elif decision == 'Up Scaling':
+        log.info('More Resources Needed')
+    elif decision == 'Down Scaling':
+        log.info('No Extra Resources Needed')
+
+    resize_accepted = False
+    if target is not None:
+        log.info('Resize target: %s -> %s workernodes' % (resources_usage['nodes_count'], target))
+        operation = state['resizer'].submit(resources_usage['nodes_count'], target)
+        resize_accepted = operation is not None
+        if resize_accepted:
+            journal_resize(cluster, state, operation)
+    previous_count = state['threshold_count']
+    update_threshold_count(state, decision, resize_accepted)
+    journal_count(cluster, state, previous_count)
+    return decision
+
+
+async def poll_fleet(clusters, states, fleet, semaphore, executor):
+    loop = asyncio.get_running_loop()
+    by_name = dict((cluster['cluster_name'], cluster) for cluster in clusters)
+
+    # Every batch is journaled as soon as it is in, a slow batch does not hold back the others
+    async def poll_batch(names):
+        async with semaphore:
+            try:
+                await loop.run_in_executor(executor, poll_metrics, fleet, names)
+            except Exception as e:
+                LOGGER.error('Metric poll of %d cluster(s) failed: %s' % (len(names), e))
+                return
+        for name in names:
+            journal_samples(by_name[name], states[name])
+
+    # Clusters reading their ResourceManager directly are polled one by one
+    async def poll_source(cluster):
+        async with semaphore:
+            try:
+                await loop.run_in_executor(executor, poll_metrics, states[cluster['cluster_name']]['ingestor'])
+            except Exception as e:
+                cluster_logger(cluster).error('Metric poll from %s failed: %s' % (cluster['yarn_rm_url'], e))
+                return
+        journal_samples(cluster, states[cluster['cluster_name']])
+
+    await asyncio.gather(*([poll_batch(names) for names in fleet.batches()] +
+                           [poll_source(cluster) for cluster in clusters if cluster['metrics_source'] == 'yarn']))
+
+
+# Metrics of every cluster are polled together every poll_interval, in es_batch_size clusters per Elasticsearch request
+async def fleet_poll_loop(clusters, states, fleet, semaphore, executor):
+    while True:
+        await asyncio.sleep(poll_interval)
+        await poll_fleet(clusters, states, fleet, semaphore, executor)
+
+
+async def cluster_loop(cluster, state, semaphore, executor):
+    log = cluster_logger(cluster)
+    while True:
+        try:
+            with metrics.CYCLE_SECONDS.time():
+                await evaluate_cluster(cluster, state, semaphore, executor)
+        except Exception as e:
+            # One failing cluster must not stop the rest of the fleet
+            log.error('Autoscaling cycle failed: %s' % e)
+            metrics.CYCLE_ERRORS_TOTAL.inc(cluster=cluster['cluster_name'])
+        await asyncio.sleep(sample_interval)
+
+
+async def run_fleet(clusters):
+    semaphore = asyncio.Semaphore(max_clusters_in_flight)
+    states = {}
+    journal = None
+    restored = {}
+    if journal_path:
+        started = time.time()
+        restored = state_journal.replay(journal_path, max([metric_history_size] + [history_size(cluster) for cluster in clusters]))
+        LOGGER.info('Replayed journal of %d cluster(s) in %.0fms' % (len(restored), (time.time() - started) * 1000))
+        journal = state_journal.StateJournal(journal_path, snapshot=lambda: snapshot_states(states), compact_every=journal_compact_every,
+                                             on_compact=lambda: schedule_compaction(journal))
+
+    fleet = FleetIngestor(unravel, es_query_url, batch_size=es_batch_size, timeout=request_timeout)
+    for cluster in clusters:
+        state = states[cluster['cluster_name']] = new_cluster_state(cluster, journal)
+        if cluster['cluster_name'] in restored:
+            restore_cluster_state(cluster, state, restored[cluster['cluster_name']])
+        if cluster['metrics_source'] != 'yarn':
+            fleet.add(state['ingestor'])
+    try:
+        with ThreadPoolExecutor(max_workers=max_clusters_in_flight) as executor:
+            await poll_fleet(clusters, states, fleet, semaphore, executor)
+            await asyncio.gather(fleet_poll_loop(clusters, states, fleet, semaphore, executor),
+                                 *[cluster_loop(cluster, states[cluster['cluster_name']], semaphore, executor) for cluster in clusters])
+    finally:
+        if journal is not None:
+            journal.close()
+
 
-        sleep(120)
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fleet', help='JSON file with the list of clusters to autoscale', default=fleet_config)
+    argv = parser.parse_args()
+
+    if argv.fleet:
+        clusters = load_fleet(argv.fleet)
+    else:
+        clusters = [default_cluster()]
+    LOGGER.info('Autoscaling %d cluster(s): %s' % (len(clusters), ', '.join(c['cluster_name'] for c in clusters)))
+    if not check_login():
+        LOGGER.error('Not logged in to %s, retrying with the first request' % unravel_base_url)
+    if metrics_port:
+        metrics.start_metrics_server(metrics_port)
+        LOGGER.info('Serving autoscaler metrics on http://127.0.0.1:%d/metrics' % metrics_port)
+    asyncio.run(run_fleet(clusters))
 
 if __name__ == '__main__':
-    LOGGER = logging.getLogger('hdinsight_autoscaling')
     LOGGER.setLevel(logging.DEBUG)
     LOGFILE = 'hdinsight_autoscaling.log'
     fileHandler = logging.FileHandler(LOGFILE)
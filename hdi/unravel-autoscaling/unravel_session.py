@@ -0,0 +1,108 @@
+"""
+ Authenticated Unravel API session for Unravel Auto Scaling on HDInsight
+
+ Logs in to Unravel once and reuses the session cookie (and the API token
+ when the login returns one) over the shared pooled connection. The token is
+ sent with the requests of this session only, never set on the shared
+ requests.Session that also talks to other hosts. A request
+ answered with 401 or redirected to the login page is sent again after
+ logging in again; the session is also renewed once it is max_age old.
+"""
+import json
+import threading
+import time
+from urllib.parse import urlparse
+
+REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class LoginError(Exception):
+    pass
+
+
+class UnravelSession(object):
+    """
+    session:     pooled requests.Session the requests are sent over
+    login_url:   Unravel's /users/sign_in
+    credentials: JSON body of the login request
+    max_age:     seconds after which the next request logs in again, None = only on expiry
+    timeout:     seconds before the login or a request without its own timeout is given up
+    on_login:    callable(reason) called after every login, reason is 'initial', 'expired' or 'max_age'
+    """
+    def __init__(self, session, login_url, credentials, max_age=None, timeout=None, clock=time.time, on_login=None):
+        self.session = session
+        self.login_url = login_url
+        self.login_path = urlparse(login_url).path
+        self.credentials = credentials
+        self.max_age = max_age
+        self.timeout = timeout
+        self.clock = clock
+        self.on_login = on_login
+        self.token = None
+        self.logged_in_at = None
+        self.logins = 0
+        self.lock = threading.Lock()
+
+    def age(self):
+        """Seconds since the last login, None before the first one"""
+        if self.logged_in_at is None:
+            return None
+        return self.clock() - self.logged_in_at
+
+    def login(self, reason='initial'):
+        res = self.session.post(self.login_url, json=self.credentials, timeout=self.timeout, allow_redirects=False)
+        if res.status_code != 200:
+            raise LoginError('Login to %s failed with HTTP %s' % (self.login_url, res.status_code))
+        try:
+            token = (json.loads(res.text) or {}).get('token')
+        except (ValueError, AttributeError):
+            token = None
+        if token:
+            self.token = token
+        self.logged_in_at = self.clock()
+        self.logins += 1
+        if self.on_login is not None:
+            self.on_login(reason)
+
+    def ensure_login(self, generation=None, reason='initial'):
+        """
+        Log in unless another thread already did since generation (the
+        logins count the caller saw), so concurrent expiries log in once
+        """
+        with self.lock:
+            if generation is None or generation == self.logins:
+                self.login(reason)
+
+    def expired(self, res):
+        if res.status_code == 401:
+            return True
+        for response in list(res.history) + [res]:
+            if response.status_code in REDIRECTS and urlparse(response.headers.get('Location', '')).path == self.login_path:
+                return True
+        return False
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        generation = self.logins
+        if self.logged_in_at is None:
+            self.ensure_login(generation)
+        elif self.max_age is not None and self.age() > self.max_age:
+            self.ensure_login(generation, 'max_age')
+        generation = self.logins
+        res = self.send(method, url, kwargs)
+        if self.expired(res):
+            self.ensure_login(generation, 'expired')
+            res = self.send(method, url, kwargs)
+        return res
+
+    def send(self, method, url, kwargs):
+        if self.token:
+            kwargs = dict(kwargs, headers=dict(kwargs.get('headers') or {}, Authorization=self.token))
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
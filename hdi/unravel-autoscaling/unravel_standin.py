@@ -0,0 +1,344 @@
+"""
+ Local Unravel, Elasticsearch and Azure stand-in for Unravel Auto Scaling on HDInsight
+
+ One HTTP server answering everything the autoscaler calls, for a fleet of
+ simulated clusters, so it can run and be load tested without Unravel or Azure:
+
+ POST /users/sign_in                                   login, returns a token
+ POST /api/v1/apps/search                              running / pending apps of every cluster
+ GET  /api/v1/clusters/resources/<cpu|memory>/<total|allocated>   of the first cluster
+ POST /search/q/rm-search/cm                           metric_ingest queries, aggregated from the models
+ GET  /subscriptions/<id>/resourceGroups/<rg>/providers/Microsoft.HDInsight/clusters/<name>
+ POST .../clusters/<name>/roles/workernode/resize      finishes after resize_latency seconds
+ GET  /standin/operations/<id>                         status of a resize
+
+ Every cluster replays a simulator trace as its YARN demand from a random
+ offset, speed times faster than real time. Point the autoscaler at it with
+ unravel_base_url and a 'rest' topology provider using it as management URL.
+
+ python unravel_standin.py --port 3000 --clusters 50 --resize-latency 120
+"""
+import argparse
+import itertools
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+from autoscaling_metrics import ThreadingHTTPServer
+from yarn_rm_standin import yarn_cluster_metrics
+
+STEP_MS = 30000
+RESOURCE_FIELDS = {('cpu', 'total'): ('avg_totalvc', 'totalVirtualCores'),
+                   ('cpu', 'allocated'): ('avg_allocatedvcores', 'allocatedVirtualCores'),
+                   ('memory', 'total'): ('avg_totalmb', 'totalMB'),
+                   ('memory', 'allocated'): ('avg_allocatedmb', 'allocatedMB')}
+CLUSTER_PATH = re.compile(r'^/subscriptions/[^/]+/resourceGroups/[^/]+/providers/Microsoft.HDInsight/clusters/([^/]+)(/roles/workernode/resize)?$')
+
+
+def reduce_values(aggregation, document_values):
+    """Result of an avg / max / percentiles aggregation over the values of its field"""
+    kind, spec = list(aggregation.items())[0]
+    values = sorted(value for value in (doc.get(spec['field']) for doc in document_values) if value is not None)
+    if kind == 'percentiles':
+        return {'values': dict(('%.1f' % percent, values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)] if values else None)
+                               for percent in spec['percents'])}
+    if not values:
+        return {'value': None}
+    if kind == 'avg':
+        return {'value': sum(values) / float(len(values))}
+    if kind == 'max':
+        return {'value': values[-1]}
+    raise ValueError('Aggregation %s is not supported by the stand-in' % kind)
+
+
+def rm_search_document(cluster_metrics):
+    """YARN clusterMetrics as indexed in Unravel's rm-search index, vcores are VCores there"""
+    return dict((field.replace('VirtualCores', 'VCores'), value) for field, value in cluster_metrics.items())
+
+
+def parse_time(value, now_ms):
+    """epoch ms or now-<n><unit>"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.match(r'^now(-(\d+)([smhd]))?(/m)?$', value)
+    if not match:
+        raise ValueError('Date %s is not supported by the stand-in' % value)
+    units = {'s': 1000, 'm': 60000, 'h': 3600000, 'd': 86400000}
+    at = now_ms - (int(match.group(2)) * units[match.group(3)] if match.group(1) else 0)
+    if match.group(4):
+        at -= at % 60000
+    return at
+
+
+class StandInFleet(object):
+    """
+    Simulated HDInsight clusters: workernodes of one shape running the demand
+    of a trace, resized through the Azure endpoints after resize_latency seconds
+    """
+    def __init__(self, names, traces, shape=(8, 28672), initial_nodes=3, speed=1.0, resize_latency=60, seed=7, clock=time.time):
+        rand = random.Random(seed)
+        self.shape = shape
+        self.speed = speed
+        self.resize_latency = resize_latency
+        self.clock = clock
+        self.started = clock()
+        self.clusters = {}
+        for name, trace in zip(names, itertools.cycle(traces)):
+            self.clusters[name] = {'trace': trace, 'offset': rand.randrange(len(trace)), 'nodes': initial_nodes, 'resize': None}
+        self.tokens = set()
+        self.operations = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def login(self):
+        token = '%016x' % random.getrandbits(64)
+        with self.lock:
+            self.tokens.add(token)
+        return token
+
+    def demand(self, name, at):
+        cluster = self.clusters[name]
+        step = int((at - self.started) * self.speed * 1000 / STEP_MS)
+        return cluster['trace'][(cluster['offset'] + step) % len(cluster['trace'])]
+
+    def nodes(self, name, at):
+        """Workernodes running at time at, a resize in flight counts once it is done"""
+        with self.lock:
+            cluster = self.clusters[name]
+            resize = cluster['resize']
+            if resize is not None and at >= resize['ready_at']:
+                cluster['nodes'] = resize['target']
+                cluster['resize'] = None
+            return cluster['nodes']
+
+    def document(self, name, at):
+        """YARN cluster metrics document of a cluster at time at (epoch seconds)"""
+        point = self.demand(name, at)
+        return yarn_cluster_metrics(self.nodes(name, at), self.shape[0], self.shape[1], point['cores'], point['memory'])
+
+    def target_count(self, name):
+        with self.lock:
+            cluster = self.clusters[name]
+            return cluster['resize']['target'] if cluster['resize'] else cluster['nodes']
+
+    def start_resize(self, name, target):
+        now = self.clock()
+        self.nodes(name, now)
+        with self.lock:
+            self.clusters[name]['resize'] = {'target': target, 'ready_at': now + self.resize_latency}
+            operation = '%016x' % random.getrandbits(64)
+            self.operations[operation] = (name, now + self.resize_latency)
+        return operation
+
+    def operation_status(self, operation):
+        name, ready_at = self.operations[operation]
+        return 'Succeeded' if self.clock() >= ready_at else 'InProgress'
+
+    def search(self, query, now_ms):
+        """Elasticsearch response to a metric_ingest query, one document per 30s bucket"""
+        starts = {}
+        for clause in query['query']['bool'].get('should') or [query]:
+            must = clause['query']['bool']['must'] if 'query' in clause else clause['bool']['must']
+            start = parse_time(must[0]['range']['date']['gte'], now_ms)
+            matches = must[1].get('terms', must[1].get('term'))['clusterName']
+            for name in [matches] if isinstance(matches, str) else matches:
+                if name in self.clusters:
+                    starts[name] = max(start, now_ms - 3600000)
+        names = sorted(starts)
+        aggs = query['aggs']
+        if 'clusters' in aggs:
+            buckets = [dict(self.aggregate(name, self.timestamps(starts[name], now_ms), aggs['clusters']['aggs']), key=name) for name in names]
+            aggregations = {'clusters': {'buckets': buckets}}
+        elif names:
+            aggregations = self.aggregate(names[0], self.timestamps(starts[names[0]], now_ms), aggs)
+        else:
+            return {'aggregations': {}}
+        if 'windows' in aggs:
+            aggregations['windows'] = self.windows(aggs['windows']['aggs'], now_ms)
+        return {'aggregations': aggregations}
+
+    def timestamps(self, start, now_ms):
+        return range(start - start % STEP_MS, now_ms, STEP_MS)
+
+    def aggregate(self, name, timestamps, aggs):
+        documents = [(timestamp, rm_search_document(self.document(name, timestamp / 1000.0))) for timestamp in timestamps]
+        result = {}
+        for key, agg in aggs.items():
+            if 'date_histogram' in agg:
+                result[key] = {'buckets': [dict(((signal, reduce_values(spec, [doc])) for signal, spec in agg['aggs'].items()), key=timestamp)
+                                           for timestamp, doc in documents]}
+        return result
+
+    def windows(self, aggs, now_ms):
+        """The filter aggregations below the global one, per cluster over their trailing window"""
+        result = {}
+        for key, agg in aggs.items():
+            must = agg['filter']['bool']['must']
+            since = parse_time(must[0]['range']['date']['gte'], now_ms)
+            signals = agg['aggs']['clusters']['aggs']
+            buckets = []
+            for name in must[1]['terms']['clusterName']:
+                if name not in self.clusters:
+                    continue
+                window = [rm_search_document(self.document(name, timestamp / 1000.0)) for timestamp in self.timestamps(since, now_ms) if timestamp >= since]
+                buckets.append(dict(((signal, reduce_values(spec, window)) for signal, spec in signals.items()), key=name, doc_count=len(window)))
+            result[key] = {'clusters': {'buckets': buckets}}
+        return result
+
+    def apps(self, statuses, now, names=None):
+        """
+        Running apps of 4 vcores holding the allocated demand, pending ones
+        requesting the rest with nothing allocated, of names or every cluster
+        """
+        results = []
+        for name in sorted(self.clusters if names is None else set(names) & set(self.clusters)):
+            doc = self.document(name, now)
+            for status, cores, memory in (('R', doc['allocatedVirtualCores'], doc['allocatedMB']), ('W', doc['pendingVirtualCores'], doc['pendingMB'])):
+                if status not in statuses or cores <= 0:
+                    continue
+                count = int(math.ceil(cores / 4.0))
+                for i in range(count):
+                    app = {'id': 'application_%s_%s%04d' % (name, status, i), 'kind': 'spark', 'status': status,
+                           'duration_long': 60000 * (i + 1), 'queue': 'default', 'clusterId': name}
+                    if status == 'R':
+                        app.update({'allocatedVCores': cores / float(count), 'allocatedMB': memory / float(count)})
+                    else:
+                        app.update({'allocatedVCores': 0, 'allocatedMB': 0, 'pendingVCores': cores / float(count), 'pendingMB': memory / float(count)})
+                    results.append(app)
+        return results
+
+
+class UnravelStandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    fleet = None
+    latency = 0
+
+    def authorized(self):
+        token = self.headers.get('Authorization') or ''
+        cookies = self.headers.get('Cookie') or ''
+        return token in self.fleet.tokens or any(cookie.strip()[len('unravel_session='):] in self.fleet.tokens
+                                                 for cookie in cookies.split(';') if cookie.strip().startswith('unravel_session='))
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def handle_request(self, method):
+        path = self.path.split('?')[0].rstrip('/')
+        body = self.read_json() if method == 'POST' else None
+        if self.latency:
+            time.sleep(self.latency)
+        if path == '/users/sign_in':
+            self.fleet.count('login')
+            token = self.fleet.login()
+            return self.send_json({'token': token}, headers={'Set-Cookie': 'unravel_session=%s; Path=/' % token})
+
+        cluster_path = CLUSTER_PATH.match(path)
+        if path.startswith('/subscriptions/') and cluster_path:
+            name = cluster_path.group(1)
+            if name not in self.fleet.clusters:
+                return self.send_json({'error': {'code': 'ResourceNotFound'}}, 404)
+            if cluster_path.group(2) and method == 'POST':
+                self.fleet.count('azure_resize')
+                operation = self.fleet.start_resize(name, int(body['targetInstanceCount']))
+                status_url = 'http://%s:%d/standin/operations/%s' % (self.server.server_address[0], self.server.server_address[1], operation)
+                return self.send_json({}, 202, {'Azure-AsyncOperation': status_url, 'Retry-After': '1'})
+            self.fleet.count('azure_show')
+            return self.send_json({'name': name, 'properties': {'computeProfile': {'roles': [
+                {'name': 'headnode', 'targetInstanceCount': 2, 'hardwareProfile': {'vmSize': 'Standard_D12_V2'}},
+                {'name': 'workernode', 'targetInstanceCount': self.fleet.target_count(name), 'hardwareProfile': {'vmSize': 'Standard_D13_V2'}}]}}})
+        if path.startswith('/standin/operations/'):
+            self.fleet.count('azure_operation')
+            return self.send_json({'status': self.fleet.operation_status(path.rsplit('/', 1)[1])}, headers={'Retry-After': '1'})
+
+        if not self.authorized():
+            return self.send_json({'error': 'unauthorized'}, 401)
+        now = self.fleet.clock()
+        if path == '/search/q/rm-search/cm' and method == 'POST':
+            self.fleet.count('es_search')
+            return self.send_json(self.fleet.search(body, int(now * 1000)))
+        if path == '/api/v1/apps/search' and method == 'POST':
+            self.fleet.count('apps_search')
+            results = self.fleet.apps(body.get('appStatus') or ['R', 'W'], now, body.get('clusters'))
+            offset, size = body.get('from', 0), body.get('size', 100)
+            return self.send_json({'results': results[offset:offset + size], 'metadata': {'totalRecords': len(results)}})
+        resource = re.match(r'^/api/v1/clusters/resources/(cpu|memory)/(total|allocated)$', path)
+        if resource:
+            self.fleet.count('resources')
+            field, yarn_field = RESOURCE_FIELDS[resource.groups()]
+            doc = self.fleet.document(sorted(self.fleet.clusters)[0], now)
+            return self.send_json([{'time': int(now * 1000), field: doc[yarn_field]}])
+        self.send_json({'error': 'not found'}, 404)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def send_json(self, body, status=200, headers=None):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_standin(fleet, port=0, host='127.0.0.1', latency=0):
+    """
+    Serve fleet on http://host:port from a daemon thread, port 0 picks a free
+    one, latency seconds added to every request. Returns the server, its URL is server.url
+    """
+    handler = type('Handler', (UnravelStandInHandler,), {'fleet': fleet, 'latency': latency})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.fleet = fleet
+    server.url = 'http://%s:%d' % server.server_address
+    thread = threading.Thread(target=server.serve_forever, name='unravel-standin')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def canonical_traces():
+    from simulator import CANONICAL_TRACES
+    return [CANONICAL_TRACES[name]() for name in sorted(CANONICAL_TRACES)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=3000)
+    parser.add_argument('--clusters', type=int, default=10)
+    parser.add_argument('--initial-nodes', type=int, default=3)
+    parser.add_argument('--worker-shape', type=float, nargs=2, default=[8, 28672], metavar=('VCORES', 'MB'))
+    parser.add_argument('--speed', type=float, default=1.0, help='Trace replay speed, 60 plays an hour of trace per minute')
+    parser.add_argument('--resize-latency', type=float, default=60, help='Seconds a resize takes')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to every request')
+    argv = parser.parse_args()
+
+    fleet = StandInFleet(['standin-%04d' % i for i in range(argv.clusters)], canonical_traces(), argv.worker_shape,
+                         argv.initial_nodes, argv.speed, argv.resize_latency)
+    server = start_standin(fleet, argv.port, latency=argv.latency)
+    print('Unravel / Azure stand-in for %d clusters on %s' % (argv.clusters, server.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+ Local YARN ResourceManager stand-in for Unravel Auto Scaling on HDInsight
+
+ Serves /ws/v1/cluster/metrics and /ws/v1/cluster/nodes from a simple cluster
+ model so YarnRmSource and the scale down planner can run without a cluster.
+ The model is changed with a PUT of JSON to /standin, e.g.
+ {"nodes": 4, "cores": 40, "memory": 122880} for 4 workernodes and a demand
+ of 40 vcores / 120GB, or replayed from a simulator trace.
+
+ python yarn_rm_standin.py --port 8088 --nodes 4
+ python yarn_rm_standin.py --port 8088 --trace spiky --speed 60
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+from autoscaling_metrics import ThreadingHTTPServer
+
+
+def yarn_cluster_metrics(nodes, node_cores, node_memory, cores, memory):
+    """clusterMetrics of nodes workernodes running a demand of cores / memory"""
+    total_cores = nodes * node_cores
+    total_memory = nodes * node_memory
+    allocated_cores = min(cores, total_cores)
+    allocated_memory = min(memory, total_memory)
+    return {'totalVirtualCores': int(total_cores),
+            'totalMB': int(total_memory),
+            'allocatedVirtualCores': int(allocated_cores),
+            'allocatedMB': int(allocated_memory),
+            'availableVirtualCores': int(total_cores - allocated_cores),
+            'availableMB': int(total_memory - allocated_memory),
+            'pendingVirtualCores': int(cores - allocated_cores),
+            'pendingMB': int(memory - allocated_memory),
+            'activeNodes': nodes,
+            'totalNodes': nodes}
+
+
+class ClusterModel(object):
+    """Workernodes of a fixed shape and a YARN demand, allocated up to capacity and pending beyond"""
+    def __init__(self, nodes=3, node_cores=8, node_memory=28672):
+        self.nodes = nodes
+        self.node_cores = node_cores
+        self.node_memory = node_memory
+        self.cores = 0.0
+        self.memory = 0.0
+        self.lock = threading.Lock()
+
+    def update(self, values):
+        with self.lock:
+            for key in ('nodes', 'node_cores', 'node_memory', 'cores', 'memory'):
+                if key in values:
+                    setattr(self, key, values[key])
+
+    def cluster_metrics(self):
+        with self.lock:
+            return yarn_cluster_metrics(self.nodes, self.node_cores, self.node_memory, self.cores, self.memory)
+
+    def node_list(self):
+        """The demand packed onto the first nodes, the remaining ones idle"""
+        with self.lock:
+            nodes = []
+            cores, memory = self.cores, self.memory
+            for i in range(self.nodes):
+                used_cores = min(cores, self.node_cores)
+                used_memory = min(memory, self.node_memory)
+                cores -= used_cores
+                memory -= used_memory
+                nodes.append({'nodeHostName': 'wn%d-standin' % i,
+                              'state': 'RUNNING',
+                              'numContainers': int(used_cores),
+                              'usedVirtualCores': int(used_cores),
+                              'usedMemoryMB': int(used_memory)})
+            return nodes
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    model = None
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path == '/ws/v1/cluster/metrics':
+            self.send_json({'clusterMetrics': self.model.cluster_metrics()})
+        elif path == '/ws/v1/cluster/nodes':
+            self.send_json({'nodes': {'node': self.model.node_list()}})
+        else:
+            self.send_error(404)
+
+    def do_PUT(self):
+        if self.path.rstrip('/') != '/standin':
+            self.send_error(404)
+            return
+        try:
+            self.model.update(json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0)))))
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        self.send_json({'clusterMetrics': self.model.cluster_metrics()})
+
+    def send_json(self, body):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_standin(port=0, host='127.0.0.1', model=None):
+    """Serve model on http://host:port from a daemon thread, port 0 picks a free one. Returns the server"""
+    model = model or ClusterModel()
+    handler = type('Handler', (StandInHandler,), {'model': model})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.model = model
+    thread = threading.Thread(target=server.serve_forever, name='yarn-rm-standin')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def replay(model, trace, speed=1.0, step_seconds=30):
+    """Set the demand of model to each point of a simulator trace, speed times faster than real time"""
+    for point in trace:
+        model.update({'cores': point['cores'], 'memory': point['memory']})
+        time.sleep(step_seconds / float(speed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8088)
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--worker-shape', type=float, nargs=2, default=[8, 28672], metavar=('VCORES', 'MB'))
+    parser.add_argument('--trace', help='Canonical simulator trace or JSON trace file to replay as demand')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed, 60 plays an hour of trace per minute')
+    argv = parser.parse_args()
+
+    model = ClusterModel(argv.nodes, *argv.worker_shape)
+    server = start_standin(argv.port, model=model)
+    print('YARN RM stand-in on http://127.0.0.1:%d' % server.server_address[1])
+    try:
+        if argv.trace:
+            from simulator import get_trace
+            replay(model, get_trace(argv.trace), argv.speed)
+        else:
+            while True:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -21,14 +21,25 @@ limitations under the License.
 import optparse
 from optparse import OptionGroup
 import sys
-import urllib2
+import httplib
+import socket
 import time
 import json
 import base64
+import copy
+import errno
+import fcntl
+import hashlib
+import urllib
 import xml
 import xml.etree.ElementTree as ET
 import os
 import logging
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger('AmbariConfig')
 
@@ -38,9 +49,11 @@ HTTPS_PROTOCOL = 'https'
 SET_ACTION = 'set'
 GET_ACTION = 'get'
 DELETE_ACTION = 'delete'
+HISTORY_ACTION = 'history'
 
 GET_REQUEST_TYPE = 'GET'
 PUT_REQUEST_TYPE = 'PUT'
+IDEMPOTENT_REQUEST_TYPES = (GET_REQUEST_TYPE,)
 
 # JSON Keywords
 PROPERTIES = 'properties'
@@ -49,12 +62,26 @@ CLUSTERS = 'Clusters'
 DESIRED_CONFIGS = 'desired_configs'
 TYPE = 'type'
 TAG = 'tag'
+VERSION = 'version'
+NOTE = 'service_config_version_note'
 ITEMS = 'items'
 TAG_PREFIX = 'version'
+ALL_CONFIG_TYPES = 'all'
+
+DEFAULT_CACHE_SIZE = 64            # MB
+DEFAULT_HISTORY_STORE = os.path.expanduser('~/.ambari-config-history')
+HISTORY_WORKERS = 8                # Requests in flight fetching a history
+HISTORY_CHUNK_SIZE = 10            # Versions fetched per request
+
+# Exit status of a --plan with changes pending, 0 when there are none
+PLAN_CHANGES_EXIT = 2
 
 CLUSTERS_URL = '/api/v1/clusters/{0}'
 DESIRED_CONFIGS_URL = CLUSTERS_URL + '?fields=Clusters/desired_configs'
 CONFIGURATION_URL = CLUSTERS_URL + '/configurations?type={1}&tag={2}'
+CONFIG_VERSIONS_URL = CLUSTERS_URL + '/configurations?type={1}&fields=type,tag,version'
+SERVICE_CONFIG_VERSIONS_URL = CLUSTERS_URL + '/configurations/service_config_versions?is_current=true&fields=service_name,configurations/type'
+CONFIGURATIONS_URL = CLUSTERS_URL + '/configurations?fields=type,tag,properties,properties_attributes&{1}'
 
 FILE_FORMAT = \
 """
@@ -73,73 +100,382 @@ FILE_FORMAT = \
 class UsageException(Exception):
   pass
 
-def api_accessor(host, login, password, protocol, port):
-  def do_request(api_url, request_type=GET_REQUEST_TYPE, request_body=''):
+def closed_without_response(exc):
+  """The server closed the connection before answering with a single byte, as it does with an idle one"""
+  return isinstance(exc, httplib.BadStatusLine) and (exc.line == repr('') or exc.line.startswith('No status line received'))
+
+class AmbariConfigClient(object):
+  """
+  Ambari configuration API client holding one keep-alive connection to the
+  server, so a tool doing many config operations sets it up only once.
+  A client is also an accessor: client(api_url, request_type, request_body).
+  """
+  def __init__(self, host, login, password, protocol=HTTP_PROTOCOL, port='8080', timeout=60, cache=None):
+    self.host = host
+    self.cache = cache
+    self.protocol = protocol
+    self.port = int(port) if port else None
+    self.timeout = timeout
+    self.headers = {
+      'Authorization': 'Basic %s' % base64.b64encode('%s:%s' % (login, password)),
+      'X-Requested-By': 'ambari'
+    }
+    self.connection = None
+
+  def connect(self):
+    if self.protocol == HTTPS_PROTOCOL:
+      return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+    return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+  def close(self):
+    if self.connection is not None:
+      self.connection.close()
+      self.connection = None
+
+  def do_request(self, api_url, request_type=GET_REQUEST_TYPE, request_body=''):
+    # A kept-alive connection the server has closed fails on reuse, retried once on a new one.
+    # A PUT is retried only when it never reached the server, it must not be applied twice
+    for attempt in range(2):
+      reused = self.connection is not None
+      if not reused:
+        self.connection = self.connect()
+      sent = False
+      try:
+        headers = dict(self.headers)
+        if request_body:
+          headers['Content-Type'] = 'application/json'
+        self.connection.request(request_type, api_url, request_body or None, headers)
+        sent = True
+        response = self.connection.getresponse()
+        response_body = response.read()
+      except (httplib.HTTPException, socket.error) as exc:
+        self.close()
+        if reused and attempt == 0 and (request_type in IDEMPOTENT_REQUEST_TYPES or not sent or closed_without_response(exc)):
+          continue
+        raise Exception('Problem with accessing api. Reason: {0}'.format(exc))
+      if response.getheader('connection', '').lower() == 'close':
+        self.close()
+      if response.status >= 400:
+        raise Exception('Problem with accessing api. Reason: HTTP Error {0}: {1}'.format(response.status, response.reason))
+      return response_body
+
+  __call__ = do_request
+
+  def get_config_tag(self, cluster, config_type):
+    response = self.do_request(DESIRED_CONFIGS_URL.format(cluster))
     try:
-      url = '{0}://{1}:{2}{3}'.format(protocol, host, port, api_url)
-      admin_auth = base64.encodestring('%s:%s' % (login, password)).replace('\n', '')
-      request = urllib2.Request(url)
-      request.add_header('Authorization', 'Basic %s' % admin_auth)
-      request.add_header('X-Requested-By', 'ambari')
-      request.add_data(request_body)
-      request.get_method = lambda: request_type
-      response = urllib2.urlopen(request)
-      response_body = response.read()
+      desired_tags = json.loads(response)
+      current_config_tag = desired_tags[CLUSTERS][DESIRED_CONFIGS][config_type][TAG]
     except Exception as exc:
-      raise Exception('Problem with accessing api. Reason: {0}'.format(exc))
-    return response_body
-  return do_request
+      raise Exception('"{0}" not found in server response. Response:\n{1}'.format(config_type, response))
+    return current_config_tag
 
-def get_config_tag(cluster, config_type, accessor):
-  response = accessor(DESIRED_CONFIGS_URL.format(cluster))
-  try:
-    desired_tags = json.loads(response)
-    current_config_tag = desired_tags[CLUSTERS][DESIRED_CONFIGS][config_type][TAG]
-  except Exception as exc:
-    raise Exception('"{0}" not found in server response. Response:\n{1}'.format(config_type, response))
-  return current_config_tag
-
-def create_new_desired_config(cluster, config_type, properties, attributes, accessor):
-  new_tag = TAG_PREFIX + str(int(time.time() * 1000000))
-  new_config = {
-    CLUSTERS: {
-      DESIRED_CONFIGS: {
+  def get_config_tags(self, cluster):
+    response = self.do_request(DESIRED_CONFIGS_URL.format(cluster))
+    try:
+      desired_configs = json.loads(response)[CLUSTERS][DESIRED_CONFIGS]
+    except Exception as exc:
+      raise Exception('Desired configs not found in server response. Response:\n{0}'.format(response))
+    return dict((config_type, desired_config[TAG]) for config_type, desired_config in desired_configs.iteritems())
+
+  def create_new_desired_config(self, cluster, config_type, properties, attributes, note=None):
+    self.create_new_desired_configs(cluster, {config_type: (properties, attributes)}, note)
+
+  def get_config_services(self, cluster):
+    """config type -> name of the service owning it, from the current service config versions"""
+    response = self.do_request(SERVICE_CONFIG_VERSIONS_URL.format(cluster))
+    services = {}
+    for item in json.loads(response)[ITEMS]:
+      for configuration in item.get('configurations', []):
+        services[configuration[TYPE]] = item['service_name']
+    return services
+
+  def create_new_desired_configs(self, cluster, configs, note=None):
+    """
+    New versions of several config types (config type -> (properties, attributes))
+    with one PUT of a desired_configs array per service: Ambari applies the
+    types of a service together, with one stale config recalculation, and
+    either all of them or none. It refuses a request spanning several services.
+    """
+    new_tag = TAG_PREFIX + str(int(time.time() * 1000000))
+    groups = {None: sorted(configs)}
+    if len(configs) > 1:
+      services = self.get_config_services(cluster)
+      groups = {}
+      for config_type in sorted(configs):
+        groups.setdefault(services.get(config_type), []).append(config_type)
+    for service in sorted(groups):
+      self.put_desired_configs(cluster, dict((config_type, configs[config_type]) for config_type in groups[service]), new_tag, note,
+                               service if len(groups) > 1 else None)
+
+  def put_desired_configs(self, cluster, configs, new_tag, note=None, service=None):
+    desired_configs = []
+    for config_type in sorted(configs):
+      properties, attributes = configs[config_type]
+      desired_config = {
         TYPE: config_type,
         TAG: new_tag,
         PROPERTIES: properties
       }
+      if len(attributes.keys()) > 0:
+        desired_config[ATTRIBUTES] = attributes
+      if note:
+        desired_config[NOTE] = note
+      desired_configs.append(desired_config)
+    new_config = {
+      CLUSTERS: {
+        DESIRED_CONFIGS: desired_configs[0] if len(desired_configs) == 1 else desired_configs
+      }
     }
-  }
-  if len(attributes.keys()) > 0:
-    new_config[CLUSTERS][DESIRED_CONFIGS][ATTRIBUTES] = attributes
-  request_body = json.dumps(new_config)
-  new_file = 'doSet_{0}.json'.format(new_tag)
-  logger.info('### PUTting json into: {0}'.format(new_file))
-  output_to_file(new_file)(new_config)
-  accessor(CLUSTERS_URL.format(cluster), PUT_REQUEST_TYPE, request_body)
-  logger.info('### NEW Site:{0}, Tag:{1}'.format(config_type, new_tag))
-
-def get_current_config(cluster, config_type, accessor):
-  config_tag = get_config_tag(cluster, config_type, accessor)
-  logger.info("### on (Site:{0}, Tag:{1})".format(config_type, config_tag))
-  response = accessor(CONFIGURATION_URL.format(cluster, config_type, config_tag))
-  config_by_tag = json.loads(response)
-  current_config = config_by_tag[ITEMS][0]
-  return current_config[PROPERTIES], current_config.get(ATTRIBUTES, {})
-
-def update_config(cluster, config_type, config_updater, accessor):
-  properties, attributes = config_updater(cluster, config_type, accessor)
-  create_new_desired_config(cluster, config_type, properties, attributes, accessor)
+    request_body = json.dumps(new_config)
+    new_file = 'doSet_{0}.json'.format(new_tag) if service is None else 'doSet_{0}_{1}.json'.format(new_tag, service)
+    logger.info('### PUTting json into: {0}'.format(new_file))
+    output_to_file(new_file)(new_config)
+    self.do_request(CLUSTERS_URL.format(cluster), PUT_REQUEST_TYPE, request_body)
+    for config_type in sorted(configs):
+      logger.info('### NEW Site:{0}, Tag:{1}'.format(config_type, new_tag))
+      if self.cache is not None:
+        self.cache.put(cluster, config_type, new_tag, *stored_config(*configs[config_type]))
+
+  def get_current_config(self, cluster, config_type):
+    config_tag = self.get_config_tag(cluster, config_type)
+    cached = self.cache.get(cluster, config_type, config_tag) if self.cache is not None else None
+    if cached is not None:
+      logger.info("### on (Site:{0}, Tag:{1}) from cache".format(config_type, config_tag))
+      return cached
+    logger.info("### on (Site:{0}, Tag:{1})".format(config_type, config_tag))
+    response = self.do_request(CONFIGURATION_URL.format(cluster, config_type, config_tag))
+    config_by_tag = json.loads(response)
+    current_config = config_by_tag[ITEMS][0]
+    if self.cache is not None:
+      self.cache.put(cluster, config_type, config_tag, current_config[PROPERTIES], current_config.get(ATTRIBUTES, {}))
+    return current_config[PROPERTIES], current_config.get(ATTRIBUTES, {})
+
+  def get_current_configs(self, cluster, config_types=None, missing_ok=False):
+    """
+    Properties and attributes of several config types (all when None) in two
+    requests: the desired tags, then every type/tag pair in one query.
+    With missing_ok types the cluster doesn't have yet are left out.
+    """
+    config_tags = self.get_config_tags(cluster)
+    if config_types is None:
+      config_types = sorted(config_tags)
+    missing = [config_type for config_type in config_types if config_type not in config_tags]
+    if missing and not missing_ok:
+      raise Exception('"{0}" not found in desired configs of cluster {1}'.format('", "'.join(missing), cluster))
+    configs = self.fetch_configs(cluster, [(config_type, config_tags[config_type]) for config_type in config_types if config_type in config_tags])
+    return dict((config_type, config) for (config_type, config_tag), config in configs.iteritems())
+
+  def fetch_configs(self, cluster, type_tags, log=True):
+    """
+    (properties, attributes) of (type, tag) pairs, the cached ones from the
+    cache and all the others in one query
+    """
+    configs = {}
+    if self.cache is not None:
+      for config_type, config_tag in type_tags:
+        cached = self.cache.get(cluster, config_type, config_tag)
+        if cached is not None:
+          if log:
+            logger.info("### on (Site:{0}, Tag:{1}) from cache".format(config_type, config_tag))
+          configs[config_type, config_tag] = cached
+    type_tags = [type_tag for type_tag in type_tags if type_tag not in configs]
+    if not type_tags:
+      return configs
+    if log:
+      for config_type, config_tag in type_tags:
+        logger.info("### on (Site:{0}, Tag:{1})".format(config_type, config_tag))
+    predicate = '|'.join('(type={0}&tag={1})'.format(config_type, config_tag) for config_type, config_tag in type_tags)
+    response = self.do_request(CONFIGURATIONS_URL.format(cluster, urllib.quote(predicate, safe='=&()')))
+    items = dict(((item[TYPE], item[TAG]), item) for item in json.loads(response)[ITEMS])
+    for config_type, config_tag in type_tags:
+      if (config_type, config_tag) not in items:
+        raise Exception('"{0}" (Tag:{1}) not found in server response'.format(config_type, config_tag))
+      item = items[config_type, config_tag]
+      configs[config_type, config_tag] = item[PROPERTIES], item.get(ATTRIBUTES, {})
+      if self.cache is not None:
+        self.cache.put(cluster, config_type, config_tag, *configs[config_type, config_tag])
+    return configs
+
+  def get_config_versions(self, cluster, config_type):
+    """(version, tag) of every version of config_type, oldest first"""
+    response = self.do_request(CONFIG_VERSIONS_URL.format(cluster, urllib.quote(config_type)))
+    return sorted((item[VERSION], item[TAG]) for item in json.loads(response)[ITEMS])
+
+  def clone(self):
+    """A client of the same server with a connection of its own, for another thread"""
+    client = copy.copy(self)
+    client.connection = None
+    return client
+
+  def get_config_history(self, cluster, config_type, versions, workers=HISTORY_WORKERS, chunk_size=HISTORY_CHUNK_SIZE):
+    """
+    version -> (properties, attributes) of versions, (version, tag) pairs.
+    Versions not in the cache are fetched chunk_size per request, over at
+    most workers connections at the same time.
+    """
+    type_tags = [(config_type, config_tag) for version, config_tag in versions]
+    configs = {}
+    if self.cache is not None:
+      for type_tag in type_tags:
+        cached = self.cache.get(cluster, *type_tag)
+        if cached is not None:
+          configs[type_tag] = cached
+    missing = [type_tag for type_tag in type_tags if type_tag not in configs]
+    chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+    if chunks:
+      local = threading.local()
+      clients = []
+      def fetch(chunk):
+        if not hasattr(local, 'client'):
+          local.client = self.clone()
+          clients.append(local.client)
+        return local.client.fetch_configs(cluster, chunk, log=False)
+      pool = ThreadPool(min(workers, len(chunks)))
+      try:
+        for fetched in pool.map(fetch, chunks):
+          configs.update(fetched)
+      finally:
+        pool.close()
+        pool.join()
+        for client in clients:
+          client.close()
+    logger.info('### {0} version(s) of {1}, {2} fetched in {3} request(s)'.format(len(versions), config_type, len(missing), len(chunks)))
+    return dict((version, configs[config_type, config_tag]) for version, config_tag in versions)
+
+  def update_config(self, cluster, config_type, config_updater, note=None, plan_only=False):
+    return self.update_configs(cluster, {config_type: config_updater}, note, plan_only)
+
+  def update_configs(self, cluster, config_updaters, note=None, plan_only=False):
+    """
+    Run the updater of every config type against the current configs and
+    write the types that changed in one PUT, nothing when none did.
+    Returns the plan, config type -> diff_config() changes.
+    """
+    current_configs = self.get_current_configs(cluster, sorted(config_updaters), missing_ok=True)
+    snapshot = ConfigSnapshot(self, current_configs)
+    configs = dict((config_type, config_updater(cluster, config_type, snapshot)) for config_type, config_updater in config_updaters.iteritems())
+    plan = dict((config_type, diff_config(current_configs.get(config_type, ({}, {})), configs[config_type])) for config_type in configs)
+    log_plan(plan)
+    changed = [config_type for config_type in plan if plan[config_type]]
+    if plan_only:
+      return plan
+    if not changed:
+      logger.info('### No changes, nothing to PUT')
+      return plan
+    self.create_new_desired_configs(cluster, dict((config_type, configs[config_type]) for config_type in changed), note)
+    return plan
+
+  def get_config(self, cluster, config_type, output):
+    properties, attributes = self.get_current_config(cluster, config_type)
+    output(to_config(properties, attributes))
+
+  def get_configs(self, cluster, config_types, output):
+    """output gets config type -> config of config_types, all types when None"""
+    configs = self.get_current_configs(cluster, config_types)
+    output(dict((config_type, to_config(properties, attributes)) for config_type, (properties, attributes) in configs.iteritems()))
+
+class ConfigCache(object):
+  """
+  Config contents by (server, cluster, type, tag) in a directory shared by
+  concurrent processes under a file lock. The contents of a tag never
+  change, so an entry stays valid for as long as it is kept; the least
+  recently used entries are evicted once the directory holds more than
+  max_size bytes.
+  """
+  LOCK_FILE = '.lock'
+  SUFFIX = '.json.z'
+
+  def __init__(self, directory, server='', max_size=DEFAULT_CACHE_SIZE * 1024 * 1024):
+    self.directory = directory
+    self.server = server
+    self.max_size = max_size
+    try:
+      os.makedirs(directory)
+    except OSError as exc:
+      if exc.errno != errno.EEXIST:
+        raise
+
+  def path(self, cluster, config_type, tag):
+    key = u'\n'.join([self.server, cluster, config_type, tag]).encode('utf-8')
+    return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + self.SUFFIX)
+
+  @contextmanager
+  def locked(self, operation):
+    with open(os.path.join(self.directory, self.LOCK_FILE), 'a') as lock_file:
+      fcntl.flock(lock_file, operation)
+      try:
+        yield
+      finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+  def get(self, cluster, config_type, tag):
+    """(properties, attributes) of the tag, None when not cached"""
+    path = self.path(cluster, config_type, tag)
+    with self.locked(fcntl.LOCK_SH):
+      try:
+        with open(path, 'rb') as in_file:
+          entry = json.loads(zlib.decompress(in_file.read()))
+        # The modification time orders the entries for eviction
+        os.utime(path, None)
+      except (IOError, OSError, ValueError, zlib.error):
+        return None
+    return entry[PROPERTIES], entry.get(ATTRIBUTES, {})
+
+  def put(self, cluster, config_type, tag, properties, attributes):
+    path = self.path(cluster, config_type, tag)
+    # Versions of a type mostly repeat each other, compressed they take a fraction of the space
+    entry = zlib.compress(json.dumps({'cluster': cluster, TYPE: config_type, TAG: tag, PROPERTIES: properties, ATTRIBUTES: attributes}, separators=(',', ':')))
+    with self.locked(fcntl.LOCK_EX):
+      with open(path + '.tmp', 'wb') as out_file:
+        out_file.write(entry)
+      os.rename(path + '.tmp', path)
+      self.evict()
+
+  def evict(self):
+    entries = []
+    for file_name in os.listdir(self.directory):
+      if file_name.endswith(self.SUFFIX):
+        path = os.path.join(self.directory, file_name)
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+    size = sum(entry[1] for entry in entries)
+    for mtime, entry_size, path in sorted(entries):
+      if size <= self.max_size:
+        break
+      os.remove(path)
+      size -= entry_size
+
+class ConfigSnapshot(object):
+  """
+  The client as seen by the updaters of one update_configs(): the current
+  configs it already fetched are served from memory, as copies the updater
+  may change. Everything else goes to the client.
+  """
+  def __init__(self, client, configs):
+    self.client = client
+    self.configs = configs
+
+  def get_current_config(self, cluster, config_type):
+    if config_type in self.configs:
+      return copy.deepcopy(self.configs[config_type])
+    return self.client.get_current_config(cluster, config_type)
+
+  def __getattr__(self, name):
+    return getattr(self.client, name)
+
+def api_accessor(host, login, password, protocol, port):
+  return AmbariConfigClient(host, login, password, protocol, port)
 
 def update_specific_property(config_name, config_value):
-  def update(cluster, config_type, accessor):
-    properties, attributes = get_current_config(cluster, config_type, accessor)
+  def update(cluster, config_type, client):
+    properties, attributes = client.get_current_config(cluster, config_type)
     properties[config_name] = config_value
     return properties, attributes
   return update
 
 def update_from_xml(config_file):
-  def update(cluster, config_type, accessor):
+  def update(cluster, config_type, client):
     return read_xml_data_to_map(config_file)
   return update
 
@@ -173,32 +509,124 @@ def read_xml_data_to_map(path):
     configurations[name_text] = value_text
   return configurations, {"final" : properties_attributes}
 
+def read_json_file(config_file):
+  try:
+    with open(config_file) as in_file:
+      file_content = in_file.read()
+  except Exception as e:
+    raise Exception('Cannot find file "{0}" to PUT'.format(config_file))
+  try:
+    return json.loads('{' + file_content + '}')
+  except Exception as e:
+    raise Exception('File "{0}" should be in the following JSON format ("properties_attributes" is optional):\n{1}'.format(config_file, FILE_FORMAT))
+
 def update_from_file(config_file):
-  def update(cluster, config_type, accessor):
-    try:
-      with open(config_file) as in_file:
-        file_content = in_file.read()
-    except Exception as e:
-      raise Exception('Cannot find file "{0}" to PUT'.format(config_file))
-    try:
-      file_properties = json.loads('{' + file_content + '}')
-    except Exception as e:
-      raise Exception('File "{0}" should be in the following JSON format ("properties_attributes" is optional):\n{1}'.format(config_file, FILE_FORMAT))
+  def update(cluster, config_type, client):
+    file_properties = read_json_file(config_file)
     new_properties = file_properties.get(PROPERTIES, {})
     new_attributes = file_properties.get(ATTRIBUTES, {})
     logger.info('### PUTting file: "{0}"'.format(config_file))
     return new_properties, new_attributes
   return update
 
+def update_from_types_file(config_file, config_types=None):
+  """
+  Updaters of several config types saved in one file as by a "get" of
+  several types, "type": {"properties": ..}, all types in the file when None
+  """
+  file_configs = read_json_file(config_file)
+  config_types = config_types or sorted(file_configs)
+  missing = [config_type for config_type in config_types if not isinstance(file_configs.get(config_type), dict)]
+  if missing:
+    raise Exception('"{0}" not found in file "{1}"'.format('", "'.join(missing), config_file))
+  def file_update(config_type):
+    def update(cluster, config_type, client):
+      logger.info('### PUTting "{0}" from file: "{1}"'.format(config_type, config_file))
+      return file_configs[config_type].get(PROPERTIES, {}), file_configs[config_type].get(ATTRIBUTES, {})
+    return update
+  return dict((config_type, file_update(config_type)) for config_type in config_types)
+
+def update_from_directory(directory, config_types=None):
+  """Updaters of the config types saved in a directory as <type>.xml or <type>.json, all files when None"""
+  updaters = {}
+  for file_name in sorted(os.listdir(directory)):
+    config_type, ext = os.path.splitext(file_name)
+    if ext == ".xml":
+      updaters[config_type] = update_from_xml(os.path.join(directory, file_name))
+    elif ext == ".json":
+      updaters[config_type] = update_from_file(os.path.join(directory, file_name))
+  if not config_types:
+    return updaters
+  missing = [config_type for config_type in config_types if config_type not in updaters]
+  if missing:
+    raise Exception('No .xml or .json file for "{0}" in "{1}"'.format('", "'.join(missing), directory))
+  return dict((config_type, updaters[config_type]) for config_type in config_types)
+
 def delete_specific_property(config_name):
-  def update(cluster, config_type, accessor):
-    properties, attributes = get_current_config(cluster, config_type, accessor)
+  def update(cluster, config_type, client):
+    properties, attributes = client.get_current_config(cluster, config_type)
     properties.pop(config_name, None)
     for attribute_values in attributes.values():
       attribute_values.pop(config_name, None)
     return properties, attributes
   return update
 
+def config_value(value):
+  # Ambari keeps every value as a string
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  return value if isinstance(value, basestring) else unicode(value)
+
+def stored_config(properties, attributes):
+  """(properties, attributes) as Ambari stores them"""
+  return (dict((name, config_value(value)) for name, value in properties.iteritems()),
+          dict((attribute, dict((name, config_value(value)) for name, value in values.iteritems())) for attribute, values in attributes.iteritems()))
+
+def flatten_config(properties, attributes):
+  flat = dict((name, config_value(value)) for name, value in properties.iteritems())
+  for attribute, values in attributes.iteritems():
+    for name, value in values.iteritems():
+      flat['{0}/{1}/{2}'.format(ATTRIBUTES, attribute, name)] = config_value(value)
+  return flat
+
+def diff_config(current, new):
+  """
+  Property level changes from current to new, both (properties, attributes):
+  sorted ('+' | '-' | '~', name, current value, new value), attributes named
+  properties_attributes/<attribute>/<property>
+  """
+  current, new = flatten_config(*current), flatten_config(*new)
+  changes = []
+  for name in sorted(set(current) | set(new)):
+    if name not in new:
+      changes.append(('-', name, current[name], None))
+    elif name not in current:
+      changes.append(('+', name, None, new[name]))
+    elif current[name] != new[name]:
+      changes.append(('~', name, current[name], new[name]))
+  return changes
+
+def format_change(change):
+  op, name, current_value, new_value = change
+  if op == '+':
+    return u'  + "{0}": "{1}"'.format(name, new_value)
+  if op == '-':
+    return u'  - "{0}": "{1}"'.format(name, current_value)
+  return u'  ~ "{0}": "{1}" -> "{2}"'.format(name, current_value, new_value)
+
+def log_plan(plan):
+  for config_type in sorted(plan):
+    changes = plan[config_type]
+    if not changes:
+      logger.info('### Plan for {0}: no changes'.format(config_type))
+      continue
+    logger.info('### Plan for {0}: {1} change(s)'.format(config_type, len(changes)))
+    for change in changes:
+      logger.info(format_change(change))
+
+def plan_status(plan):
+  return PLAN_CHANGES_EXIT if any(plan.values()) else 0
+
 def format_json(dictionary, tab_level=0):
   output = ''
   tab = ' ' * 2 * tab_level
@@ -206,6 +634,8 @@ def format_json(dictionary, tab_level=0):
     output += ',\n{0}"{1}": '.format(tab, key)
     if isinstance(value, dict):
       output += '{\n' + format_json(value, tab_level + 1) + tab + '}'
+    elif isinstance(value, list):
+      output += '[\n' + ',\n'.join('{0}  {{\n{1}{0}  }}'.format(tab, format_json(item, tab_level + 2)) for item in value) + '\n' + tab + ']'
     else:
       output += '"{0}"'.format(value)
   output += '\n'
@@ -217,17 +647,24 @@ def output_to_file(filename):
       out_file.write(format_json(config))
   return output
 
-def output_to_console(config):
-  print format_json(config)
+def output_to_directory(directory):
+  def output(configs):
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    for config_type, config in configs.iteritems():
+      output_to_file(os.path.join(directory, '{0}.json'.format(config_type)))(config)
+  return output
 
-def get_config(cluster, config_type, accessor, output):
-  properties, attributes = get_current_config(cluster, config_type, accessor)
+def to_config(properties, attributes):
   config = {PROPERTIES: properties}
   if len(attributes.keys()) > 0:
     config[ATTRIBUTES] = attributes
-  output(config)
+  return config
 
-def set_properties(cluster, config_type, args, accessor):
+def output_to_console(config):
+  print format_json(config)
+
+def set_properties(cluster, config_type, args, client, note=None, plan_only=False):
   logger.info('### Performing "set":')
 
   if len(args) == 1:
@@ -246,10 +683,26 @@ def set_properties(cluster, config_type, args, accessor):
     config_value = args[1]
     updater = update_specific_property(config_name, config_value)
     logger.info('### new property - "{0}":"{1}"'.format(config_name, config_value))
-  update_config(cluster, config_type, updater, accessor)
-  return 0
+  plan = client.update_config(cluster, config_type, updater, note, plan_only)
+  return plan_status(plan) if plan_only else 0
+
+def set_configs(cluster, config_types, args, client, note=None, plan_only=False):
+  """Set several config types (None for all in the file or directory) in one PUT"""
+  logger.info('### Performing "set" of several config types:')
+  source = args[0]
+  if os.path.isdir(source):
+    updaters = update_from_directory(source, config_types)
+    logger.info('### from directory {0}'.format(source))
+  else:
+    updaters = update_from_types_file(source, config_types)
+    logger.info('### from file {0}'.format(source))
+  if not updaters:
+    logger.error('No config types to set found in "{0}"'.format(source))
+    return -1
+  plan = client.update_configs(cluster, updaters, note, plan_only)
+  return plan_status(plan) if plan_only else 0
 
-def delete_properties(cluster, config_type, args, accessor):
+def delete_properties(cluster, config_type, args, client, plan_only=False):
   logger.info('### Performing "delete":')
   if len(args) == 0:
     logger.error("Not enough arguments. Expected config key.")
@@ -257,19 +710,83 @@ def delete_properties(cluster, config_type, args, accessor):
 
   config_name = args[0]
   logger.info('### on property "{0}"'.format(config_name))
-  update_config(cluster, config_type, delete_specific_property(config_name), accessor)
-  return 0
+  plan = client.update_config(cluster, config_type, delete_specific_property(config_name), plan_only=plan_only)
+  return plan_status(plan) if plan_only else 0
 
 
-def get_properties(cluster, config_type, args, accessor):
+def get_properties(cluster, config_types, args, client):
   logger.info("### Performing \"get\" content:")
+  batch = len(config_types) > 1 or config_types == [ALL_CONFIG_TYPES]
   if len(args) > 0:
     filename = args[0]
-    output = output_to_file(filename)
-    logger.info('### to file "{0}"'.format(filename))
+    # Several types go to one file, or to one <type>.json each when given a directory
+    if batch and (os.path.isdir(filename) or filename.endswith(os.sep)):
+      output = output_to_directory(filename)
+      logger.info('### to directory "{0}"'.format(filename))
+    else:
+      output = output_to_file(filename)
+      logger.info('### to file "{0}"'.format(filename))
   else:
     output = output_to_console
-  get_config(cluster, config_type, accessor, output)
+  if batch:
+    client.get_configs(cluster, None if config_types == [ALL_CONFIG_TYPES] else config_types, output)
+  else:
+    client.get_config(cluster, config_types[0], output)
+  return 0
+
+def parse_versions(expression, versions):
+  """(version, tag) of versions within "first:last", either end may be left out, or of a single version"""
+  first, last = expression.split(':', 1) if ':' in expression else (expression, expression)
+  first = int(first) if first.strip() else None
+  last = int(last) if last.strip() else None
+  return [(version, tag) for version, tag in versions if (first is None or version >= first) and (last is None or version <= last)]
+
+def history(cluster, config_type, client, version_range=None, diff_versions=None, output_file=None, workers=HISTORY_WORKERS):
+  logger.info('### Performing "history":')
+  versions = client.get_config_versions(cluster, config_type)
+  if not versions:
+    logger.error('No versions of "{0}" found'.format(config_type))
+    return -1
+  tags = dict(versions)
+
+  if diff_versions:
+    missing = [str(version) for version in diff_versions if version not in tags]
+    if missing:
+      logger.error('No version {0} of "{1}"'.format(', '.join(missing), config_type))
+      return -1
+    configs = client.get_config_history(cluster, config_type, [(version, tags[version]) for version in diff_versions], workers)
+    changes = diff_config(configs[diff_versions[0]], configs[diff_versions[1]])
+    print '### {0} version {1} -> {2}: {3} change(s)'.format(config_type, diff_versions[0], diff_versions[1], len(changes))
+    for change in changes:
+      print format_change(change)
+    return 0
+
+  if version_range is None and not output_file:
+    current_tag = client.get_config_tag(cluster, config_type)
+    for version, tag in versions:
+      print '{0:>8}  {1}{2}'.format(version, tag, '  (current)' if tag == current_tag else '')
+    return 0
+
+  selected = parse_versions(version_range or ':', versions)
+  if not selected:
+    logger.error('No versions of "{0}" in {1}'.format(config_type, version_range))
+    return -1
+  # The version before the range too, the first one is compared with it
+  first = versions.index(selected[0])
+  configs = client.get_config_history(cluster, config_type, versions[max(0, first - 1):first] + selected, workers)
+  previous = configs[versions[first - 1][0]] if first > 0 else None
+  for version, tag in selected:
+    if previous is None:
+      print '### version {0} ({1}): first version, {2} properties'.format(version, tag, len(configs[version][0]))
+    else:
+      changes = diff_config(previous, configs[version])
+      print '### version {0} ({1}): {2} change(s)'.format(version, tag, len(changes))
+      for change in changes:
+        print format_change(change)
+    previous = configs[version]
+  if output_file:
+    output_to_file(output_file)(OrderedDict((str(version), dict(to_config(*configs[version]), tag=tag)) for version, tag in selected))
+    logger.info('### {0} version(s) exported to file "{1}"'.format(len(selected), output_file))
   return 0
 
 def main():
@@ -284,15 +801,22 @@ def main():
 
   parser.add_option("-t", "--port", dest="port", default="8080", help="Optional port number for Ambari server. Default is '8080'. Provide empty string to not use port.")
   parser.add_option("-s", "--protocol", dest="protocol", default="http", help="Optional support of SSL. Default protocol is 'http'")
-  parser.add_option("-a", "--action", dest="action", help="Script action: <get>, <set>, <delete>")
+  parser.add_option("-a", "--action", dest="action", help="Script action: <get>, <set>, <delete>, <history>")
   parser.add_option("-l", "--host", dest="host", help="Server external host name")
   parser.add_option("-n", "--cluster", dest="cluster", help="Name given to cluster. Ex: 'c1'")
-  parser.add_option("-c", "--config-type", dest="config_type", help="One of the various configuration types in Ambari. Ex: core-site, hdfs-site, mapred-queue-acls, etc.")
+  parser.add_option("--plan", dest="plan", action="store_true", default=False, help="Only print what a 'set' or 'delete' would change. Exits with {0} when there are changes pending, 0 otherwise".format(PLAN_CHANGES_EXIT))
+  parser.add_option("--cache-dir", dest="cache_dir", help="Optional directory caching config contents by tag, shared by concurrent runs. Only the current tags are asked from the server for cached contents. 'history' always keeps the versions it fetched, in {0} by default".format(DEFAULT_HISTORY_STORE))
+  parser.add_option("--cache-size", dest="cache_size", type="int", default=DEFAULT_CACHE_SIZE, help="Size in MB the cache directory is kept under, least recently used contents are evicted first. Default is {0}".format(DEFAULT_CACHE_SIZE))
+  parser.add_option("-c", "--config-type", dest="config_type", help="One of the various configuration types in Ambari. Ex: core-site, hdfs-site, mapred-queue-acls, etc. 'get' and 'set' also take a comma separated list, or 'all'")
 
   config_options_group = OptionGroup(parser, "To specify property(s) please use \"-f\" OR \"-k\" and \"-v'\"")
-  config_options_group.add_option("-f", "--file", dest="file", help="File where entire configurations are saved to, or read from. Supported extensions (.xml, .json>)")
+  config_options_group.add_option("-f", "--file", dest="file", help="File where entire configurations are saved to, or read from. Supported extensions (.xml, .json>). Several config types are saved to, or read from, one file or a directory of one file per type")
   config_options_group.add_option("-k", "--key", dest="key", help="Key that has to be set or deleted. Not necessary for 'get' action.")
   config_options_group.add_option("-v", "--value", dest="value", help="Optional value to be set. Not necessary for 'get' or 'delete' actions.")
+  config_options_group.add_option("-r", "--versions", dest="versions", help="Versions a 'history' shows the changes of, 'first:last' (either may be left out) or one version. Without it the versions are listed")
+  config_options_group.add_option("-d", "--diff", dest="diff", help="Two versions a 'history' compares, e.g. '12,187'")
+  config_options_group.add_option("-w", "--workers", dest="workers", type="int", default=HISTORY_WORKERS, help="Requests in flight fetching a 'history'. Default is {0}".format(HISTORY_WORKERS))
+  config_options_group.add_option("-m", "--note", dest="note", help="Optional service config version note of a 'set', shared by all the config types it sets")
   parser.add_option_group(config_options_group)
 
   (options, args) = parser.parse_args()
@@ -341,9 +865,18 @@ def main():
   action = options.action
   host = options.host
   cluster = options.cluster
-  config_type = options.config_type
-
-  accessor = api_accessor(host, user, password, protocol, port)
+  config_types = [config_type.strip() for config_type in options.config_type.split(',') if config_type.strip()]
+  batch = len(config_types) > 1 or config_types == [ALL_CONFIG_TYPES]
+  if batch and (action == DELETE_ACTION or (action == SET_ACTION and not options.file)):
+    parser.error("Action \"{0}\" of several config types (-c) needs a file or directory (-f)".format(action))
+  if batch and action == HISTORY_ACTION:
+    parser.error("Action \"{0}\" takes a single config type (-c)".format(action))
+  config_type = config_types[0]
+
+  cache = None
+  if options.cache_dir or action == HISTORY_ACTION:
+    cache = ConfigCache(options.cache_dir or DEFAULT_HISTORY_STORE, '{0}://{1}:{2}'.format(protocol, host, port), options.cache_size * 1024 * 1024)
+  client = AmbariConfigClient(host, user, password, protocol, port, cache=cache)
   if action == SET_ACTION:
 
     if not options.file and (not options.key or not options.value):
@@ -352,23 +885,42 @@ def main():
       action_args = [options.file]
     else:
       action_args = [options.key, options.value]
-    return set_properties(cluster, config_type, action_args, accessor)
+    if batch:
+      return set_configs(cluster, None if config_types == [ALL_CONFIG_TYPES] else config_types, action_args, client, options.note, options.plan)
+    return set_properties(cluster, config_type, action_args, client, options.note, options.plan)
 
   elif action == GET_ACTION:
     if options.file:
       action_args = [options.file]
     else:
       action_args = []
-    return get_properties(cluster, config_type, action_args, accessor)
+    return get_properties(cluster, config_types, action_args, client)
 
   elif action == DELETE_ACTION:
     if not options.key:
       parser.error("You should use option (-k) to set property name witch will be deleted")
     else:
       action_args = [options.key]
-    return delete_properties(cluster, config_type, action_args, accessor)
+    return delete_properties(cluster, config_type, action_args, client, options.plan)
+
+  elif action == HISTORY_ACTION:
+    diff_versions = None
+    if options.diff:
+      try:
+        diff_versions = [int(version) for version in options.diff.split(',')]
+      except ValueError:
+        diff_versions = []
+      if len(diff_versions) != 2:
+        parser.error("You should use option (-d) with two versions separated by a comma, e.g. '12,187'")
+    if options.versions:
+      try:
+        parse_versions(options.versions, [])
+      except ValueError:
+        logger.error('Incorrect versions "{0}". Expected a version or a range of versions, e.g. "12", "12:187" or "180:"'.format(options.versions))
+        return -1
+    return history(cluster, config_type, client, options.versions, diff_versions, options.file, options.workers)
   else:
-    logger.error('Action "{0}" is not supported. Supported actions: "get", "set", "delete".'.format(action))
+    logger.error('Action "{0}" is not supported. Supported actions: "get", "set", "delete", "history".'.format(action))
     return -1
 
 if __name__ == "__main__":
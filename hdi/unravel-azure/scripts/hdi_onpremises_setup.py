@@ -50,6 +50,8 @@ hive_site_json = log_dir + 'hive-site.json'
 hadoop_env_json = log_dir + 'hadoop-env.json'
 mapred_site_json = log_dir + 'mapred-site.json'
 tez_site_json = log_dir + 'tez-site.json'
+# configs.py keeps the config contents by tag here, reused by every configs.py call of the run
+config_cache_dir = log_dir + 'configs-cache'
 if not os.path.exists(log_dir):
     os.makedirs(log_dir)
 if not os.path.exists(script_dir + 'configs.py'):
@@ -289,9 +291,9 @@ def deploy_sensor():
 #########################################################################
 def get_config(config_name, set_file=None):
     if set_file:
-        return check_output('python /usr/local/unravel/configs.py -l {0} -u {1} -p \'{2}\' -n {3} -a get -c {4} -f {5}'.format(argv.am_host, argv.username, argv.password, argv.cluster_name, config_name, set_file), shell=True)
+        return check_output('python /usr/local/unravel/configs.py --cache-dir \'{cache}\' -l {0} -u {1} -p \'{2}\' -n {3} -a get -c {4} -f {5}'.format(argv.am_host, argv.username, argv.password, argv.cluster_name, config_name, set_file, cache=config_cache_dir), shell=True)
     else:
-        return check_output('python /usr/local/unravel/configs.py -l {0} -u {1} -p \'{2}\' -n {3} -a get -c {4}'.format(argv.am_host, argv.username, argv.password, argv.cluster_name, config_name), shell=True)
+        return check_output('python /usr/local/unravel/configs.py --cache-dir \'{cache}\' -l {0} -u {1} -p \'{2}\' -n {3} -a get -c {4}'.format(argv.am_host, argv.username, argv.password, argv.cluster_name, config_name, cache=config_cache_dir), shell=True)
 
 #####################################################################
 # Get Ambari Last Operations                                        #
@@ -306,10 +308,10 @@ def get_latest_req_stat():
 #####################################################################
 def get_spark_defaults():
     try:
-        spark_defaults = check_output('python /usr/local/unravel/configs.py -l {0} -u {1} -p \'{2}\' -n {3} -a get -c spark2-defaults -f {4}'.format(argv.am_host, argv.username, argv.password, argv.cluster_name, spark_def_json), shell=True)
+        spark_defaults = check_output('python /usr/local/unravel/configs.py --cache-dir \'{cache}\' -l {0} -u {1} -p \'{2}\' -n {3} -a get -c spark2-defaults -f {4}'.format(argv.am_host, argv.username, argv.password, argv.cluster_name, spark_def_json, cache=config_cache_dir), shell=True)
         return ('spark2-defaults')
     except:
-        spark_defaults =check_output('python /usr/local/unravel/configs.py -l {0} -u {1} -p \'{2}\' -n {3} -a get -c spark-defaults -f {4}'.format(argv.am_host, argv.username, argv.password, argv.cluster_name, spark_def_json), shell=True)
+        spark_defaults =check_output('python /usr/local/unravel/configs.py --cache-dir \'{cache}\' -l {0} -u {1} -p \'{2}\' -n {3} -a get -c spark-defaults -f {4}'.format(argv.am_host, argv.username, argv.password, argv.cluster_name, spark_def_json, cache=config_cache_dir), shell=True)
         return ('spark-defaults')
 
 #####################################################################
@@ -458,9 +460,9 @@ def uninstall_unravel(hdfs_url=None,hive_env_content=None,hadoop_env_content=Non
 def update_config(config_name,config_key=None,config_value=None, set_file=None):
     try:
         if set_file:
-            return check_output('python /usr/local/unravel/configs.py -l {0} -u {1} -p \'{2}\' -n {3} -a set -c {4} -f {5}'.format(argv.am_host, argv.username, argv.password, argv.cluster_name, config_name, set_file), shell=True)
+            return check_output('python /usr/local/unravel/configs.py --cache-dir \'{cache}\' -l {0} -u {1} -p \'{2}\' -n {3} -a set -c {4} -f {5}'.format(argv.am_host, argv.username, argv.password, argv.cluster_name, config_name, set_file, cache=config_cache_dir), shell=True)
         else:
-            return check_output('python /usr/local/unravel/configs.py -l {0} -u {1} -p \'{2}\' -n {3} -a set -c {4} -k {5} -v {6}'.format(argv.am_host, argv.username, argv.password, argv.cluster_name, config_name, config_key, config_value), shell=True)
+            return check_output('python /usr/local/unravel/configs.py --cache-dir \'{cache}\' -l {0} -u {1} -p \'{2}\' -n {3} -a set -c {4} -k {5} -v {6}'.format(argv.am_host, argv.username, argv.password, argv.cluster_name, config_name, config_key, config_value, cache=config_cache_dir), shell=True)
     except:
         print('\Update %s configuration failed' % config_name)
 
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+'''
+Tests of configs.py against a recording stand-in for the Ambari API
+
+python test_configs.py
+'''
+
+import fcntl
+import httplib
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from StringIO import StringIO
+
+import configs
+
+SERVICE_CONFIG_VERSIONS = {
+  'items': [
+    {'service_name': 'HIVE', 'configurations': [{'type': 'hive-site'}, {'type': 'hive-env'}]},
+    {'service_name': 'MAPREDUCE2', 'configurations': [{'type': 'mapred-site'}]},
+    {'service_name': 'SPARK2', 'configurations': [{'type': 'spark2-defaults'}]}
+  ]
+}
+
+class RecordingClient(configs.AmbariConfigClient):
+  """Answers the service config versions query and records every request instead of sending it"""
+  def __init__(self):
+    configs.AmbariConfigClient.__init__(self, 'ambari', 'admin', 'admin')
+    self.requests = []
+
+  def do_request(self, api_url, request_type=configs.GET_REQUEST_TYPE, request_body=''):
+    self.requests.append((request_type, api_url, request_body))
+    if api_url == configs.SERVICE_CONFIG_VERSIONS_URL.format('c1'):
+      return json.dumps(SERVICE_CONFIG_VERSIONS)
+    return '{}'
+
+  def puts(self):
+    return [json.loads(body)[configs.CLUSTERS][configs.DESIRED_CONFIGS] for request_type, api_url, body in self.requests
+            if request_type == configs.PUT_REQUEST_TYPE]
+
+class CreateNewDesiredConfigsTest(unittest.TestCase):
+  def setUp(self):
+    # doSet_<tag>.json records are written to the working directory
+    self.cwd = os.getcwd()
+    self.directory = tempfile.mkdtemp()
+    os.chdir(self.directory)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.directory)
+
+  def test_mixed_service_batch_is_one_put_per_service(self):
+    client = RecordingClient()
+    client.create_new_desired_configs('c1', {
+      'hive-site': ({'a': '1'}, {}),
+      'hive-env': ({'b': '2'}, {}),
+      'mapred-site': ({'c': '3'}, {}),
+      'spark2-defaults': ({'d': '4'}, {})
+    }, note='unravel')
+    puts = client.puts()
+    self.assertEqual(3, len(puts))
+    types = [sorted(desired[configs.TYPE] for desired in (put if isinstance(put, list) else [put])) for put in puts]
+    self.assertEqual(sorted([['hive-env', 'hive-site'], ['mapred-site'], ['spark2-defaults']]), sorted(types))
+    tags = set(desired[configs.TAG] for put in puts for desired in (put if isinstance(put, list) else [put]))
+    self.assertEqual(1, len(tags))
+
+  def test_single_service_batch_is_one_put(self):
+    client = RecordingClient()
+    client.create_new_desired_configs('c1', {'hive-site': ({'a': '1'}, {}), 'hive-env': ({'b': '2'}, {})})
+    puts = client.puts()
+    self.assertEqual(1, len(puts))
+    self.assertEqual(['hive-env', 'hive-site'], [desired[configs.TYPE] for desired in puts[0]])
+
+  def test_single_type_needs_no_service_lookup(self):
+    client = RecordingClient()
+    client.create_new_desired_config('c1', 'hive-site', {'a': '1'}, {})
+    self.assertEqual([configs.PUT_REQUEST_TYPE], [request[0] for request in client.requests])
+    self.assertEqual('hive-site', client.puts()[0][configs.TYPE])
+
+class PlanTest(unittest.TestCase):
+  def test_diff_config(self):
+    current = ({'a': '1', 'b': '2', 'c': '3'}, {'final': {'a': 'true'}})
+    new = ({'a': '1', 'b': 20, 'd': True}, {'final': {'a': 'true', 'd': 'false'}})
+    self.assertEqual([('~', 'b', '2', '20'),
+                      ('-', 'c', '3', None),
+                      ('+', 'd', None, 'true'),
+                      ('+', 'properties_attributes/final/d', None, 'false')], configs.diff_config(current, new))
+
+  def test_same_values_are_no_change(self):
+    self.assertEqual([], configs.diff_config(({'a': '1', 'b': 'true'}, {}), ({'a': 1, 'b': True}, {})))
+
+  def test_plan_status(self):
+    self.assertEqual(0, configs.plan_status({'hive-site': [], 'hive-env': []}))
+    self.assertEqual(configs.PLAN_CHANGES_EXIT, configs.plan_status({'hive-site': [], 'hive-env': [('+', 'a', None, '1')]}))
+
+class ConfigCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.cache = configs.ConfigCache(self.directory, 'ambari')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def put(self, tag, mtime=None):
+    self.cache.put('c1', 'hive-site', tag, {'a': '1'}, {})
+    if mtime is not None:
+      os.utime(self.cache.path('c1', 'hive-site', tag), (mtime, mtime))
+
+  def test_get_returns_what_was_put(self):
+    self.cache.put('c1', 'hive-site', 'version1', {'a': '1'}, {'final': {'a': 'true'}})
+    self.assertEqual(({'a': '1'}, {'final': {'a': 'true'}}), self.cache.get('c1', 'hive-site', 'version1'))
+    self.assertEqual(None, self.cache.get('c1', 'hive-site', 'version2'))
+    self.assertEqual(None, configs.ConfigCache(self.directory, 'other').get('c1', 'hive-site', 'version1'))
+
+  def test_least_recently_used_entries_are_evicted(self):
+    for i, tag in enumerate(['version1', 'version2', 'version3']):
+      self.put(tag, mtime=1000 + i)
+    # Read last, version1 is now the most recently used
+    self.cache.get('c1', 'hive-site', 'version1')
+    # Room for three entries, not four
+    self.cache.max_size = 3.5 * os.path.getsize(self.cache.path('c1', 'hive-site', 'version1'))
+    self.put('version4')
+    cached = [tag for tag in ['version1', 'version2', 'version3', 'version4'] if self.cache.get('c1', 'hive-site', tag) is not None]
+    self.assertEqual(['version1', 'version3', 'version4'], cached)
+
+  def test_get_waits_for_a_writer_holding_the_lock(self):
+    self.put('version1')
+    done = []
+    with open(os.path.join(self.directory, configs.ConfigCache.LOCK_FILE), 'a') as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      reader = threading.Thread(target=lambda: done.append(self.cache.get('c1', 'hive-site', 'version1')))
+      reader.start()
+      time.sleep(0.2)
+      self.assertEqual([], done)
+      fcntl.flock(lock_file, fcntl.LOCK_UN)
+      reader.join(5)
+    self.assertEqual([({'a': '1'}, {})], done)
+
+VERSIONS = [(version, 'version{0}'.format(version)) for version in (1, 2, 5, 12, 180, 181)]
+
+class HistoryClient(configs.AmbariConfigClient):
+  """Every version of hive-site sets a to its version number, records which versions are fetched"""
+  def __init__(self):
+    configs.AmbariConfigClient.__init__(self, 'ambari', 'admin', 'admin')
+    self.fetched = []
+
+  def get_config_versions(self, cluster, config_type):
+    return list(VERSIONS)
+
+  def get_config_history(self, cluster, config_type, versions, workers=configs.HISTORY_WORKERS, chunk_size=configs.HISTORY_CHUNK_SIZE):
+    self.fetched.append([version for version, tag in versions])
+    return dict((version, ({'a': str(version)}, {})) for version, tag in versions)
+
+class VersionRangeTest(unittest.TestCase):
+  def test_parse_versions(self):
+    self.assertEqual([180, 181], [version for version, tag in configs.parse_versions('180:', VERSIONS)])
+    self.assertEqual([1, 2, 5, 12], [version for version, tag in configs.parse_versions(':12', VERSIONS)])
+    self.assertEqual([5, 12], [version for version, tag in configs.parse_versions('3:12', VERSIONS)])
+    self.assertEqual([(12, 'version12')], configs.parse_versions('12', VERSIONS))
+    self.assertEqual(VERSIONS, configs.parse_versions(':', VERSIONS))
+
+  def test_malformed_range_is_rejected(self):
+    for expression in ('abc', '1:x', '1-5'):
+      self.assertRaises(ValueError, configs.parse_versions, expression, VERSIONS)
+
+  def history(self, version_range):
+    client = HistoryClient()
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+      status = configs.history('c1', 'hive-site', client, version_range)
+      output = sys.stdout.getvalue()
+    finally:
+      sys.stdout = stdout
+    return status, client.fetched, output
+
+  def test_history_fetches_the_version_before_the_range(self):
+    status, fetched, output = self.history('5:12')
+    self.assertEqual(0, status)
+    self.assertEqual([[2, 5, 12]], fetched)
+    self.assertEqual(['5', '12'], [line.split()[2] for line in output.splitlines() if line.startswith('### version')])
+    self.assertIn('~ "a": "2" -> "5"', output)
+
+  def test_history_from_the_first_version(self):
+    status, fetched, output = self.history(':2')
+    self.assertEqual([[1, 2]], fetched)
+    self.assertIn('### version 1 (version1): first version, 1 properties', output)
+
+  def test_history_of_an_empty_range_fails(self):
+    status, fetched, output = self.history('6:11')
+    self.assertEqual(-1, status)
+    self.assertEqual([], fetched)
+
+class ScriptedResponse(object):
+  status = 200
+  reason = 'OK'
+
+  def read(self):
+    return '{}'
+
+  def getheader(self, name, default=None):
+    return default
+
+class ScriptedConnection(object):
+  """Fails the way it is told to, on send or on reading the response"""
+  def __init__(self, log, fail_on=None, error=None):
+    self.log = log
+    self.fail_on = fail_on
+    self.error = error
+
+  def request(self, method, url, body=None, headers=None):
+    self.log.append(method)
+    if self.fail_on == 'send':
+      raise self.error
+
+  def getresponse(self):
+    if self.fail_on == 'response':
+      raise self.error
+    return ScriptedResponse()
+
+  def close(self):
+    pass
+
+class StaleConnectionClient(configs.AmbariConfigClient):
+  """Its kept-alive connection fails, every new one works"""
+  def __init__(self, fail_on, error):
+    configs.AmbariConfigClient.__init__(self, 'ambari', 'admin', 'admin')
+    self.sent = []
+    self.connection = ScriptedConnection(self.sent, fail_on, error)
+
+  def connect(self):
+    return ScriptedConnection(self.sent)
+
+class DoRequestRetryTest(unittest.TestCase):
+  def test_get_is_retried_on_a_new_connection(self):
+    client = StaleConnectionClient('response', socket.error(104, 'Connection reset by peer'))
+    client.do_request('/api/v1/clusters')
+    self.assertEqual(['GET', 'GET'], client.sent)
+
+  def test_put_that_may_have_been_applied_is_not_retried(self):
+    client = StaleConnectionClient('response', socket.error(104, 'Connection reset by peer'))
+    self.assertRaises(Exception, client.do_request, '/api/v1/clusters/c1', configs.PUT_REQUEST_TYPE, '{}')
+    self.assertEqual(['PUT'], client.sent)
+
+  def test_put_is_retried_when_it_was_not_sent(self):
+    client = StaleConnectionClient('send', socket.error(32, 'Broken pipe'))
+    client.do_request('/api/v1/clusters/c1', configs.PUT_REQUEST_TYPE, '{}')
+    self.assertEqual(['PUT', 'PUT'], client.sent)
+
+  def test_put_is_retried_when_the_idle_connection_was_closed(self):
+    client = StaleConnectionClient('response', httplib.BadStatusLine(''))
+    client.do_request('/api/v1/clusters/c1', configs.PUT_REQUEST_TYPE, '{}')
+    self.assertEqual(['PUT', 'PUT'], client.sent)
+
+if __name__ == '__main__':
+  unittest.main()